@@ -1,7 +1,100 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.contrib import admin
-from .models import ChatUser, Conversation, Message
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Count, IntegerField, OuterRef, Prefetch, Subquery
+from django.utils.functional import cached_property
+from .models import ChatUser, Conversation, Message, Announcement
 
-# Register your models here.
-admin.site.register(ChatUser)
-admin.site.register(Conversation)
-admin.site.register(Message)
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    uses the planner statistics instead of a full COUNT(*) for unfiltered changelists of big tables
+    '''
+    @cached_property
+    def count(self):
+        if connection.vendor == 'postgresql' and not self.object_list.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [self.object_list.model._meta.db_table])
+                row = cursor.fetchone()
+
+            if row is not None and row[0] > 0:
+                return int(row[0])
+
+        return super().count
+
+
+def _count_subquery(queryset, field_name):
+    # a correlated subquery is only evaluated for the rows of the page, unlike a join with GROUP BY
+    return Subquery(
+        queryset.filter(**{field_name: OuterRef('pk')}).order_by().values(field_name).annotate(count=Count('*')).values('count'),
+        output_field=IntegerField()
+    )
+
+
+@admin.register(ChatUser)
+class ChatUserAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'user', 'age', 'message_count', 'last_message_time')
+    list_select_related = ('user',)
+    search_fields = ('name', 'user__username')
+    raw_id_fields = ('user',)
+    ordering = ('-id',)
+
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'attendees_names', 'attendees_count', 'message_count', 'last_message_time', 'is_open', 'closed_at')
+    list_filter = ('is_open',)
+    raw_id_fields = ('attendees',)
+    ordering = ('-id',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(
+            Prefetch('attendees', queryset=ChatUser.objects.select_related('user'))
+        ).annotate(
+            attendees_count=_count_subquery(Conversation.attendees.through.objects, 'conversation')
+        )
+
+    def attendees_names(self, conversation):
+        return ', '.join(str(chat_user) for chat_user in conversation.attendees.all())
+
+    def attendees_count(self, conversation):
+        return conversation.attendees_count or 0
+
+
+@admin.register(Message)
+class MessageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'author', 'conversation_number', 'text', 'time')
+    list_select_related = ('author__user',)
+    list_filter = (('time', admin.DateFieldListFilter),)
+    raw_id_fields = ('author', 'conversation')
+    ordering = ('-id',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def conversation_number(self, message):
+        return message.conversation_id
+
+
+@admin.register(Announcement)
+class AnnouncementAdmin(admin.ModelAdmin):
+    list_display = ('id', 'text', 'created_at', 'sent_at', 'delivered_count')
+    readonly_fields = ('sent_at', 'delivered_count')
+    ordering = ('-id',)
+    actions = ['send_announcements']
+
+    def send_announcements(self, request, queryset):
+        channel_layer = get_channel_layer()
+        announcement_ids = list(queryset.values_list('id', flat=True))
+        for announcement_id in announcement_ids:
+            async_to_sync(channel_layer.send)(
+                'announcements-task',
+                {'type': 'send_announcement', 'announcement_id': announcement_id}
+            )
+
+        self.message_user(request, f'Sending {len(announcement_ids)} announcements to all connected users')
+
+    send_announcements.short_description = 'Send to all connected users'
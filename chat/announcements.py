@@ -0,0 +1,38 @@
+import asyncio
+import collections
+
+
+def get_broadcast_group_name(shard):
+    return f'broadcast_{shard}'
+
+
+class DeliveryCounter:
+    '''
+    counts the announcements delivered by the connections of this process, and reports them to the announcements
+    task once per flush interval instead of once per delivered socket
+    '''
+    def __init__(self, channel_layer, flush_interval_seconds):
+        self._channel_layer = channel_layer
+        self._flush_interval_seconds = flush_interval_seconds
+        self._counts = collections.Counter()
+        self._flush_handle = None
+
+    def increment(self, announcement_id):
+        self._counts[announcement_id] += 1
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self._flush_interval_seconds, self._on_flush)
+
+    def _on_flush(self):
+        self._flush_handle = None
+        counts = self._counts
+        self._counts = collections.Counter()
+        asyncio.ensure_future(self._flush(counts))
+
+    async def _flush(self, counts):
+        await self._channel_layer.send(
+            'announcements-task',
+            {
+                'type': 'record_deliveries',
+                'deliveries': [[announcement_id, count] for announcement_id, count in counts.items()]
+            }
+        )
@@ -0,0 +1,42 @@
+class ConnectionFeatures:
+    '''
+    the state of the features a connection has used, one object created on the first use of any of them,
+    so an idle connection keeps a single empty attribute instead of one per feature
+    '''
+    __slots__ = (
+        'rate_limit_buckets',
+        'typing_debouncer',
+        'typing_poll_handle',
+        'receipt_batcher',
+        'receipts_poll_handle',
+    )
+
+    def __init__(self):
+        for name in ConnectionFeatures.__slots__:
+            setattr(self, name, None)
+
+
+class FeatureField:
+    '''
+    a consumer attribute kept in its ConnectionFeatures, reads None until the features are created
+    '''
+    __slots__ = ('_name',)
+
+    def __init__(self, name):
+        self._name = name
+
+    def __get__(self, consumer, owner):
+        if consumer is None:
+            return self
+
+        features = consumer._features
+        return getattr(features, self._name) if features is not None else None
+
+    def __set__(self, consumer, value):
+        if consumer._features is None:
+            if value is None:
+                return
+
+            consumer._features = ConnectionFeatures()
+
+        setattr(consumer._features, self._name, value)
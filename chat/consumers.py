@@ -2,8 +2,17 @@ import asyncio
 import json
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 import jsonschema
+from django.conf import settings
 from .tasks import ConversationManagerTask
 from .enums import ErrorEnum
+from .throttling import TokenBucket, ChannelBacklogMonitor, get_inbox_depth
+from .drain import DrainController
+from .typing import TypingDebouncer
+from .receipts import ReceiptBatcher
+from .announcements import DeliveryCounter, get_broadcast_group_name
+from .connection_features import FeatureField
+from .phrase_filter import BannedPhraseFilter
+from . import metrics
 from .conversation_user_dictionary import ConversationUserDictionary
 
 
@@ -11,7 +20,7 @@ base_schema = {
     '$schema': 'http://json-schema.org/draft-07/schema#',
     'type': 'object',
     'properties': {
-        'request_type': {'type': 'string', 'enum': ['join_lobby', 'conversation_closed', 'send_message', 'receive_message', 'error', 'request_match', 'unrequest_match', 'receive_match', 'leave', 'join', 'authenticate', 'set_pn_token']},
+        'request_type': {'type': 'string', 'enum': ['join_lobby', 'conversation_closed', 'send_message', 'receive_message', 'error', 'request_match', 'unrequest_match', 'receive_match', 'leave', 'join', 'authenticate', 'set_pn_token', 'reconnect', 'typing', 'set_visibility', 'receipt', 'announcement']},
         'payload': {'type': 'object'},
         'seq': {'type': 'number', 'minimum': 1,  'multipleOf': 1.0},
     },
@@ -36,6 +45,7 @@ send_message_schema = {
     'type': 'object',
     'properties': {
         'text': {'type': 'string', 'maxLength': 500},
+        'client_message_id': {'type': 'string', 'minLength': 1, 'maxLength': 64},
     },
     'required': ['text'],
     'additionalProperties': False
@@ -61,6 +71,8 @@ receive_message_schema = {
         'conversation_id': {'type': 'number', 'minimum': 1, 'multipleOf': 1.0},
         'author_id': {'type': 'number', 'minimum': 1, 'multipleOf': 1.0},
         'time': {'type': 'number', 'minimum': 0},
+        'client_message_id': {'type': 'string', 'minLength': 1, 'maxLength': 64},
+        'message_id': {'type': 'number', 'minimum': 1, 'multipleOf': 1.0},
     },
     'required': ['text', 'conversation_id', 'author_id', 'time'],
     'additionalProperties': False
@@ -90,6 +102,7 @@ receive_match_schema = {
     'type': 'object',
     'properties': {
         'conversation_id': {'type': 'number', 'minimum': 1, 'multipleOf': 1.0},
+        'room_id': {'type': 'number', 'minimum': 1, 'multipleOf': 1.0},
         'attendees': {
             'type': 'object',
             "patternProperties": {
@@ -123,6 +136,62 @@ join_schema = {
     'additionalProperties': False
 }
 
+reconnect_schema = {
+    '$schema': 'http://json-schema.org/draft-07/schema#',
+    'type': 'object',
+    'properties': {
+        'backoff_ms': {'type': 'number', 'minimum': 0, 'multipleOf': 1.0},
+    },
+    'required': ['backoff_ms'],
+    'additionalProperties': False
+}
+
+typing_schema = {
+    '$schema': 'http://json-schema.org/draft-07/schema#',
+    'type': 'object',
+    'properties': {
+        'is_typing': {'type': 'boolean'},
+        'user_id': {'type': 'number', 'minimum': 1, 'multipleOf': 1.0},
+    },
+    'required': ['is_typing'],
+    'additionalProperties': False
+}
+
+announcement_schema = {
+    '$schema': 'http://json-schema.org/draft-07/schema#',
+    'type': 'object',
+    'properties': {
+        'announcement_id': {'type': 'number', 'minimum': 1, 'multipleOf': 1.0},
+        'text': {'type': 'string', 'maxLength': 500},
+    },
+    'required': ['announcement_id', 'text'],
+    'additionalProperties': False
+}
+
+# the marks are message ids, every message up to the mark is acknowledged
+receipt_schema = {
+    '$schema': 'http://json-schema.org/draft-07/schema#',
+    'type': 'object',
+    'properties': {
+        # message ids, the marks are stored in 32 bit columns
+        'delivered_up_to': {'type': 'number', 'minimum': 0, 'maximum': 2 ** 31 - 1, 'multipleOf': 1.0},
+        'seen_up_to': {'type': 'number', 'minimum': 0, 'maximum': 2 ** 31 - 1, 'multipleOf': 1.0},
+        'user_id': {'type': 'number', 'minimum': 1, 'multipleOf': 1.0},
+    },
+    'anyOf': [{'required': ['delivered_up_to']}, {'required': ['seen_up_to']}],
+    'additionalProperties': False
+}
+
+set_visibility_schema = {
+    '$schema': 'http://json-schema.org/draft-07/schema#',
+    'type': 'object',
+    'properties': {
+        'is_visible': {'type': 'boolean'},
+    },
+    'required': ['is_visible'],
+    'additionalProperties': False
+}
+
 authenticate_schema = {
     '$schema': 'http://json-schema.org/drauft-07/schema#',
     'type': 'object',
@@ -145,40 +214,113 @@ payload_dict = {
     'leave': leave_schema,
     'join': join_schema,
     'authenticate': authenticate_schema,
-    'set_pn_token': set_pn_token_schema
+    'set_pn_token': set_pn_token_schema,
+    'reconnect': reconnect_schema,
+    'typing': typing_schema,
+    'set_visibility': set_visibility_schema,
+    'receipt': receipt_schema,
+    'announcement': announcement_schema
 }
 
 
 class ChatConsumer(AsyncJsonWebsocketConsumer):
     AUTHENTICATE_TIMEOUT_SECONDS = 3
     INACTIVENESS_TIMEOUT_SECONDS = 180
+    TYPING_INTERVAL_SECONDS = 2
+    TYPING_IDLE_TIMEOUT_SECONDS = 6
+    RECEIPTS_INTERVAL_SECONDS = 2
+
+    # request type: (tokens refilled per second, bucket capacity)
+    RATE_LIMITS = {
+        'authenticate': (0.5, 3),
+        'send_message': (2, 10),
+        'request_match': (0.2, 3),
+        'unrequest_match': (0.2, 3),
+        'join_lobby': (0.2, 3),
+        'set_pn_token': (0.1, 2),
+        'typing': (10, 20),
+        'set_visibility': (2, 10),
+        'receipt': (5, 20),
+    }
+    # skipped while the consumer lags behind its channel, join and leave only while in the lobby
+    DROPPABLE_REQUEST_TYPES = {'typing', 'receipt'}
+    DROPPABLE_LOBBY_REQUEST_TYPES = {'join', 'leave'}
+    # rejected while the workers are overloaded
+    # receipts are cumulative, a rejected one is covered by the next
+    NON_CRITICAL_REQUEST_TYPES = {'request_match', 'join_lobby', 'set_pn_token', 'receipt'}
+    WORKER_CHANNELS = ['db-operations-task', 'matchmaking-task', 'conversation-manager-task', 'pn-task', 'announcements-task']
+
+    _backlog_monitor = None
+    _drain_controller = None
+    _banned_phrase_filter = None
+    _delivery_counter = None
+
+    # the groups are joined and left explicitly, no per connection list
+    groups = ()
+    _rate_limit_buckets = FeatureField('rate_limit_buckets')
+    _typing_debouncer = FeatureField('typing_debouncer')
+    _typing_poll_handle = FeatureField('typing_poll_handle')
+    _receipt_batcher = FeatureField('receipt_batcher')
+    _receipts_poll_handle = FeatureField('receipts_poll_handle')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self._conversation_id = None
+        self._lobby_room_id = None
         self._chat_user_id = None
         self._chat_user_name = None
         self._seq = 0
         self._is_authenticated = False
         self._new_message_flag = True
         self._has_push_notifications = False
+        self._is_visible = True
+        # the rate limit, typing and receipts state, created on first use
+        self._features = None
+
+        # plain timer handles instead of sleeping tasks, an idle connection should not hold any coroutine
+        loop = asyncio.get_event_loop()
+        self._last_activity_time = loop.time()
+        self._authenticate_timeout_handle = loop.call_later(
+            ChatConsumer.AUTHENTICATE_TIMEOUT_SECONDS,
+            self._on_authenticate_timeout
+        )
+        self._inactiveness_timeout_handle = loop.call_later(
+            ChatConsumer.INACTIVENESS_TIMEOUT_SECONDS,
+            self._on_inactiveness_check
+        )
 
-        self._authenticate_timeout_task = asyncio.create_task(self.send_disconnection_due_to_authentication_timeout())
-        self._in_active_timeout = asyncio.create_task(self.send_disconnection_due_to_inactiveness())
+    def _on_authenticate_timeout(self):
+        self._authenticate_timeout_handle = None
+        asyncio.ensure_future(self.send_disconnection_due_to_authentication_timeout())
 
     async def send_disconnection_due_to_authentication_timeout(self):
-        await asyncio.sleep(ChatConsumer.AUTHENTICATE_TIMEOUT_SECONDS)
         await self.send_error_message(ErrorEnum.AUTHENTICATION_TIMEOUT, error_message='disconnecting due to authentication timeout')
         await self.close()
 
-    async def send_disconnection_due_to_inactiveness(self):
-        while self.did_got_new_message():
-            await asyncio.sleep(ChatConsumer.INACTIVENESS_TIMEOUT_SECONDS)
+    def _on_inactiveness_check(self):
+        if self.did_got_new_message():
+            self._inactiveness_timeout_handle = asyncio.get_event_loop().call_later(
+                ChatConsumer.INACTIVENESS_TIMEOUT_SECONDS,
+                self._on_inactiveness_check
+            )
+        else:
+            self._inactiveness_timeout_handle = None
+            asyncio.ensure_future(self.send_disconnection_due_to_inactiveness())
 
+    async def send_disconnection_due_to_inactiveness(self):
         await self.send_error_message(ErrorEnum.INACTIVENESS_TIMEOUT, error_message='disconnecting due inactiveness')
         await self.close()
 
+    def _cancel_timeouts(self):
+        if self._authenticate_timeout_handle is not None:
+            self._authenticate_timeout_handle.cancel()
+            self._authenticate_timeout_handle = None
+
+        if self._inactiveness_timeout_handle is not None:
+            self._inactiveness_timeout_handle.cancel()
+            self._inactiveness_timeout_handle = None
+
     def did_got_new_message(self):
         did_got_new_message = self._new_message_flag
         if did_got_new_message:
@@ -190,37 +332,84 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         self._seq += 1
         return self._seq
 
-    async def update_conversation_id(self, value):
+    def get_group_name(self):
+        # lobby members only listen to their own lobby room
+        if self._conversation_id == ConversationUserDictionary.LOBBY_CONVERSATION_ID:
+            return ConversationManagerTask.get_lobby_room_channel(self._lobby_room_id)
+
+        return ConversationManagerTask.get_conversation_channel(self._conversation_id)
+
+    async def update_conversation_id(self, value, lobby_room_id=None):
         if self._conversation_id != value:
             if self._conversation_id is not None:
-                await self.channel_layer.group_discard(
-                    ConversationManagerTask.get_conversation_channel(self._conversation_id),
-                    self.channel_name
-                )
+                await self._flush_receipts()
+                await self.channel_layer.group_discard(self.get_group_name(), self.channel_name)
+
+            self._reset_typing()
 
             self._conversation_id = value
+            self._lobby_room_id = lobby_room_id
             await self.channel_layer.send(
                 'conversation-manager-task',
                 {
                     'type': 'join_conversation',
                     'user_id': self._chat_user_id,
-                    'conversation_id': self._conversation_id
+                    'conversation_id': self._conversation_id,
+                    'lobby_room_id': self._lobby_room_id
                 }
             )
-            await self.channel_layer.group_add(ConversationManagerTask.get_conversation_channel(self._conversation_id), self.channel_name)
+            await self.channel_layer.group_add(self.get_group_name(), self.channel_name)
+
+    @classmethod
+    def get_drain_controller(cls):
+        if cls._drain_controller is None:
+            cls._drain_controller = DrainController(
+                settings.DRAIN_WAVES,
+                settings.DRAIN_DURATION_SECONDS,
+                settings.RECONNECT_MIN_BACKOFF_SECONDS,
+                settings.RECONNECT_MAX_BACKOFF_SECONDS
+            )
+
+        return cls._drain_controller
 
     async def connect(self):
+        drain_controller = self.get_drain_controller()
+        if drain_controller.is_draining:
+            # the process is going down, the client should connect to another one
+            await self.close()
+            return
+
+        if settings.DRAIN_ON_SIGTERM:
+            drain_controller.install_signal_handler()
+
+        drain_controller.register(self)
         await self.accept()
 
+    async def send_reconnect_and_close(self, backoff_seconds):
+        content = {
+            'request_type': 'reconnect',
+            'seq': self.get_next_seq(),
+            'payload': {
+                'backoff_ms': int(backoff_seconds * 1000)
+            }
+        }
+
+        await self.send_json(content)
+        await self.close()
+
     async def receive_json(self, content, **kwargs):
         try:
             self._new_message_flag = True
+            self._last_activity_time = asyncio.get_event_loop().time()
             self.validate_content(content)
 
             if not self._is_authenticated and content['request_type'] != 'authenticate':
                 await self.close()
                 return
 
+            if not await self.is_request_allowed(content):
+                return
+
             try:
                 # calling the specific payload process function
                 await getattr(self, f'process__{content["request_type"]}')(content)
@@ -245,8 +434,13 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         await self.send_receive_match(conversation_id, attendees)
 
     async def disconnect(self, close_code):
+        self.get_drain_controller().unregister(self)
+        self._cancel_timeouts()
+        self._reset_typing()
+
         if self._is_authenticated:
-            group = ConversationManagerTask.get_conversation_channel(self._conversation_id)
+            await self._flush_receipts()
+            group = self.get_group_name()
 
             # not sending leave message if the conversation is closed already
             if close_code != ErrorEnum.CONVERSATION_CLOSED:
@@ -267,6 +461,53 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                     {'type': 'remove_pn_listener', 'channel_name': self.channel_name}
                 )
             await self.channel_layer.group_discard(group, self.channel_name)
+            await self.channel_layer.group_discard(self.get_broadcast_group_name(), self.channel_name)
+
+    @classmethod
+    def get_backlog_monitor(cls, channel_layer):
+        if cls._backlog_monitor is None:
+            cls._backlog_monitor = ChannelBacklogMonitor(
+                channel_layer,
+                cls.WORKER_CHANNELS,
+                settings.SHEDDING_BACKLOG_THRESHOLD,
+                settings.SHEDDING_SAMPLE_INTERVAL_SECONDS
+            )
+
+        return cls._backlog_monitor
+
+    @classmethod
+    def get_banned_phrase_filter(cls):
+        if cls._banned_phrase_filter is None:
+            cls._banned_phrase_filter = BannedPhraseFilter(
+                settings.BANNED_PHRASES_FILE,
+                settings.BANNED_PHRASES_POLICY,
+                settings.BANNED_PHRASES_RELOAD_INTERVAL_SECONDS
+            )
+
+        return cls._banned_phrase_filter
+
+    async def is_request_allowed(self, content):
+        request_type = content['request_type']
+
+        if (
+                request_type in ChatConsumer.NON_CRITICAL_REQUEST_TYPES and
+                self.get_backlog_monitor(self.channel_layer).is_overloaded()
+        ):
+            await self.send_error_message(ErrorEnum.SERVER_BUSY, 'Server is busy, try again later', content['seq'])
+            return False
+
+        if request_type in ChatConsumer.RATE_LIMITS:
+            if self._rate_limit_buckets is None:
+                self._rate_limit_buckets = {}
+
+            if request_type not in self._rate_limit_buckets:
+                self._rate_limit_buckets[request_type] = TokenBucket(*ChatConsumer.RATE_LIMITS[request_type])
+
+            if not self._rate_limit_buckets[request_type].consume():
+                await self.send_error_message(ErrorEnum.RATE_LIMITED, 'Too many requests', content['seq'])
+                return False
+
+        return True
 
     @classmethod
     def validate_content(cls, content):
@@ -284,18 +525,30 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             await self.send_error_message(ErrorEnum.CONVERSATION_NOT_INITIALIZED, "conversation has not initialized yet")
             return
 
+        is_rejected, text = await self.get_banned_phrase_filter().filter(payload['text'])
+        if is_rejected:
+            await self.send_error_message(ErrorEnum.MESSAGE_REJECTED, 'Message contains a banned phrase', content['seq'])
+            return
+
+        # the conversation manager authorizes the message against its roster before it reaches the db, the only time
+        # the message passes through it
         await self.channel_layer.send(
-            'db-operations-task',
+            'conversation-manager-task',
             {
-                'type': 'create_message',
+                'type': 'authorize_message',
                 'channel_name': self.channel_name,
-                'text': payload['text'],
+                'text': text,
                 'conversation_id': self._conversation_id,
                 'author_id': self._chat_user_id,
+                'lobby_room_id': self._lobby_room_id,
+                'client_message_id': payload.get('client_message_id'),
                 'seq': content['seq'],
             }
         )
 
+    async def process__set_visibility(self, content):
+        self._is_visible = content['payload']['is_visible']
+
     async def process__set_pn_token(self, content):
         payload = content['payload']
         await self.channel_layer.send(
@@ -314,6 +567,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
         if error_code == ErrorEnum.OK.value:
             message_payload = content['message']
+            content_is_duplicate = content.get('is_duplicate', False)
             content = {
                 'request_type': 'receive_message',
                 # TODO: this is a bug: using one chat sequence number to other.
@@ -322,12 +576,26 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                     'text': message_payload['text'],
                     'conversation_id': message_payload['conversation_id'],
                     'author_id': message_payload['author_id'],
-                    'time': message_payload['time']
+                    'time': message_payload['time'],
+                    'message_id': message_payload['message_id']
                 }
             }
 
-            # broadcasting the message
-            await self.send_to_group(content)
+            if message_payload.get('client_message_id') is not None:
+                content['payload']['client_message_id'] = message_payload['client_message_id']
+
+            if content_is_duplicate:
+                # a retry of a message that was already broadcasted, only the author needs the answer
+                await self.send_json(content)
+            else:
+                # the conversation manager authorized the message on its way to the db, it is not passed through it again
+                await self.channel_layer.group_send(
+                    self.get_group_name(),
+                    {
+                        'type': 'chat.message',
+                        'content': content
+                    }
+                )
         else:
             # fallback
             await self.send_error_message(
@@ -353,11 +621,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
         if error_code == ErrorEnum.OK.value:
             # login success
-            self._authenticate_timeout_task.cancel()
-            self._chat_user_id = content['chat_user_id']
-            self._chat_user_name = content['chat_user_name']
-            self._is_authenticated = True
-
+            self.set_authenticated(content['chat_user_id'], content['chat_user_name'])
+            await self.channel_layer.group_add(self.get_broadcast_group_name(), self.channel_name)
             await self.send_error_message(response_to=error_payload['response_to'])
         else:
             # login has failed
@@ -367,6 +632,36 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             )
             await self.close()
 
+    def set_authenticated(self, chat_user_id, chat_user_name):
+        if self._authenticate_timeout_handle is not None:
+            self._authenticate_timeout_handle.cancel()
+            self._authenticate_timeout_handle = None
+
+        self._chat_user_id = chat_user_id
+        self._chat_user_name = chat_user_name
+        self._is_authenticated = True
+
+    def get_broadcast_group_name(self):
+        return get_broadcast_group_name(self._chat_user_id % settings.BROADCAST_SHARDS)
+
+    @classmethod
+    def get_delivery_counter(cls, channel_layer):
+        if cls._delivery_counter is None:
+            cls._delivery_counter = DeliveryCounter(channel_layer, settings.ANNOUNCEMENT_DELIVERIES_FLUSH_SECONDS)
+
+        return cls._delivery_counter
+
+    async def chat_announcement(self, content):
+        await self.send_json({
+            'request_type': 'announcement',
+            'seq': self.get_next_seq(),
+            'payload': {
+                'announcement_id': content['announcement_id'],
+                'text': content['text']
+            }
+        })
+        self.get_delivery_counter(self.channel_layer).increment(content['announcement_id'])
+
     async def send_to_group(self, content):
         await self.channel_layer.send(
             'conversation-manager-task',
@@ -377,17 +672,33 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             }
         )
 
+    '''
+    a push notification is only useful to a recipient who is not looking at the chat right now
+    '''
+    def should_send_push_notification(self, message_payload):
+        if message_payload['author_id'] == self._chat_user_id:
+            return False
+
+        if not self._is_visible:
+            return True
+
+        return asyncio.get_event_loop().time() - self._last_activity_time >= settings.PN_IDLE_SECONDS
+
     async def chat_message(self, content):
         if content['content']['request_type'] == 'receive_message' and self._has_push_notifications:
-            await self.channel_layer.send(
-                'pn-task',
-                {
-                    'type': 'send_pn_message',
-                    'channel_name': self.channel_name,
-                    'title': 'הודעה חדשה',
-                    'body': f'{content["content"]["payload"]["text"]}'
-                }
-            )
+            if self.should_send_push_notification(content['content']['payload']):
+                metrics.increment('pn.sent')
+                await self.channel_layer.send(
+                    'pn-task',
+                    {
+                        'type': 'send_pn_message',
+                        'channel_name': self.channel_name,
+                        'title': 'הודעה חדשה',
+                        'body': f'{content["content"]["payload"]["text"]}'
+                    }
+                )
+            else:
+                metrics.increment('pn.suppressed')
 
         await self.send_json(content['content'])
 
@@ -395,10 +706,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         if content['user_id'] == self._chat_user_id:
             await self.close(ErrorEnum.CONVERSATION_CLOSED)
         else:
-            await self.channel_layer.group_discard(
-                ConversationManagerTask.get_conversation_channel(self._conversation_id),
-                self.channel_name
-            )
+            await self.channel_layer.group_discard(self.get_group_name(), self.channel_name)
 
             content = {
                 'request_type': 'conversation_closed',
@@ -408,6 +716,157 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
             await self.send_json(content)
 
+    async def process__typing(self, content):
+        # typing indicators are only relayed inside conversations, never to the lobby
+        if self._conversation_id is None or self._conversation_id == ConversationUserDictionary.LOBBY_CONVERSATION_ID:
+            return
+
+        if self._typing_debouncer is None:
+            self._typing_debouncer = TypingDebouncer(
+                ChatConsumer.TYPING_INTERVAL_SECONDS,
+                ChatConsumer.TYPING_IDLE_TIMEOUT_SECONDS
+            )
+
+        now = asyncio.get_event_loop().time()
+        await self._send_typing_state(self._typing_debouncer.on_typing(content['payload']['is_typing'], now))
+
+    async def _send_typing_state(self, is_typing):
+        if is_typing is not None:
+            # going straight to the conversation group, the state is not worth a conversation manager hop
+            await self.channel_layer.group_send(
+                self.get_group_name(),
+                {
+                    'type': 'chat.typing',
+                    'user_id': self._chat_user_id,
+                    'is_typing': is_typing
+                }
+            )
+
+        self._schedule_typing_poll()
+
+    def _schedule_typing_poll(self):
+        if self._typing_poll_handle is not None:
+            self._typing_poll_handle.cancel()
+            self._typing_poll_handle = None
+
+        deadline = self._typing_debouncer.get_next_deadline() if self._typing_debouncer is not None else None
+        if deadline is not None:
+            self._typing_poll_handle = asyncio.get_event_loop().call_at(deadline, self._on_typing_poll)
+
+    def _on_typing_poll(self):
+        self._typing_poll_handle = None
+        if self._typing_debouncer is not None:
+            now = asyncio.get_event_loop().time()
+            asyncio.ensure_future(self._send_typing_state(self._typing_debouncer.poll(now)))
+
+    def _reset_typing(self):
+        self._typing_debouncer = None
+        self._schedule_typing_poll()
+
+    async def chat_typing(self, content):
+        if content['user_id'] == self._chat_user_id:
+            return
+
+        await self.send_json({
+            'request_type': 'typing',
+            'seq': self.get_next_seq(),
+            'payload': {
+                'user_id': content['user_id'],
+                'is_typing': content['is_typing']
+            }
+        })
+
+    async def process__receipt(self, content):
+        if self._conversation_id is None or self._conversation_id == ConversationUserDictionary.LOBBY_CONVERSATION_ID:
+            return
+
+        if self._receipt_batcher is None:
+            self._receipt_batcher = ReceiptBatcher(ChatConsumer.RECEIPTS_INTERVAL_SECONDS)
+
+        payload = content['payload']
+        marks = self._receipt_batcher.on_receipt(
+            payload.get('delivered_up_to', 0),
+            payload.get('seen_up_to', 0),
+            asyncio.get_event_loop().time()
+        )
+        if marks is not None:
+            await self._send_receipts(*marks)
+
+        self._schedule_receipts_poll()
+
+    async def _send_receipts(self, delivered_up_to, seen_up_to):
+        await self.channel_layer.send(
+            'db-operations-task',
+            {
+                'type': 'update_receipts',
+                'conversation_id': self._conversation_id,
+                'user_id': self._chat_user_id,
+                'delivered_up_to': delivered_up_to,
+                'seen_up_to': seen_up_to
+            }
+        )
+        await self.channel_layer.group_send(
+            self.get_group_name(),
+            {
+                'type': 'chat.receipt',
+                'user_id': self._chat_user_id,
+                'delivered_up_to': delivered_up_to,
+                'seen_up_to': seen_up_to
+            }
+        )
+
+    def _schedule_receipts_poll(self):
+        if self._receipts_poll_handle is not None:
+            self._receipts_poll_handle.cancel()
+            self._receipts_poll_handle = None
+
+        deadline = self._receipt_batcher.get_next_deadline() if self._receipt_batcher is not None else None
+        if deadline is not None:
+            self._receipts_poll_handle = asyncio.get_event_loop().call_at(deadline, self._on_receipts_poll)
+
+    def _on_receipts_poll(self):
+        self._receipts_poll_handle = None
+        asyncio.ensure_future(self._poll_receipts())
+
+    async def _poll_receipts(self):
+        if self._receipt_batcher is None:
+            return
+
+        marks = self._receipt_batcher.poll(asyncio.get_event_loop().time())
+        if marks is not None:
+            await self._send_receipts(*marks)
+
+        self._schedule_receipts_poll()
+
+    '''
+    sends the marks that are still waiting for their interval, before the conversation is left
+    '''
+    async def _flush_receipts(self):
+        if self._receipts_poll_handle is not None:
+            self._receipts_poll_handle.cancel()
+            self._receipts_poll_handle = None
+
+        receipt_batcher = self._receipt_batcher
+        self._receipt_batcher = None
+
+        marks = receipt_batcher.flush() if receipt_batcher is not None else None
+        if marks is not None:
+            await self._send_receipts(*marks)
+
+    async def chat_receipt(self, content):
+        if content['user_id'] == self._chat_user_id:
+            return
+
+        await self.send_json({
+            'request_type': 'receipt',
+            'seq': self.get_next_seq(),
+            'payload': {
+                'user_id': content['user_id'],
+                'delivered_up_to': content['delivered_up_to'],
+                'seen_up_to': content['seen_up_to']
+            }
+        })
+
     async def process__default(self, content):
         await self.send_error_message(
             error_code=ErrorEnum.UNIMPLEMENTED,
@@ -437,15 +896,15 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
     async def join_lobby(self):
         await self.channel_layer.send(
             'conversation-manager-task',
-            {'type': 'request_lobby_attendees_list', 'channel_name': self.channel_name}
+            {'type': 'request_lobby_attendees_list', 'channel_name': self.channel_name, 'user_id': self._chat_user_id}
         )
 
     async def response_lobby_attendees_list(self, content):
         attendees = json.loads(content['attendees'])
         # moving to lobby until response is given
-        await self._move_to_lobby(attendees)
+        await self._move_to_lobby(attendees, content['lobby_room_id'])
 
-    async def _move_to_lobby(self, attendees):
+    async def _move_to_lobby(self, attendees, lobby_room_id):
         connect_message = {
             'request_type': 'join',
             # TODO: this is a bug: using one chat sequence number to other.
@@ -455,14 +914,30 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                 'name': self._chat_user_name
             }
         }
-        await self.update_conversation_id(ConversationUserDictionary.LOBBY_CONVERSATION_ID)
-        await self.send_receive_match(ConversationUserDictionary.LOBBY_CONVERSATION_ID, attendees)
+        await self.update_conversation_id(ConversationUserDictionary.LOBBY_CONVERSATION_ID, lobby_room_id)
+        await self.send_receive_match(ConversationUserDictionary.LOBBY_CONVERSATION_ID, attendees, lobby_room_id)
         await self.send_to_group(connect_message)
 
     async def send_json(self, content, close=False):
         self.validate_content(content)
+
+        if self._is_inbox_lagging(content['request_type']):
+            metrics.increment('lagging_inbox.frames_dropped')
+            return
+
         return await super().send_json(content, close)
 
+    '''
+    a consumer with many unhandled channel messages is behind on everything it relays, so its frames that the next
+    one supersedes are skipped. this is the lag of the consumer, the server does not tell whether the client reads
+    '''
+    def _is_inbox_lagging(self, request_type):
+        is_droppable = request_type in ChatConsumer.DROPPABLE_REQUEST_TYPES or (
+            request_type in ChatConsumer.DROPPABLE_LOBBY_REQUEST_TYPES and
+            self._conversation_id == ConversationUserDictionary.LOBBY_CONVERSATION_ID
+        )
+        return is_droppable and get_inbox_depth(self.channel_layer, self.channel_name) > settings.LAGGING_INBOX_MAX_MESSAGES
+
     async def send_error_message(self, error_code=ErrorEnum.OK, error_message='', response_to=None):
         content = {
             'request_type': 'error',
@@ -478,7 +953,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
         await self.send_json(content)
 
-    async def send_receive_match(self, conversation_id, attendees):
+    async def send_receive_match(self, conversation_id, attendees, room_id=None):
         content = {
             'request_type': 'receive_match',
             'seq': self.get_next_seq(),
@@ -488,6 +963,9 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             }
         }
 
+        if room_id is not None:
+            content['payload']['room_id'] = room_id
+
         await self.send_json(content)
 
     async def send_leave_message(self):
@@ -1,10 +1,17 @@
 class ConversationUserDictionary:
     LOBBY_CONVERSATION_ID = 1
+    DEFAULT_LOBBY_ROOM_MAX_SIZE = 50
 
-    def __init__(self):
+    def __init__(self, lobby_room_max_size=DEFAULT_LOBBY_ROOM_MAX_SIZE):
         self._users_to_conversations_dict = {}
         self._conversations_to_user_dict = {ConversationUserDictionary.LOBBY_CONVERSATION_ID: set([])}
 
+        # the lobby is split into bounded rooms, each one is broadcasted separately
+        self._lobby_room_max_size = lobby_room_max_size
+        self._users_to_lobby_rooms_dict = {}
+        self._lobby_rooms_to_users_dict = {}
+        self._next_lobby_room_id = 1
+
     def _remove_from_both_dicts(self, user_id, conversation_id, is_safe):
         if is_safe:
             self._conversations_to_user_dict[conversation_id].discard(user_id)
@@ -13,6 +20,9 @@ class ConversationUserDictionary:
             self._conversations_to_user_dict[conversation_id].remove(user_id)
             del self._users_to_conversations_dict[user_id]
 
+        if conversation_id == ConversationUserDictionary.LOBBY_CONVERSATION_ID:
+            self._remove_from_lobby_room(user_id)
+
     '''
     return conversation_id if conversation was closed due to this operation, None otherwise
     '''
@@ -32,14 +42,24 @@ class ConversationUserDictionary:
 
         del self._conversations_to_user_dict[conversation_id]
 
-    def add_user_to_conversation(self, user_id, conversation_id):
+    def add_user_to_conversation(self, user_id, conversation_id, lobby_room_id=None):
         if conversation_id not in self._conversations_to_user_dict:
             self._conversations_to_user_dict[conversation_id] = set([])
 
         self._conversations_to_user_dict[conversation_id].add(user_id)
         self._users_to_conversations_dict[user_id] = conversation_id
 
+        if conversation_id == ConversationUserDictionary.LOBBY_CONVERSATION_ID:
+            if lobby_room_id is None:
+                self.assign_lobby_room(user_id)
+            else:
+                self._add_to_lobby_room(user_id, lobby_room_id)
+        else:
+            # dropping any lobby room reserved for the user
+            self._remove_from_lobby_room(user_id)
+
     def user_disconnect(self, user_id):
+        self._remove_from_lobby_room(user_id)
         if user_id in self._users_to_conversations_dict:
             return self.remove_user_from_conversation(user_id, self._users_to_conversations_dict[user_id])
 
@@ -47,12 +67,15 @@ class ConversationUserDictionary:
         for user in self._conversations_to_user_dict[conversation_id].copy():
             self.remove_user_from_conversation(user, conversation_id)
 
-    def leave_any_previous_conversations_and_join(self, user_id, conversation_id):
+    def leave_any_previous_conversations_and_join(self, user_id, conversation_id, lobby_room_id=None):
         closed_conversation_id = None
         if user_id in self._users_to_conversations_dict:
+            if self._users_to_conversations_dict[user_id] == conversation_id:
+                return None
+
             closed_conversation_id = self.remove_user_from_conversation(user_id, self._users_to_conversations_dict[user_id])
 
-        self.add_user_to_conversation(user_id, conversation_id)
+        self.add_user_to_conversation(user_id, conversation_id, lobby_room_id)
         return closed_conversation_id
 
     def get_conversation_attendees(self, conversation_id):
@@ -61,3 +84,56 @@ class ConversationUserDictionary:
     def get_user_conversation(self, user_id):
         if user_id in self._users_to_conversations_dict:
             return self._users_to_conversations_dict[user_id]
+
+    '''
+    places the user in the least full lobby room (opening a new room when all are full) and returns its id
+    '''
+    def assign_lobby_room(self, user_id):
+        if user_id in self._users_to_lobby_rooms_dict:
+            return self._users_to_lobby_rooms_dict[user_id]
+
+        lobby_room_id = None
+        if len(self._lobby_rooms_to_users_dict) > 0:
+            lobby_room_id = min(
+                self._lobby_rooms_to_users_dict,
+                key=lambda room_id: len(self._lobby_rooms_to_users_dict[room_id])
+            )
+            if len(self._lobby_rooms_to_users_dict[lobby_room_id]) >= self._lobby_room_max_size:
+                lobby_room_id = None
+
+        if lobby_room_id is None:
+            lobby_room_id = self._next_lobby_room_id
+
+        self._add_to_lobby_room(user_id, lobby_room_id)
+        return lobby_room_id
+
+    def _add_to_lobby_room(self, user_id, lobby_room_id):
+        previous_lobby_room_id = self._users_to_lobby_rooms_dict.get(user_id)
+        if previous_lobby_room_id == lobby_room_id:
+            return
+
+        if previous_lobby_room_id is not None:
+            self._remove_from_lobby_room(user_id)
+
+        if lobby_room_id not in self._lobby_rooms_to_users_dict:
+            self._lobby_rooms_to_users_dict[lobby_room_id] = set([])
+            self._next_lobby_room_id = max(self._next_lobby_room_id, lobby_room_id + 1)
+
+        self._lobby_rooms_to_users_dict[lobby_room_id].add(user_id)
+        self._users_to_lobby_rooms_dict[user_id] = lobby_room_id
+
+    def _remove_from_lobby_room(self, user_id):
+        lobby_room_id = self._users_to_lobby_rooms_dict.pop(user_id, None)
+        if lobby_room_id is None:
+            return
+
+        lobby_room_attendees = self._lobby_rooms_to_users_dict[lobby_room_id]
+        lobby_room_attendees.discard(user_id)
+        if len(lobby_room_attendees) == 0:
+            del self._lobby_rooms_to_users_dict[lobby_room_id]
+
+    def get_lobby_room_attendees(self, lobby_room_id):
+        return self._lobby_rooms_to_users_dict.get(lobby_room_id, set([]))
+
+    def get_user_lobby_room(self, user_id):
+        return self._users_to_lobby_rooms_dict.get(user_id)
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import random
+import signal
+import weakref
+
+logger = logging.getLogger(__name__)
+
+
+def get_drain_schedule(connections_count, waves, duration_seconds, min_backoff_seconds, max_backoff_seconds):
+    '''
+    returns a (close delay, reconnect backoff) pair for every connection, the waves are spread evenly over the duration
+    '''
+    waves = max(1, min(waves, connections_count))
+    wave_interval_seconds = duration_seconds / waves
+    return [
+        (
+            (index % waves) * wave_interval_seconds,
+            random.uniform(min_backoff_seconds, max_backoff_seconds)
+        )
+        for index in range(connections_count)
+    ]
+
+
+class DrainController:
+    '''
+    tracks the connections of the process and, once draining, closes them in staggered waves with a reconnect hint
+    '''
+    def __init__(self, waves, duration_seconds, min_backoff_seconds, max_backoff_seconds):
+        self._waves = waves
+        self._duration_seconds = duration_seconds
+        self._min_backoff_seconds = min_backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+        self._consumers = weakref.WeakSet()
+        self._is_draining = False
+        self._is_signal_handler_installed = False
+
+    @property
+    def is_draining(self):
+        return self._is_draining
+
+    def register(self, consumer):
+        self._consumers.add(consumer)
+
+    def unregister(self, consumer):
+        self._consumers.discard(consumer)
+
+    def install_signal_handler(self):
+        if self._is_signal_handler_installed:
+            return
+
+        self._is_signal_handler_installed = True
+        previous_handler = signal.getsignal(signal.SIGTERM)
+        try:
+            asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, self._on_sigterm, previous_handler)
+        except (NotImplementedError, RuntimeError, ValueError):
+            logger.warning('could not install the drain signal handler, connections will not be drained')
+
+    def _on_sigterm(self, previous_handler):
+        asyncio.ensure_future(self._drain_and_terminate(previous_handler))
+
+    async def _drain_and_terminate(self, previous_handler):
+        await self.drain()
+
+        # handing the signal back to the server so it shuts down as usual
+        asyncio.get_event_loop().remove_signal_handler(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, previous_handler if previous_handler is not None else signal.SIG_DFL)
+        signal.raise_signal(signal.SIGTERM)
+
+    async def drain(self):
+        if self._is_draining:
+            return
+
+        self._is_draining = True
+        consumers = list(self._consumers)
+        random.shuffle(consumers)
+        logger.warning('draining %s connections', len(consumers))
+
+        schedule = get_drain_schedule(
+            len(consumers),
+            self._waves,
+            self._duration_seconds,
+            self._min_backoff_seconds,
+            self._max_backoff_seconds
+        )
+
+        elapsed_seconds = 0
+        closing_tasks = []
+        for consumer, (close_delay_seconds, backoff_seconds) in sorted(
+                zip(consumers, schedule),
+                key=lambda consumer_schedule: consumer_schedule[1][0]
+        ):
+            if close_delay_seconds > elapsed_seconds:
+                await asyncio.sleep(close_delay_seconds - elapsed_seconds)
+                elapsed_seconds = close_delay_seconds
+
+            # the connection might have been closed while waiting for its wave
+            if consumer in self._consumers:
+                closing_tasks.append(asyncio.ensure_future(consumer.send_reconnect_and_close(backoff_seconds)))
+
+        if len(closing_tasks) > 0:
+            await asyncio.wait(closing_tasks)
@@ -12,6 +12,16 @@ class ErrorEnum(enum.Enum):
     AUTH_FAIL_USER_INACTIVE = enum.auto()
     AUTH_FAIL_INVALID_TOKEN = enum.auto()
     INACTIVENESS_TIMEOUT = enum.auto()
+    RATE_LIMITED = enum.auto()
+    SERVER_BUSY = enum.auto()
+    MESSAGE_REJECTED = enum.auto()
 
     # KEEP LAST
-    UNKNOWN_ERROR = enum.auto()
\ No newline at end of file
+    UNKNOWN_ERROR = enum.auto()
+
+
+class AuthorizationEnum(enum.Enum):
+    GRANTED = 'granted'
+    DENIED = 'denied'
+    # the conversation manager does not know the user (e.g. after a restart)
+    UNKNOWN = 'unknown'
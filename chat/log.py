@@ -0,0 +1,112 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from django.conf import settings
+from . import metrics
+
+# passed with extra={...} on the hot paths, written as json fields when present
+CONTEXT_FIELDS = ('event', 'user_id', 'partner_id', 'conversation_id', 'channel_name', 'metrics')
+
+logger = logging.getLogger(__name__)
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    keeps only a share of the records of high volume events, given as {event: share between 0 and 1}.
+    errors and records without a sampled event always pass
+    '''
+    def __init__(self, sample_rates):
+        super().__init__()
+        self._sample_rates = sample_rates
+
+    def filter(self, record):
+        sample_rate = self._sample_rates.get(getattr(record, 'event', None))
+        if sample_rate is None or record.levelno >= logging.ERROR:
+            return True
+
+        return random.random() < sample_rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    hands the records to the listener thread, which formats and writes them. a full queue drops records instead of
+    blocking the event loop or the worker threads
+    '''
+    def prepare(self, record):
+        # the arguments may change once the call returns, so only the message is resolved here
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.increment('log.dropped')
+
+
+def report_metrics():
+    logger.info('metrics snapshot', extra={'event': 'metrics.snapshot', 'metrics': metrics.get_snapshot()})
+
+
+def _report_metrics_forever(interval_seconds):
+    while True:
+        time.sleep(interval_seconds)
+        report_metrics()
+
+
+def configure():
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue = queue.Queue(settings.CHAT_LOG_QUEUE_SIZE)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(settings.CHAT_LOG_SAMPLE_RATES))
+
+    chat_logger = logging.getLogger('chat')
+    chat_logger.handlers = [queue_handler]
+    chat_logger.setLevel(settings.CHAT_LOG_LEVEL)
+    chat_logger.propagate = False
+
+    # every process logs its own counters, the web and worker processes do not share them
+    if settings.METRICS_LOG_INTERVAL_SECONDS > 0:
+        threading.Thread(
+            target=_report_metrics_forever,
+            args=(settings.METRICS_LOG_INTERVAL_SECONDS,),
+            name='metrics-reporter',
+            daemon=True
+        ).start()
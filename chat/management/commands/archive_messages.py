@@ -0,0 +1,29 @@
+import datetime
+import time
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat.models import ConversationArchive
+
+
+class Command(BaseCommand):
+    help = 'Moves the messages of conversations closed for more than the given days into the archive table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30)
+        parser.add_argument('--batch-size', type=int, default=1000, help='messages archived per transaction')
+        parser.add_argument('--sleep-seconds', type=float, default=0.5, help='pause between batches')
+
+    def handle(self, *args, **options):
+        closed_before = timezone.now() - datetime.timedelta(days=options['days'])
+        archived_count = 0
+
+        while True:
+            batch_count = ConversationArchive.archive_closed_conversations(closed_before, options['batch_size'])
+            if batch_count == 0:
+                break
+
+            archived_count += batch_count
+            self.stdout.write(f'archived {archived_count} messages')
+            time.sleep(options['sleep_seconds'])
+
+        self.stdout.write(f'done, archived {archived_count} messages')
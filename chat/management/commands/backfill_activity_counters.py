@@ -0,0 +1,85 @@
+import collections
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max
+from chat.models import ChatUser, Conversation, ConversationArchive, ConversationArchiveChunk, Message
+
+
+class Command(BaseCommand):
+    help = 'Recalculates the conversation and chat user activity counters from the stored messages, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # archived messages only keep a per conversation count, per author counts need the archives themselves
+        archived_author_counts = collections.Counter()
+        for chunk in self._iterate_in_batches(ConversationArchiveChunk.objects.all(), 'id', batch_size):
+            archived_author_counts.update(message['author_id'] for message in chunk.get_messages())
+
+        conversations_count = 0
+        for conversations in self._iterate_batches(Conversation.objects.only('id', 'last_message_time'), 'id', batch_size):
+            conversation_ids = [conversation.id for conversation in conversations]
+            hot_counters = self._get_hot_counters('conversation_id', conversation_ids)
+            archived_counts = dict(
+                ConversationArchive.objects.filter(conversation_id__in=conversation_ids).values_list('conversation_id', 'messages_count')
+            )
+
+            for conversation in conversations:
+                message_count, last_message_time = hot_counters.get(conversation.id, (0, conversation.last_message_time))
+                conversation.message_count = message_count + archived_counts.get(conversation.id, 0)
+                conversation.last_message_time = last_message_time
+
+            with transaction.atomic():
+                Conversation.objects.bulk_update(conversations, ['message_count', 'last_message_time'])
+
+            conversations_count += len(conversations)
+            self.stdout.write(f'updated {conversations_count} conversations')
+
+        chat_users_count = 0
+        for chat_users in self._iterate_batches(ChatUser.objects.only('id', 'last_message_time'), 'id', batch_size):
+            hot_counters = self._get_hot_counters('author_id', [chat_user.id for chat_user in chat_users])
+
+            for chat_user in chat_users:
+                message_count, last_message_time = hot_counters.get(chat_user.id, (0, chat_user.last_message_time))
+                chat_user.message_count = message_count + archived_author_counts[chat_user.id]
+                chat_user.last_message_time = last_message_time
+
+            with transaction.atomic():
+                ChatUser.objects.bulk_update(chat_users, ['message_count', 'last_message_time'])
+
+            chat_users_count += len(chat_users)
+            self.stdout.write(f'updated {chat_users_count} chat users')
+
+    @staticmethod
+    def _get_hot_counters(field_name, ids):
+        return {
+            row[field_name]: (row['message_count'], row['last_message_time'])
+            for row in Message.objects.filter(**{f'{field_name}__in': ids}).order_by().values(field_name).annotate(
+                message_count=Count('id'),
+                last_message_time=Max('time')
+            )
+        }
+
+    @classmethod
+    def _iterate_in_batches(cls, queryset, key_name, batch_size):
+        for batch in cls._iterate_batches(queryset, key_name, batch_size):
+            yield from batch
+
+    @staticmethod
+    def _iterate_batches(queryset, key_name, batch_size):
+        # keyset pagination, every batch is a cheap index range scan
+        last_key = None
+        while True:
+            batch_queryset = queryset.order_by(key_name)
+            if last_key is not None:
+                batch_queryset = batch_queryset.filter(**{f'{key_name}__gt': last_key})
+
+            batch = list(batch_queryset[:batch_size])
+            if len(batch) == 0:
+                return
+
+            yield batch
+            last_key = getattr(batch[-1], key_name)
@@ -0,0 +1,78 @@
+import asyncio
+import statistics
+import time
+from asgiref.sync import async_to_sync
+from channels.consumer import SyncConsumer
+from channels.layers import InMemoryChannelLayer, channel_layers
+from channels.routing import ChannelNameRouter
+from channels.worker import Worker
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+ECHO_CHANNEL = 'bench-echo-task'
+
+
+class EchoTask(SyncConsumer):
+    '''
+    answers every message from the worker thread pool, the same hop the worker tasks make
+    '''
+    def echo(self, message):
+        async_to_sync(self.channel_layer.send)(message['reply_channel'], {'type': 'echo.reply'})
+
+
+class Command(BaseCommand):
+    help = 'Compares the round trip of a worker task event over the in-memory layer and over redis'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        topologies = {'single node (in-memory)': InMemoryChannelLayer()}
+        if settings.REDIS_URL:
+            from channels_redis.core import RedisChannelLayer
+            topologies['redis'] = RedisChannelLayer(hosts=[settings.REDIS_URL], prefix='bench-channel-latency')
+
+        for topology, channel_layer in topologies.items():
+            alias = f'bench-{topology}'
+            channel_layers.backends[alias] = channel_layer
+            try:
+                latencies = asyncio.get_event_loop().run_until_complete(
+                    self._measure(alias, channel_layer, options['events'])
+                )
+            finally:
+                del channel_layers.backends[alias]
+
+            if len(latencies) == 0:
+                raise CommandError('no events were measured')
+
+            latencies.sort()
+            self.stdout.write(
+                f'{topology}: '
+                f'p50 {statistics.median(latencies) * 1000:.2f}ms, '
+                f'p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f}ms'
+            )
+
+    @staticmethod
+    async def _measure(alias, channel_layer, events_count):
+        echo_task = type('EchoTask', (EchoTask,), {'channel_layer_alias': alias})
+        worker = Worker(
+            application=ChannelNameRouter({ECHO_CHANNEL: echo_task}),
+            channels=[ECHO_CHANNEL],
+            channel_layer=channel_layer
+        )
+        worker_future = asyncio.ensure_future(worker.handle())
+        reply_channel = await channel_layer.new_channel()
+
+        latencies = []
+        try:
+            for _ in range(events_count):
+                start = time.perf_counter()
+                await channel_layer.send(ECHO_CHANNEL, {'type': 'echo', 'reply_channel': reply_channel})
+                await channel_layer.receive(reply_channel)
+                latencies.append(time.perf_counter() - start)
+        finally:
+            worker_future.cancel()
+            for details in worker.application_instances.values():
+                details['future'].cancel()
+
+        return latencies
@@ -0,0 +1,110 @@
+import asyncio
+import gc
+import json
+import tracemalloc
+from channels.layers import InMemoryChannelLayer, channel_layers
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from chat.consumers import ChatConsumer
+
+BENCH_CHANNEL_LAYER_ALIAS = 'bench-idle-connections'
+TARGET_CONNECTIONS = 100000
+LOBBY_ROOM_SIZE = 50
+
+
+'''
+opens the connections through the websocket protocol and returns the bytes each one holds once it is authenticated,
+in the broadcast group and in a lobby room. the db and conversation manager replies are sent by this function, the
+communicator queues stand in for the ones the server keeps for every connection
+'''
+async def measure_idle_connections(connections_count):
+    # an in-memory layer, so the measurement covers the consumer and its receive loop without a redis client.
+    # the worker channels fill up with the disconnection messages when the connections are closed
+    channel_layer = InMemoryChannelLayer(capacity=4 * connections_count)
+    channel_layers.backends[BENCH_CHANNEL_LAYER_ALIAS] = channel_layer
+
+    def application(scope):
+        consumer = ChatConsumer(scope)
+        consumer.channel_layer_alias = BENCH_CHANNEL_LAYER_ALIAS
+        return consumer
+
+    communicators = []
+    tracemalloc.start()
+    try:
+        gc.collect()
+        memory_before, _ = tracemalloc.get_traced_memory()
+
+        for index in range(connections_count):
+            communicator = WebsocketCommunicator(application, '/chat')
+            communicators.append(communicator)
+            await open_idle_connection(communicator, channel_layer, index)
+
+        gc.collect()
+        memory_after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        del channel_layers.backends[BENCH_CHANNEL_LAYER_ALIAS]
+
+    return (memory_after - memory_before) / connections_count
+
+
+async def open_idle_connection(communicator, channel_layer, index):
+    is_connected, _ = await communicator.connect()
+    if not is_connected:
+        raise CommandError(f'connection {index} was not accepted')
+
+    await communicator.send_json_to({'request_type': 'authenticate', 'seq': 1, 'payload': {'access_token': 'token'}})
+    authenticate = await channel_layer.receive('db-operations-task')
+    await channel_layer.send(authenticate['channel_name'], {
+        'type': 'authenticate_response',
+        'error': {
+            'request_type': 'error',
+            'seq': 1,
+            'response_to': authenticate['seq'],
+            'payload': {'error_code': 0, 'error_message': ''}
+        },
+        'chat_user_id': index + 1,
+        'chat_user_name': f'user {index}'
+    })
+    await communicator.receive_json_from()
+
+    await communicator.send_json_to({'request_type': 'join_lobby', 'seq': 2, 'payload': {}})
+    await communicator.receive_json_from()
+    attendees_request = await channel_layer.receive('conversation-manager-task')
+    await channel_layer.send(attendees_request['channel_name'], {
+        'type': 'response_lobby_attendees_list',
+        'attendees': json.dumps({}),
+        'lobby_room_id': index // LOBBY_ROOM_SIZE + 1
+    })
+    await communicator.receive_json_from()
+
+    # the join_conversation and join broadcast the conversation manager would handle
+    for _ in range(2):
+        await channel_layer.receive('conversation-manager-task')
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures the memory held by idle ChatConsumer connections using tracemalloc, each one opened through the '
+        'websocket protocol, authenticated and joined to the lobby on an in-memory channel layer'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=10000)
+        parser.add_argument('--max-bytes-per-connection', type=int, default=24576)
+
+    def handle(self, *args, **options):
+        bytes_per_connection = asyncio.get_event_loop().run_until_complete(
+            measure_idle_connections(options['connections'])
+        )
+
+        self.stdout.write(
+            f'{bytes_per_connection:.0f} bytes per idle connection, '
+            f'{bytes_per_connection * TARGET_CONNECTIONS / 2 ** 20:.0f}MB for {TARGET_CONNECTIONS} connections'
+        )
+        if bytes_per_connection > options['max_bytes_per_connection']:
+            raise CommandError(f'over the budget of {options["max_bytes_per_connection"]} bytes per connection')
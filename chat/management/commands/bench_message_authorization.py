@@ -0,0 +1,61 @@
+import time
+import uuid
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chat.conversation_user_dictionary import ConversationUserDictionary
+from chat.models import ChatUser, Conversation, Message
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures the per-message cost of send_message with the db authorization check and with the in-memory roster. '
+        'The roster is checked by the conversation manager, the one worker every message passes through, so the '
+        'lookup adds no channel layer hop'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        messages_count = options['messages']
+
+        # everything created by the benchmark is rolled back at the end
+        with transaction.atomic():
+            run_id = uuid.uuid4().hex[:8]
+            chat_users = [
+                ChatUser.create_chat_user(User.objects.create(username=f'bench-{run_id}-{i}'), name=f'bench {i}')
+                for i in range(2)
+            ]
+            author_id = chat_users[0].id
+            conversation = Conversation.create_conversation([chat_user.id for chat_user in chat_users])
+
+            roster = ConversationUserDictionary()
+            roster.add_user_to_conversation(author_id, conversation.id)
+
+            db_seconds = self._measure(
+                messages_count,
+                lambda: Message.validate_message_creation(author_id, conversation.id),
+                author_id,
+                conversation.id
+            )
+            in_memory_seconds = self._measure(
+                messages_count,
+                lambda: roster.get_user_conversation(author_id) == conversation.id,
+                author_id,
+                conversation.id
+            )
+
+            transaction.set_rollback(True)
+
+        for title, seconds in (('db check', db_seconds), ('in-memory roster', in_memory_seconds)):
+            self.stdout.write(f'{title}: {seconds / messages_count * 1e6:.1f}us per message ({messages_count} messages)')
+
+    @staticmethod
+    def _measure(messages_count, authorize, author_id, conversation_id):
+        start = time.perf_counter()
+        for i in range(messages_count):
+            authorize()
+            Message.create_message(author_id=author_id, conversation_id=conversation_id, text=f'message {i}')
+
+        return time.perf_counter() - start
@@ -0,0 +1,50 @@
+import random
+import re
+import time
+from django.core.management.base import BaseCommand
+from chat.phrase_filter import AhoCorasickAutomaton
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyzאבגדהוזחטיכלמנסעפצקרשת '
+
+
+class Command(BaseCommand):
+    help = 'Compares the banned-phrase automaton with a naive per-phrase scan for growing phrase lists'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--message-length', type=int, default=200)
+        parser.add_argument('--phrase-counts', type=int, nargs='+', default=[10, 100, 1000, 10000])
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        messages = [
+            ''.join(rng.choice(ALPHABET) for _ in range(options['message_length']))
+            for _ in range(options['messages'])
+        ]
+
+        for phrase_count in options['phrase_counts']:
+            phrases = [
+                ''.join(rng.choice(ALPHABET[:-1]) for _ in range(rng.randint(4, 12)))
+                for _ in range(phrase_count)
+            ]
+
+            automaton = AhoCorasickAutomaton(phrases)
+            start = time.perf_counter()
+            automaton_matches = sum(next(automaton.find_spans(message), None) is not None for message in messages)
+            automaton_seconds = time.perf_counter() - start
+
+            # the automaton only matches whole words, as \b does
+            patterns = [re.compile(rf'\b{re.escape(phrase)}\b', re.IGNORECASE) for phrase in phrases]
+            start = time.perf_counter()
+            naive_matches = sum(
+                any(pattern.search(message) is not None for pattern in patterns)
+                for message in messages
+            )
+            naive_seconds = time.perf_counter() - start
+
+            self.stdout.write(
+                f'{phrase_count} phrases: '
+                f'automaton {automaton_seconds / len(messages) * 1e6:.1f}us/message, '
+                f'naive {naive_seconds / len(messages) * 1e6:.1f}us/message '
+                f'({automaton_matches}/{naive_matches} messages matched)'
+            )
@@ -0,0 +1,63 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# runs in a fresh interpreter, loads what the process type loads before serving its first event
+STARTUP_SCRIPT = '''
+import json
+import os
+import resource
+import sys
+import time
+
+start = time.perf_counter()
+import django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'co_buddies.settings')
+django.setup()
+import co_buddies.routing
+
+if sys.argv[1] == 'worker':
+    # loaded lazily by PushNotificationsTask on its first notification
+    import firebase_admin.messaging
+
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'firebase_loaded': 'firebase_admin' in sys.modules,
+}))
+'''
+
+
+class Command(BaseCommand):
+    help = 'Reports the import time and memory footprint of the web and worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5)
+
+    def handle(self, *args, **options):
+        for process_type in ('web', 'worker'):
+            results = [self._measure(process_type) for _ in range(options['runs'])]
+            self.stdout.write(
+                f'{process_type}: '
+                f'{statistics.median(result["seconds"] for result in results) * 1000:.0f}ms import time, '
+                f'{statistics.median(result["max_rss_kb"] for result in results) / 1024:.1f}MB rss, '
+                f'firebase loaded: {results[0]["firebase_loaded"]}'
+            )
+
+    @staticmethod
+    def _measure(process_type):
+        completed_process = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT, process_type],
+            cwd=settings.BASE_DIR,
+            env=os.environ.copy(),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        if completed_process.returncode != 0:
+            raise CommandError(completed_process.stderr.decode())
+
+        return json.loads(completed_process.stdout.decode().strip().splitlines()[-1])
@@ -0,0 +1,53 @@
+import collections
+import random
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.drain import get_drain_schedule
+
+
+class Command(BaseCommand):
+    '''
+    a capacity model, not a load test: no connection is opened. the reconnect times come from get_drain_schedule and
+    from uniformly spread client retries, so the result is only as good as the assumption that every client follows them.
+    the drain itself is only exercised with a handful of real connections, by DrainControllerTests
+    '''
+    help = (
+        'Models a deploy and reports the peak authenticate rate with and without draining the connections. '
+        'No connection is opened, the drain is not validated under load'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=10000)
+        parser.add_argument(
+            '--client-retry-seconds',
+            type=float,
+            default=1,
+            help='reconnect delay of a client that lost its socket without a hint'
+        )
+        parser.add_argument('--waves', type=int, default=settings.DRAIN_WAVES)
+        parser.add_argument('--duration-seconds', type=float, default=settings.DRAIN_DURATION_SECONDS)
+        parser.add_argument('--min-backoff-seconds', type=float, default=settings.RECONNECT_MIN_BACKOFF_SECONDS)
+        parser.add_argument('--max-backoff-seconds', type=float, default=settings.RECONNECT_MAX_BACKOFF_SECONDS)
+
+    def handle(self, *args, **options):
+        connections_count = options['connections']
+
+        # every reconnecting client sends authenticate followed by join_lobby
+        without_drain = [random.uniform(0, options['client_retry_seconds']) for _ in range(connections_count)]
+        with_drain = [
+            close_delay_seconds + backoff_seconds
+            for close_delay_seconds, backoff_seconds in get_drain_schedule(
+                connections_count,
+                options['waves'],
+                options['duration_seconds'],
+                options['min_backoff_seconds'],
+                options['max_backoff_seconds']
+            )
+        ]
+
+        for title, reconnect_times in (('without drain', without_drain), ('with drain', with_drain)):
+            authentications_per_second = collections.Counter(int(reconnect_time) for reconnect_time in reconnect_times)
+            self.stdout.write(
+                f'{title}: peak {max(authentications_per_second.values())} authentications/s, '
+                f'all {connections_count} clients back after {max(reconnect_times):.1f}s'
+            )
@@ -0,0 +1,80 @@
+import random
+from django.core.management.base import BaseCommand
+from chat.consumers import ChatConsumer
+from chat.typing import TypingDebouncer
+
+
+class Command(BaseCommand):
+    '''
+    a capacity model, not a load test: no connection is opened. random keystroke bursts are fed to a TypingDebouncer
+    on a virtual clock, and the channel layer messages are counted from the hops each event would make
+    '''
+    help = (
+        'Models two users typing in a conversation and estimates the channel layer traffic typing indicators add. '
+        'No consumer or channel layer is run, the traffic is not measured'
+    )
+
+    ATTENDEES_COUNT = 2
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=float, default=10)
+        parser.add_argument('--keystrokes-per-second', type=float, default=5)
+
+    def handle(self, *args, **options):
+        duration_seconds = options['minutes'] * 60
+        keystrokes_count = 0
+        state_changes_count = 0
+
+        for _ in range(Command.ATTENDEES_COUNT):
+            keystroke_times = self._generate_keystroke_times(duration_seconds, options['keystrokes_per_second'])
+            keystrokes_count += len(keystroke_times)
+            state_changes_count += self._count_state_changes(keystroke_times)
+
+        # relaying every keystroke: consumer -> conversation-manager-task -> group_send -> a delivery per attendee
+        naive_messages = keystrokes_count * (2 + Command.ATTENDEES_COUNT)
+        # debounced state changes: group_send -> a delivery per attendee
+        debounced_messages = state_changes_count * (1 + Command.ATTENDEES_COUNT)
+
+        minutes = options['minutes']
+        self.stdout.write(f'keystrokes: {keystrokes_count / minutes:.0f}/min per conversation')
+        self.stdout.write(f'relaying every keystroke, modelled: {naive_messages / minutes:.0f} channel layer messages/min per conversation')
+        self.stdout.write(f'debounced, modelled: {debounced_messages / minutes:.0f} channel layer messages/min per conversation')
+        self.stdout.write('the messages are counted from the hops each event would make, not measured on a channel layer')
+
+    @staticmethod
+    def _generate_keystroke_times(duration_seconds, keystrokes_per_second):
+        keystroke_times = []
+        now = 0
+        while now < duration_seconds:
+            # typing a message, then reading the partner's answer
+            burst_end = now + random.uniform(2, 15)
+            while now < burst_end:
+                keystroke_times.append(now)
+                now += random.expovariate(keystrokes_per_second)
+
+            now += random.uniform(2, 30)
+
+        return keystroke_times
+
+    @staticmethod
+    def _count_state_changes(keystroke_times):
+        debouncer = TypingDebouncer(ChatConsumer.TYPING_INTERVAL_SECONDS, ChatConsumer.TYPING_IDLE_TIMEOUT_SECONDS)
+        state_changes_count = 0
+        keystroke_index = 0
+
+        while True:
+            deadline = debouncer.get_next_deadline()
+            next_keystroke_time = keystroke_times[keystroke_index] if keystroke_index < len(keystroke_times) else None
+            if next_keystroke_time is None and deadline is None:
+                break
+
+            if next_keystroke_time is not None and (deadline is None or next_keystroke_time <= deadline):
+                state = debouncer.on_typing(True, next_keystroke_time)
+                keystroke_index += 1
+            else:
+                state = debouncer.poll(deadline)
+
+            if state is not None:
+                state_changes_count += 1
+
+        return state_changes_count
@@ -0,0 +1,59 @@
+import secrets
+import time
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+from chat.models import ChatUser
+
+
+class Command(BaseCommand):
+    help = 'Bulk creates users with access tokens and chat users for load testing and writes the tokens to a file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100000)
+        # SQLite allows up to 999 variables per query
+        parser.add_argument('--chunk-size', type=int, default=900)
+        parser.add_argument('--prefix', default='loadtest')
+        parser.add_argument('--password', default='loadtest-password')
+        parser.add_argument('--output', default='access_tokens.csv')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        chunk_size = options['chunk_size']
+        prefix = options['prefix']
+
+        # hashing is the expensive part of registration, every provisioned user shares a single hash
+        password_hash = make_password(options['password'])
+
+        start = time.perf_counter()
+        with open(options['output'], 'w') as output_file:
+            for chunk_start in range(0, count, chunk_size):
+                usernames = [f'{prefix}-{index}' for index in range(chunk_start, min(chunk_start + chunk_size, count))]
+                access_tokens = self._create_users(usernames, password_hash)
+                output_file.writelines(f'{username},{access_token}\n' for username, access_token in access_tokens)
+
+        self.stdout.write(
+            f'created {count} users in {time.perf_counter() - start:.1f}s, access tokens written to {options["output"]}'
+        )
+
+    @staticmethod
+    def _create_users(usernames, password_hash):
+        with transaction.atomic():
+            User.objects.bulk_create([User(username=username, password=password_hash) for username in usernames])
+
+            # bulk_create does not return primary keys on SQLite
+            users_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+            access_tokens = [(username, secrets.token_hex(20)) for username in usernames]
+
+            Token.objects.bulk_create([
+                Token(key=access_token, user_id=users_ids[username])
+                for username, access_token in access_tokens
+            ])
+            ChatUser.objects.bulk_create([
+                ChatUser(user_id=users_ids[username], name=username)
+                for username in usernames
+            ])
+
+        return access_tokens
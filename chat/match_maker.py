@@ -1,20 +1,36 @@
+import datetime
+import logging
 import random
 import threading
 import time
+from django.conf import settings
+from django.utils import timezone
 from chat.models import Conversation, ChatUser
+from chat.matchmaking_pool import InMemoryMatchmakingPool
+from chat.recent_partners import RecentPartners
+
+logger = logging.getLogger(__name__)
 
 
 class MatchMaker:
-    def __init__(self, matchcreated_callback):
+    # users claimed from the pool in a single matching round
+    CLAIM_LIMIT = 1000
+    # candidates checked for a partner that was not met recently, before giving up on a user for this round
+    PAIRING_SCAN_LIMIT = 20
+    # conversations older than that are not considered when loading the recent partners of a user
+    RECENT_PARTNERS_HISTORY_DAYS = 30
+
+    def __init__(self, matchcreated_callback, pool=None):
         self._matchcreated_callback = matchcreated_callback
-        self._pool = {}
+        self._pool = pool if pool is not None else InMemoryMatchmakingPool()
+        self._recent_partners = RecentPartners(settings.RECENT_PARTNERS_PER_USER, settings.RECENT_PARTNERS_MAX_ENTRIES)
         self._should_matchmake = False
         self._seek_matches_thread = None
         self.start_matchmaking()
 
     def start_matchmaking(self):
         self._should_matchmake = True
-        self._seek_matches_thread = threading.Thread(target=self.seek_matches)
+        self._seek_matches_thread = threading.Thread(target=self.seek_matches, name='matchmaker')
         self._seek_matches_thread.daemon = True
         self._seek_matches_thread.start()
 
@@ -24,22 +40,14 @@ class MatchMaker:
             self._seek_matches_thread.join()
 
     def add_to_pool(self, user_id, channel_name):
-        self._pool[user_id] = channel_name
+        self._pool.add(user_id, channel_name)
         self.perform_update()
 
-    def _exists_in_pool(self, user_id):
-        return user_id in self._pool
-
     def get_user_channel(self, user_id):
-        if not self._exists_in_pool(user_id):
-            return None
-
-        return self._pool[user_id]
+        return self._pool.get_channel(user_id)
 
     def remove_from_pool_if_exist(self, user_id):
-        if user_id in self._pool:
-            del self._pool[user_id]
-
+        self._pool.remove(user_id)
         self.perform_update()
 
     def perform_update(self):
@@ -59,21 +67,73 @@ class MatchMaker:
                 if minutes_left > 1:
                     continue
 
-                pool_items = list(self._pool.keys())
-                while len(pool_items) > 0:
-                    random_1 = random.choice(pool_items)
-                    pool_items.remove(random_1)
-
-                    if len(pool_items) == 0:
-                        print(f'{random_1} alone :-(')
-                        break
-
-                    random_2 = random.choice(pool_items)
-                    pool_items.remove(random_2)
-                    self._create_match(random_1, random_2)
-
-    def _create_match(self, user_id1, user_id2):
-        print(f'{user_id1} with {user_id2}')
+                self.match_waiting_users()
+
+    def match_waiting_users(self):
+        # claimed users belong to this matchmaker only, other matchmakers can not pair them meanwhile
+        pool_entries = self._pool.claim(MatchMaker.CLAIM_LIMIT)
+        random.shuffle(pool_entries)
+        pairs = []
+        unpaired_entries = pool_entries
+
+        try:
+            self._load_recent_partners([user_id for user_id, _, _ in pool_entries])
+            pairs, unpaired_entries = self._pair_entries(list(pool_entries), time.time())
+            while len(pairs) > 0:
+                entry1, entry2 = pairs.pop()
+                try:
+                    self._create_match(entry1, entry2)
+                except Exception:
+                    self._pool.release([entry1, entry2])
+                    raise
+
+        finally:
+            for user_id, _, _ in unpaired_entries:
+                logger.info('no partner found', extra={'event': 'matchmaking.unpaired', 'user_id': user_id})
+
+            self._pool.release(unpaired_entries + [entry for pair in pairs for entry in pair])
+
+    def _load_recent_partners(self, user_ids):
+        # a single query for every claimed user on every round, matches made by other matchmakers are in the db
+        if len(user_ids) > 0:
+            self._recent_partners.load(Conversation.get_recent_partners(
+                user_ids,
+                timezone.now() - datetime.timedelta(days=MatchMaker.RECENT_PARTNERS_HISTORY_DAYS),
+                settings.RECENT_PARTNERS_PER_USER
+            ))
+
+    '''
+    pairs every user with one of the next candidates that they have not met recently, returns the pairs and the
+    users left without a partner
+    '''
+    def _pair_entries(self, pool_entries, now):
+        pairs = []
+        unpaired_entries = []
+
+        while len(pool_entries) > 0:
+            entry = pool_entries.pop()
+            last_candidate_index = max(len(pool_entries) - 1 - MatchMaker.PAIRING_SCAN_LIMIT, -1)
+            for candidate_index in range(len(pool_entries) - 1, last_candidate_index, -1):
+                if self._can_pair(entry, pool_entries[candidate_index], now):
+                    pairs.append((entry, pool_entries.pop(candidate_index)))
+                    break
+            else:
+                unpaired_entries.append(entry)
+
+        return pairs, unpaired_entries
+
+    def _can_pair(self, pool_entry1, pool_entry2, now):
+        user_id1, _, enqueue_time1 = pool_entry1
+        user_id2, _, enqueue_time2 = pool_entry2
+        if not self._recent_partners.have_met(user_id1, user_id2):
+            return True
+
+        # no fresh partner showed up for both of them for a while, meeting again is better than waiting
+        return now - max(enqueue_time1, enqueue_time2) >= settings.REPEAT_MATCH_WAIT_SECONDS
+
+    def _create_match(self, pool_entry1, pool_entry2):
+        user_id1, channel_name1, _ = pool_entry1
+        user_id2, channel_name2, _ = pool_entry2
         attendees_user_ids = [user_id1, user_id2]
 
         # calculating attendees dict
@@ -81,12 +141,19 @@ class MatchMaker:
         attendees = {chat_user.id: chat_user.name for chat_user in chat_users}
 
         conversation = Conversation.create_conversation(attendees_user_ids)
+        self._recent_partners.add_match(user_id1, user_id2)
+        logger.info(
+            'match created',
+            extra={
+                'event': 'matchmaking.match_created',
+                'user_id': user_id1,
+                'partner_id': user_id2,
+                'conversation_id': conversation.id
+            }
+        )
 
         if self._matchcreated_callback is not None:
-            self._matchcreated_callback(self._pool[user_id1], self._pool[user_id2], conversation.id, attendees)
-
-        del self._pool[user_id1]
-        del self._pool[user_id2]
+            self._matchcreated_callback(channel_name1, channel_name2, conversation.id, attendees)
 
 
 # def main():
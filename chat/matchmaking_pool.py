@@ -0,0 +1,127 @@
+import threading
+import time
+from django.conf import settings
+
+
+class InMemoryMatchmakingPool:
+    '''
+    keeps the waiting users inside the process, good for a single matchmaking worker and for tests
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        # user id -> (channel name, enqueue time)
+        self._entries = {}
+
+    def add(self, user_id, channel_name, enqueue_time=None):
+        with self._lock:
+            self._entries[user_id] = (channel_name, enqueue_time if enqueue_time is not None else time.time())
+
+    def remove(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def get_channel(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+
+        return entry[0] if entry is not None else None
+
+    '''
+    removes up to limit of the longest waiting users and returns them as (user_id, channel_name, enqueue_time)
+    '''
+    def claim(self, limit):
+        with self._lock:
+            claimed_user_ids = sorted(self._entries, key=lambda user_id: self._entries[user_id][1])[:limit]
+            return [
+                (user_id,) + self._entries.pop(user_id)
+                for user_id in claimed_user_ids
+            ]
+
+    '''
+    puts claimed users that were not matched back, unless they have requested a match again meanwhile
+    '''
+    def release(self, entries):
+        with self._lock:
+            for user_id, channel_name, enqueue_time in entries:
+                self._entries.setdefault(user_id, (channel_name, enqueue_time))
+
+
+class RedisMatchmakingPool:
+    '''
+    keeps the waiting users in redis so several matchmaking workers can share them: a sorted set of user ids
+    scored by enqueue time and a hash of their channel names. claiming is a single lua script, so two workers
+    can never claim the same user
+    '''
+    ADD_SCRIPT = '''
+        redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+        redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+    '''
+    CLAIM_SCRIPT = '''
+        local user_ids = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1, 'WITHSCORES')
+        local claimed = {}
+        for i = 1, #user_ids, 2 do
+            local channel_name = redis.call('HGET', KEYS[2], user_ids[i])
+            redis.call('ZREM', KEYS[1], user_ids[i])
+            redis.call('HDEL', KEYS[2], user_ids[i])
+            if channel_name then
+                table.insert(claimed, user_ids[i])
+                table.insert(claimed, channel_name)
+                table.insert(claimed, user_ids[i + 1])
+            end
+        end
+        return claimed
+    '''
+    RELEASE_SCRIPT = '''
+        for i = 1, #ARGV, 3 do
+            if not redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+                redis.call('ZADD', KEYS[1], ARGV[i + 2], ARGV[i])
+                redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+            end
+        end
+    '''
+
+    def __init__(self, redis_client, key_prefix='matchmaking'):
+        self._redis = redis_client
+        self._keys = [f'{key_prefix}:users', f'{key_prefix}:channels']
+        self._add_script = redis_client.register_script(RedisMatchmakingPool.ADD_SCRIPT)
+        self._claim_script = redis_client.register_script(RedisMatchmakingPool.CLAIM_SCRIPT)
+        self._release_script = redis_client.register_script(RedisMatchmakingPool.RELEASE_SCRIPT)
+
+    def add(self, user_id, channel_name, enqueue_time=None):
+        enqueue_time = enqueue_time if enqueue_time is not None else time.time()
+        self._add_script(keys=self._keys, args=[user_id, enqueue_time, channel_name])
+
+    def remove(self, user_id):
+        pipeline = self._redis.pipeline(transaction=True)
+        pipeline.zrem(self._keys[0], user_id)
+        pipeline.hdel(self._keys[1], user_id)
+        pipeline.execute()
+
+    def get_channel(self, user_id):
+        channel_name = self._redis.hget(self._keys[1], user_id)
+        return channel_name.decode() if channel_name is not None else None
+
+    def claim(self, limit):
+        claimed = self._claim_script(keys=self._keys, args=[limit])
+        return [
+            (int(claimed[i]), claimed[i + 1].decode(), float(claimed[i + 2]))
+            for i in range(0, len(claimed), 3)
+        ]
+
+    def release(self, entries):
+        if len(entries) == 0:
+            return
+
+        args = []
+        for user_id, channel_name, enqueue_time in entries:
+            args.extend([user_id, channel_name, enqueue_time])
+
+        self._release_script(keys=self._keys, args=args)
+
+
+def create_matchmaking_pool():
+    if settings.MATCHMAKING_POOL_BACKEND == 'redis':
+        import redis
+        return RedisMatchmakingPool(redis.StrictRedis.from_url(settings.REDIS_URL))
+
+    return InMemoryMatchmakingPool()
@@ -0,0 +1,28 @@
+import collections
+import threading
+
+_lock = threading.Lock()
+_counters = collections.Counter()
+_observations = {}
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name, value):
+    with _lock:
+        count, total, maximum = _observations.get(name, (0, 0, value))
+        _observations[name] = (count + 1, total + value, max(maximum, value))
+
+
+def get_snapshot():
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'observations': {
+                name: {'count': count, 'total': total, 'max': maximum}
+                for name, (count, total, maximum) in _observations.items()
+            }
+        }
@@ -0,0 +1,35 @@
+# Generated by Django 3.0.4 on 2026-10-19 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def set_closed_at_of_closed_conversations(apps, schema_editor):
+    Conversation = apps.get_model('chat', 'Conversation')
+    Conversation.objects.filter(is_open=False, closed_at__isnull=True).update(closed_at=django.utils.timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_chatuser_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='closed_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.CreateModel(
+            name='ConversationArchive',
+            fields=[
+                ('conversation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive', serialize=False, to='chat.Conversation')),
+                ('messages_count', models.IntegerField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('data', models.BinaryField()),
+            ],
+        ),
+        migrations.RunPython(set_closed_at_of_closed_conversations, migrations.RunPython.noop),
+    ]
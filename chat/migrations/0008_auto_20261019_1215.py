@@ -0,0 +1,23 @@
+# Generated by Django 3.0.4 on 2026-10-19 12:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_client_message_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversation',
+            name='is_open',
+            field=models.BooleanField(db_index=True, default=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='time',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
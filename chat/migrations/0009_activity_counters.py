@@ -0,0 +1,40 @@
+# Generated by Django 3.0.4 on 2026-10-19 12:50
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_auto_20261019_1215'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatuser',
+            name='last_message_time',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='chatuser',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_time',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
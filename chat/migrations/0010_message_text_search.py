@@ -0,0 +1,58 @@
+# Generated by Django 3.0.4 on 2026-10-19 13:30
+
+from django.db import migrations
+
+SQLITE_CREATE_STATEMENTS = [
+    '''CREATE VIRTUAL TABLE chat_message_fts USING fts5(text, content='chat_message', content_rowid='id', tokenize='unicode61')''',
+    '''CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts(rowid, text) VALUES (new.id, new.text);
+    END''',
+    '''CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END''',
+    '''CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF text ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO chat_message_fts(rowid, text) VALUES (new.id, new.text);
+    END''',
+    '''INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')''',
+]
+SQLITE_DROP_STATEMENTS = [
+    'DROP TRIGGER IF EXISTS chat_message_fts_update',
+    'DROP TRIGGER IF EXISTS chat_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chat_message_fts_insert',
+    'DROP TABLE IF EXISTS chat_message_fts',
+]
+
+# the 'simple' configuration only lowercases, no stemming, which is what hebrew text needs.
+# built concurrently so chat_message keeps taking writes meanwhile, which can not run inside a transaction
+POSTGRESQL_CREATE_STATEMENTS = [
+    '''CREATE INDEX CONCURRENTLY chat_message_text_search ON chat_message USING GIN (to_tsvector('simple', text))''',
+]
+POSTGRESQL_DROP_STATEMENTS = [
+    'DROP INDEX CONCURRENTLY IF EXISTS chat_message_text_search',
+]
+
+
+def _execute(schema_editor, statements_by_vendor):
+    for statement in statements_by_vendor.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def create_text_search(apps, schema_editor):
+    _execute(schema_editor, {'sqlite': SQLITE_CREATE_STATEMENTS, 'postgresql': POSTGRESQL_CREATE_STATEMENTS})
+
+
+def drop_text_search(apps, schema_editor):
+    _execute(schema_editor, {'sqlite': SQLITE_DROP_STATEMENTS, 'postgresql': POSTGRESQL_DROP_STATEMENTS})
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chat', '0009_activity_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_text_search, drop_text_search),
+    ]
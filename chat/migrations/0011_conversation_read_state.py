@@ -0,0 +1,29 @@
+# Generated by Django 3.0.4 on 2026-10-19 14:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_message_text_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationReadState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delivered_up_to', models.PositiveIntegerField(default=0)),
+                ('seen_up_to', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('chat_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.ChatUser')),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.Conversation')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='conversationreadstate',
+            constraint=models.UniqueConstraint(fields=('conversation', 'chat_user'), name='unique_conversation_chat_user_read_state'),
+        ),
+    ]
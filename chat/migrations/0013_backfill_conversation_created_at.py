@@ -0,0 +1,31 @@
+# Generated by Django 3.0.4 on 2026-10-19 15:10
+
+from django.db import migrations
+from django.db.models import Exists, F, OuterRef, Subquery
+
+
+def backfill_created_at(apps, schema_editor):
+    '''
+    0009_activity_counters set created_at of the existing conversations to the time it ran
+    '''
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+
+    # conversations that still have their messages started with the first one
+    earlier_messages = Message.objects.filter(conversation_id=OuterRef('pk'), time__lt=OuterRef('created_at'))
+    first_message_time = Message.objects.filter(conversation_id=OuterRef('pk')).order_by('time').values('time')[:1]
+    Conversation.objects.filter(Exists(earlier_messages)).update(created_at=Subquery(first_message_time))
+
+    # archived or empty conversations are known to have ended by then at least
+    Conversation.objects.filter(closed_at__lt=F('created_at')).update(created_at=F('closed_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_announcement'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_created_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.0.4 on 2026-10-19 15:30
+
+import importlib
+from django.db import migrations, models
+
+
+def restore_sqlite_text_search(apps, schema_editor):
+    # sqlite rebuilds chat_message to change its constraints, which drops the triggers of 0010_message_text_search
+    if schema_editor.connection.vendor == 'sqlite':
+        text_search = importlib.import_module('chat.migrations.0010_message_text_search')
+        text_search.drop_text_search(apps, schema_editor)
+        text_search.create_text_search(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_backfill_conversation_created_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, restore_sqlite_text_search),
+        migrations.RemoveConstraint(
+            model_name='message',
+            name='unique_author_client_message_id',
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('author', 'conversation', 'client_message_id'), name='unique_author_conversation_client_message_id'),
+        ),
+        migrations.RunPython(restore_sqlite_text_search, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 3.0.4 on 2026-10-19 18:57
+
+import json
+import zlib
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def move_archives_to_chunks(apps, schema_editor):
+    ConversationArchive = apps.get_model('chat', 'ConversationArchive')
+    ConversationArchiveChunk = apps.get_model('chat', 'ConversationArchiveChunk')
+
+    for archive in ConversationArchive.objects.order_by('conversation_id').iterator():
+        messages = json.loads(zlib.decompress(archive.data).decode())
+        ConversationArchiveChunk.objects.create(
+            archive_id=archive.conversation_id,
+            first_message_id=messages[0][0] if len(messages) > 0 else 0,
+            messages_count=archive.messages_count,
+            data=archive.data
+        )
+
+
+def move_chunks_to_archives(apps, schema_editor):
+    ConversationArchive = apps.get_model('chat', 'ConversationArchive')
+
+    for archive in ConversationArchive.objects.order_by('conversation_id').iterator():
+        messages = []
+        for chunk in archive.chunks.order_by('first_message_id'):
+            messages.extend(json.loads(zlib.decompress(chunk.data).decode()))
+
+        archive.data = zlib.compress(json.dumps(messages, ensure_ascii=False).encode(), 9)
+        archive.save(update_fields=['data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_message_unique_conversation_client_message_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationArchiveChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_message_id', models.IntegerField()),
+                ('messages_count', models.IntegerField()),
+                ('data', models.BinaryField()),
+                ('archive', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='chat.ConversationArchive')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='conversationarchivechunk',
+            constraint=models.UniqueConstraint(fields=('archive', 'first_message_id'), name='unique_archive_first_message_id'),
+        ),
+        migrations.RunPython(move_archives_to_chunks, move_chunks_to_archives),
+        # so that the field can be added back to the existing archives when the migration is reversed
+        migrations.AlterField(
+            model_name='conversationarchive',
+            name='data',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RemoveField(
+            model_name='conversationarchive',
+            name='data',
+        ),
+    ]
@@ -1,9 +1,17 @@
 import asyncio
+import collections
+import itertools
+import json
+import zlib
 from django.db import models
+from django.db.models import Exists, F, OuterRef
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import User
 from channels.db import database_sync_to_async
 from django.db import IntegrityError
 from django.db import transaction
+from django.utils import timezone
+from chat.conversation_user_dictionary import ConversationUserDictionary
 import time
 
 
@@ -13,6 +21,9 @@ class ChatUser(models.Model):
     name = models.TextField(max_length=50, default='')
     age = models.IntegerField(null=True)
     reason_to_isolation = models.TextField(max_length=300, default='')
+    # activity counters, maintained together with every stored message
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_time = models.DateTimeField(null=True)
 
     @staticmethod
     def create_chat_user(user, name=None, age=None, reason_to_isolation=None):
@@ -24,45 +35,295 @@ class ChatUser(models.Model):
 
 class Conversation(models.Model):
     attendees = models.ManyToManyField(ChatUser, 'conversations')
-    is_open = models.BooleanField(default=True)
+    is_open = models.BooleanField(default=True, db_index=True)
+    closed_at = models.DateTimeField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # activity counters, maintained together with every stored message
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_time = models.DateTimeField(null=True)
 
     @staticmethod
     def create_conversation(attendees_id):
         with transaction.atomic():
             conversation = Conversation.objects.create()
             conversation.attendees.add(*attendees_id)
-            conversation.save()
 
         return conversation
 
+    @staticmethod
+    def close(conversation_id):
+        return Conversation.objects.filter(id=conversation_id).update(is_open=False, closed_at=timezone.now())
+
+    @staticmethod
+    def get_recent_partners(chat_user_ids, since, partners_per_user):
+        '''
+        returns the partners each of the users had in conversations created since the given time, most recent first
+        '''
+        attendance = Conversation.attendees.through.objects
+        conversation_ids = attendance.filter(
+            chatuser_id__in=chat_user_ids,
+            conversation__created_at__gte=since
+        ).values('conversation_id')
+
+        conversations_attendees = collections.OrderedDict()
+        for conversation_id, chat_user_id in attendance.filter(
+                conversation_id__in=conversation_ids
+        ).order_by('-conversation_id').values_list('conversation_id', 'chatuser_id'):
+            conversations_attendees.setdefault(conversation_id, []).append(chat_user_id)
+
+        recent_partners = {chat_user_id: [] for chat_user_id in chat_user_ids}
+        for attendees in conversations_attendees.values():
+            for chat_user_id in attendees:
+                partners = recent_partners.get(chat_user_id)
+                if partners is not None and len(partners) < partners_per_user:
+                    partners.extend(attendee for attendee in attendees if attendee != chat_user_id)
+
+        return recent_partners
+
     async def close_conversation(self):
         self.is_open = False
+        self.closed_at = timezone.now()
         return await database_sync_to_async(self.save)()
 
+    @property
+    def duration(self):
+        return (self.closed_at or timezone.now()) - self.created_at
+
     def __str__(self):
-        return 'Conversation of: ' + ', '.join([f'{chat_user.user.first_name} {chat_user.user.last_name}' for chat_user in self.attendees.all()])
+        return 'Conversation of: ' + ', '.join([f'{chat_user.user.first_name} {chat_user.user.last_name}' for chat_user in self.attendees.select_related('user')])
 
 
 class Message(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
     author = models.ForeignKey(ChatUser, on_delete=models.CASCADE, related_name='messages')
     text = models.TextField(max_length=500)
-    time = models.DateTimeField(auto_now_add=True)
+    time = models.DateTimeField(auto_now_add=True, db_index=True)
+    # set by the client so a resent message is not stored twice
+    client_message_id = models.CharField(max_length=64, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['author', 'conversation', 'client_message_id'],
+                name='unique_author_conversation_client_message_id'
+            ),
+        ]
 
     @staticmethod
     def validate_message_creation(author_id, conversation_id):
-        conversation = Conversation.objects.filter(id=conversation_id, attendees__in=[author_id], is_open=True)
+        is_attendee = Conversation.objects.filter(id=conversation_id, attendees__in=[author_id], is_open=True).exists()
 
         # didn't find any matching conversation
-        if len(conversation) == 0:
+        if not is_attendee:
             raise Conversation.DoesNotExist()
 
         return True
 
     @staticmethod
-    def create_message(author_id, conversation_id, text):
-        return Message.objects.create(
-            author_id=author_id,
-            conversation_id=conversation_id,
-            text=text
+    def create_message(author_id, conversation_id, text, client_message_id=None):
+        with transaction.atomic():
+            message = Message.objects.create(
+                author_id=author_id,
+                conversation_id=conversation_id,
+                text=text,
+                client_message_id=client_message_id
+            )
+            # every lobby message would update the same row, the lobby has no activity counters
+            if conversation_id != ConversationUserDictionary.LOBBY_CONVERSATION_ID:
+                Conversation.objects.filter(id=conversation_id).update(
+                    message_count=F('message_count') + 1,
+                    last_message_time=message.time
+                )
+            ChatUser.objects.filter(id=author_id).update(
+                message_count=F('message_count') + 1,
+                last_message_time=message.time
+            )
+
+        return message
+
+    def get_payload(self):
+        return {
+            'message_id': self.id,
+            'text': self.text,
+            'conversation_id': self.conversation_id,
+            'author_id': self.author_id,
+            'time': time.mktime(self.time.timetuple()),
+            'client_message_id': self.client_message_id
+        }
+
+    @staticmethod
+    def get_conversation_history(conversation_id):
+        history = []
+        try:
+            history.extend(ConversationArchive.objects.get(conversation_id=conversation_id).get_messages())
+        except ConversationArchive.DoesNotExist:
+            pass
+
+        history.extend(
+            message.get_payload()
+            for message in Message.objects.filter(conversation_id=conversation_id).order_by('id')
         )
+        return history
+
+
+class ConversationReadState(models.Model):
+    '''
+    the receipts of a user in a conversation, kept as message id high-water marks instead of a row per message
+    '''
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='read_states')
+    chat_user = models.ForeignKey(ChatUser, on_delete=models.CASCADE, related_name='read_states')
+    delivered_up_to = models.PositiveIntegerField(default=0)
+    seen_up_to = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'chat_user'], name='unique_conversation_chat_user_read_state'),
+        ]
+
+    @staticmethod
+    def update_marks(conversation_id, chat_user_id, delivered_up_to, seen_up_to):
+        '''
+        moves the marks forward only, up to the latest message of the conversation
+        '''
+        latest_message_id = Message.objects.filter(
+            conversation_id=conversation_id
+        ).order_by('-id').values_list('id', flat=True).first() or 0
+        delivered_up_to = min(delivered_up_to, latest_message_id)
+        seen_up_to = min(seen_up_to, latest_message_id)
+
+        marks_filter = ConversationReadState.objects.filter(conversation_id=conversation_id, chat_user_id=chat_user_id)
+        update_kwargs = {
+            'delivered_up_to': Greatest('delivered_up_to', delivered_up_to),
+            'seen_up_to': Greatest('seen_up_to', seen_up_to),
+            'updated_at': timezone.now(),
+        }
+        if marks_filter.update(**update_kwargs) > 0:
+            return
+
+        try:
+            with transaction.atomic():
+                ConversationReadState.objects.create(
+                    conversation_id=conversation_id,
+                    chat_user_id=chat_user_id,
+                    delivered_up_to=delivered_up_to,
+                    seen_up_to=seen_up_to
+                )
+        except IntegrityError:
+            # created meanwhile by a concurrent update
+            marks_filter.update(**update_kwargs)
+
+
+class Announcement(models.Model):
+    '''
+    a notice sent by the operators to every connected user
+    '''
+    text = models.TextField(max_length=500)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True)
+    # reported by the web processes, a resent announcement keeps counting
+    delivered_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.text
+
+
+class ConversationArchive(models.Model):
+    '''
+    cold storage of the messages of a closed conversation, kept as zlib compressed json chunks
+    '''
+    conversation = models.OneToOneField(Conversation, on_delete=models.CASCADE, related_name='archive', primary_key=True)
+    messages_count = models.IntegerField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def get_messages(self):
+        return [message for chunk in self.chunks.order_by('first_message_id') for message in chunk.get_messages()]
+
+    @staticmethod
+    def archive_closed_conversations(closed_before, batch_size):
+        '''
+        moves up to batch_size messages of conversations closed before the given time into archives, a conversation
+        with more messages is archived over several calls. returns the number of archived messages
+        '''
+        with transaction.atomic():
+            conversation_ids = list(
+                Conversation.objects.filter(
+                    Exists(Message.objects.filter(conversation_id=OuterRef('pk'))),
+                    is_open=False,
+                    closed_at__lt=closed_before
+                ).order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            messages = list(
+                Message.objects.filter(conversation_id__in=conversation_ids).order_by('conversation_id', 'id')[:batch_size]
+            )
+            if len(messages) == 0:
+                return 0
+
+            chunks = [
+                ConversationArchiveChunk.create_chunk(conversation_id, list(conversation_messages))
+                for conversation_id, conversation_messages
+                in itertools.groupby(messages, lambda message: message.conversation_id)
+            ]
+
+            # only a conversation split by the previous batch has an archive already
+            archived_conversation_ids = set(
+                ConversationArchive.objects.filter(
+                    conversation_id__in=[chunk.archive_id for chunk in chunks]
+                ).values_list('conversation_id', flat=True)
+            )
+            ConversationArchive.objects.bulk_create([
+                ConversationArchive(conversation_id=chunk.archive_id, messages_count=chunk.messages_count)
+                for chunk in chunks
+                if chunk.archive_id not in archived_conversation_ids
+            ])
+            for chunk in chunks:
+                if chunk.archive_id in archived_conversation_ids:
+                    ConversationArchive.objects.filter(conversation_id=chunk.archive_id).update(
+                        messages_count=F('messages_count') + chunk.messages_count
+                    )
+
+            ConversationArchiveChunk.objects.bulk_create(chunks)
+            Message.objects.filter(id__in=[message.id for message in messages]).delete()
+
+        return len(messages)
+
+
+class ConversationArchiveChunk(models.Model):
+    '''
+    consecutive messages of an archived conversation, written by a single archiving transaction
+    '''
+    archive = models.ForeignKey(ConversationArchive, on_delete=models.CASCADE, related_name='chunks')
+    first_message_id = models.IntegerField()
+    messages_count = models.IntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['archive', 'first_message_id'], name='unique_archive_first_message_id'),
+        ]
+
+    @staticmethod
+    def create_chunk(conversation_id, messages):
+        rows = []
+        for message in messages:
+            payload = message.get_payload()
+            rows.append([payload['message_id'], payload['author_id'], payload['time'], payload['text']])
+
+        return ConversationArchiveChunk(
+            archive_id=conversation_id,
+            first_message_id=messages[0].id,
+            messages_count=len(messages),
+            data=zlib.compress(json.dumps(rows, ensure_ascii=False).encode(), 9)
+        )
+
+    def get_messages(self):
+        return [
+            {
+                'message_id': message_id,
+                'text': text,
+                'conversation_id': self.archive_id,
+                'author_id': author_id,
+                'time': message_time
+            }
+            for message_id, author_id, message_time, text in json.loads(zlib.decompress(self.data).decode())
+        ]
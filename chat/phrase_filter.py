@@ -0,0 +1,185 @@
+import asyncio
+import collections
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(character):
+    # lowering character by character keeps the match positions aligned with the original text
+    lowered = character.lower()
+    return lowered if len(lowered) == 1 else character
+
+
+def _is_word_character(character):
+    return character.isalnum() or character == '_'
+
+
+class AhoCorasickAutomaton:
+    '''
+    finds every occurrence of any of the phrases in a single linear pass over the text
+    '''
+    def __init__(self, phrases):
+        self._transitions = [{}]
+        self._failures = [0]
+        # lengths of the phrases ending at each state, longest first
+        self._match_lengths = [()]
+
+        for phrase in phrases:
+            self._add_phrase(phrase)
+
+        self._build_failures()
+
+    def _add_phrase(self, phrase):
+        state = 0
+        for character in phrase:
+            character = _normalize(character)
+            next_state = self._transitions[state].get(character)
+            if next_state is None:
+                next_state = len(self._transitions)
+                self._transitions.append({})
+                self._failures.append(0)
+                self._match_lengths.append(())
+                self._transitions[state][character] = next_state
+
+            state = next_state
+
+        self._match_lengths[state] = (len(phrase),)
+
+    def _build_failures(self):
+        states = collections.deque(self._transitions[0].values())
+        while len(states) > 0:
+            state = states.popleft()
+            for character, next_state in self._transitions[state].items():
+                states.append(next_state)
+
+                failure = self._failures[state]
+                while failure != 0 and character not in self._transitions[failure]:
+                    failure = self._failures[failure]
+
+                self._failures[next_state] = self._transitions[failure].get(character, 0)
+                # a state fails to a shorter state, so its own phrase stays the longest
+                self._match_lengths[next_state] += self._match_lengths[self._failures[next_state]]
+
+    '''
+    yields the (start, end) span of the longest whole-word phrase ending at every position that ends one,
+    a phrase inside a longer word (e.g. "ass" in "class") is not a match
+    '''
+    def find_spans(self, text):
+        transitions = self._transitions
+        failures = self._failures
+        match_lengths = self._match_lengths
+
+        state = 0
+        for index, character in enumerate(text):
+            character = _normalize(character)
+            while state != 0 and character not in transitions[state]:
+                state = failures[state]
+
+            state = transitions[state].get(character, 0)
+            if len(match_lengths[state]) == 0:
+                continue
+
+            end = index + 1
+            if end < len(text) and _is_word_character(text[end]) and _is_word_character(text[index]):
+                continue
+
+            for match_length in match_lengths[state]:
+                start = end - match_length
+                if start == 0 or not _is_word_character(text[start - 1]) or not _is_word_character(text[start]):
+                    yield start, end
+                    break
+
+
+class BannedPhraseFilter:
+    '''
+    masks or rejects the banned phrases listed in a file (one per line), the file is reloaded when it changes.
+    the file is read and the automaton built in the executor, messages wait for the first load only and keep
+    using the previous automaton while a reload is running
+    '''
+    POLICY_MASK = 'mask'
+    POLICY_REJECT = 'reject'
+    MASK_CHARACTER = '*'
+
+    def __init__(self, path, policy, reload_interval_seconds):
+        self._path = path
+        self._policy = policy
+        self._reload_interval_seconds = reload_interval_seconds
+        self._automaton = None
+        self._is_loaded = False
+        self._loaded_modification_time = None
+        self._next_reload_check_time = 0
+        self._reload_future = None
+
+    async def _get_automaton(self):
+        now = time.monotonic()
+        if now >= self._next_reload_check_time and (self._reload_future is None or self._reload_future.done()):
+            self._next_reload_check_time = now + self._reload_interval_seconds
+            self._reload_future = asyncio.get_event_loop().run_in_executor(None, self._read_if_changed)
+            self._reload_future.add_done_callback(self._on_reload_done)
+
+        if not self._is_loaded:
+            await asyncio.shield(self._reload_future)
+
+        return self._automaton
+
+    '''
+    runs in the executor, returns the (automaton, modification time, phrases count) to swap in, None to keep the current
+    '''
+    def _read_if_changed(self):
+        try:
+            modification_time = os.stat(self._path).st_mtime
+        except OSError:
+            modification_time = None
+
+        if self._is_loaded and modification_time == self._loaded_modification_time:
+            return None
+
+        phrases = []
+        if modification_time is not None:
+            try:
+                with open(self._path, encoding='utf-8') as phrases_file:
+                    phrases = [line.strip() for line in phrases_file if line.strip() and not line.startswith('#')]
+            except (OSError, ValueError):
+                logger.exception('could not read the banned phrases, keeping the previous ones')
+                return None
+
+        return AhoCorasickAutomaton(phrases) if len(phrases) > 0 else None, modification_time, len(phrases)
+
+    def _on_reload_done(self, future):
+        if future.cancelled():
+            return
+
+        if future.exception() is not None:
+            logger.error('failed loading the banned phrases', exc_info=future.exception())
+            return
+
+        if future.result() is None:
+            return
+
+        self._automaton, self._loaded_modification_time, phrases_count = future.result()
+        self._is_loaded = True
+        logger.info('loaded %s banned phrases', phrases_count)
+
+    '''
+    returns whether the text is rejected and the text to use, masked when the policy is mask
+    '''
+    async def filter(self, text):
+        automaton = await self._get_automaton()
+        if automaton is None:
+            return False, text
+
+        spans = automaton.find_spans(text)
+        if self._policy == BannedPhraseFilter.POLICY_REJECT:
+            return next(spans, None) is not None, text
+
+        characters = None
+        for start, end in spans:
+            if characters is None:
+                characters = list(text)
+
+            characters[start:end] = BannedPhraseFilter.MASK_CHARACTER * (end - start)
+
+        return False, text if characters is None else ''.join(characters)
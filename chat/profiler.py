@@ -0,0 +1,119 @@
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    '''
+    samples the stacks of every thread of the process from a background thread: the event loop, the worker
+    thread pool and the matchmaker thread. the stacks are written in the folded format read by flamegraph.pl
+    and speedscope, a line per distinct stack with the thread name at its root. nothing runs between sessions
+    '''
+    def __init__(self, interval_seconds, output_dir):
+        self._interval_seconds = interval_seconds
+        self._output_dir = output_dir
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def is_running(self):
+        return self._thread is not None
+
+    '''
+    samples for duration_seconds in the background, returns False if a session is already running
+    '''
+    def start(self, duration_seconds):
+        with self._lock:
+            if self._thread is not None:
+                return False
+
+            self._thread = threading.Thread(target=self._run, args=(duration_seconds,), name='profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def _run(self, duration_seconds):
+        try:
+            stacks, samples_count = self._sample(duration_seconds)
+            output_path = self._write(stacks)
+            logger.info('profiled %s samples into %s', samples_count, output_path)
+        except Exception:
+            logger.exception('profiling failed')
+        finally:
+            with self._lock:
+                self._thread = None
+
+    def _sample(self, duration_seconds):
+        own_thread_id = threading.get_ident()
+        stacks = collections.Counter()
+        # code object -> frame label, the same few hundred functions show up in every sample
+        labels = {}
+        samples_count = 0
+
+        deadline = time.monotonic() + duration_seconds
+        while time.monotonic() < deadline:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+
+                frame_labels = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = f'{frame.f_globals.get("__name__", "?")}:{code.co_name}'.replace(';', ':').replace(' ', '_')
+                        labels[code] = label
+
+                    frame_labels.append(label)
+                    frame = frame.f_back
+
+                frame_labels.append(thread_names.get(thread_id, str(thread_id)).replace(';', ':').replace(' ', '_'))
+                stacks[';'.join(reversed(frame_labels))] += 1
+
+            samples_count += 1
+            time.sleep(self._interval_seconds)
+
+        return stacks, samples_count
+
+    def _write(self, stacks):
+        os.makedirs(self._output_dir, exist_ok=True)
+        output_path = os.path.join(self._output_dir, f'{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}.folded')
+        with open(output_path, 'w') as output_file:
+            for stack, count in stacks.items():
+                output_file.write(f'{stack} {count}\n')
+
+        return output_path
+
+
+_profiler = None
+
+
+def get_profiler():
+    global _profiler
+    if _profiler is None:
+        _profiler = SamplingProfiler(settings.PROFILER_INTERVAL_SECONDS, settings.PROFILER_OUTPUT_DIR)
+
+    return _profiler
+
+
+def _on_signal(signal_number, frame):
+    get_profiler().start(settings.PROFILER_DURATION_SECONDS)
+
+
+'''
+starts a session right away when the PROFILE env var is set, and on every SIGUSR2
+'''
+def install():
+    if os.environ.get('PROFILE', '0') == '1':
+        get_profiler().start(settings.PROFILER_DURATION_SECONDS)
+
+    # signal handlers can only be installed from the main thread
+    if hasattr(signal, 'SIGUSR2') and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR2, _on_signal)
@@ -0,0 +1,87 @@
+import contextlib
+import logging
+import time
+from channels.consumer import get_handler_name
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connection
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryRecorder:
+    # transaction control is not counted, atomic() issues savepoints only when nested (e.g. inside a test case)
+    TRANSACTION_STATEMENTS = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+    def __init__(self):
+        self.queries_count = 0
+        self.duration_seconds = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if not sql.startswith(QueryRecorder.TRANSACTION_STATEMENTS):
+                self.queries_count += 1
+            self.duration_seconds += time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def record_queries():
+    recorder = QueryRecorder()
+    with connection.execute_wrapper(recorder):
+        yield recorder
+
+
+@contextlib.contextmanager
+def query_budget(max_queries):
+    with record_queries() as recorder:
+        yield recorder
+
+    if recorder.queries_count > max_queries:
+        raise QueryBudgetExceeded(f'{recorder.queries_count} queries executed, the budget is {max_queries}')
+
+
+class QueryBudgetMixin:
+    '''
+    records the queries of every handler invocation of a SyncConsumer task and checks them against query_budgets
+    '''
+    # handler name: maximum queries per invocation
+    query_budgets = {}
+
+    @database_sync_to_async
+    def dispatch(self, message):
+        handler_name = get_handler_name(message)
+        handler = getattr(self, handler_name, None)
+        if handler is None:
+            raise ValueError(f'No handler for message type {message["type"]}')
+
+        with record_queries() as recorder:
+            handler(message)
+
+        self._report_queries(handler_name, recorder)
+
+    def _report_queries(self, handler_name, recorder):
+        metric_name = f'db.{type(self).__name__}.{handler_name}'
+        metrics.observe(f'{metric_name}.queries', recorder.queries_count)
+        metrics.observe(f'{metric_name}.seconds', recorder.duration_seconds)
+        logger.debug(
+            '%s ran %s queries in %.2fms',
+            metric_name,
+            recorder.queries_count,
+            recorder.duration_seconds * 1000
+        )
+
+        max_queries = self.query_budgets.get(handler_name)
+        if max_queries is not None and recorder.queries_count > max_queries:
+            metrics.increment(f'{metric_name}.over_budget')
+            logger.warning('%s ran %s queries, over its budget of %s', metric_name, recorder.queries_count, max_queries)
+
+            if settings.QUERY_BUDGET_STRICT:
+                raise QueryBudgetExceeded(f'{metric_name} ran {recorder.queries_count} queries, the budget is {max_queries}')
@@ -0,0 +1,64 @@
+class ReceiptBatcher:
+    '''
+    keeps the delivered and seen high-water marks of a single user in a conversation,
+    a mark that moved forward is released at most once per interval
+    '''
+    __slots__ = (
+        '_interval_seconds',
+        '_delivered_up_to',
+        '_seen_up_to',
+        '_sent_delivered_up_to',
+        '_sent_seen_up_to',
+        '_last_sent_time',
+    )
+
+    def __init__(self, interval_seconds):
+        self._interval_seconds = interval_seconds
+        self._delivered_up_to = 0
+        self._seen_up_to = 0
+        self._sent_delivered_up_to = 0
+        self._sent_seen_up_to = 0
+        self._last_sent_time = None
+
+    def on_receipt(self, delivered_up_to, seen_up_to, now):
+        self._seen_up_to = max(self._seen_up_to, seen_up_to)
+        # a seen message was delivered too
+        self._delivered_up_to = max(self._delivered_up_to, delivered_up_to, self._seen_up_to)
+
+        return self.poll(now)
+
+    def _is_pending(self):
+        return self._delivered_up_to > self._sent_delivered_up_to or self._seen_up_to > self._sent_seen_up_to
+
+    '''
+    returns the (delivered_up_to, seen_up_to) marks that should be sent now, None if there is nothing to send yet
+    '''
+    def poll(self, now):
+        if not self._is_pending():
+            return None
+
+        if self._last_sent_time is not None and now < self._last_sent_time + self._interval_seconds:
+            return None
+
+        self._last_sent_time = now
+        return self.flush()
+
+    '''
+    returns the marks that were not sent yet regardless of the interval, None if there are none
+    '''
+    def flush(self):
+        if not self._is_pending():
+            return None
+
+        self._sent_delivered_up_to = self._delivered_up_to
+        self._sent_seen_up_to = self._seen_up_to
+        return self._delivered_up_to, self._seen_up_to
+
+    '''
+    returns the time poll should be called at, None if nothing is pending
+    '''
+    def get_next_deadline(self):
+        if not self._is_pending():
+            return None
+
+        return self._last_sent_time + self._interval_seconds
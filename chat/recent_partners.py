@@ -0,0 +1,68 @@
+import collections
+
+
+class RecentPartners:
+    '''
+    remembers the most recent partners of every user in a small ordered set per user. the whole structure holds
+    at most max_entries users and partner ids, the least recently used users are evicted first.
+    only used by the matchmaker thread, so it is not locked
+    '''
+    def __init__(self, partners_per_user, max_entries):
+        self._partners_per_user = partners_per_user
+        self._max_entries = max_entries
+        # user id -> {partner id: None}, an insertion ordered set with the oldest partner first
+        self._partners = collections.OrderedDict()
+        self._entries_count = 0
+
+    '''
+    sets the partners of users, given as {user id: [partner ids, most recent first]}
+    '''
+    def load(self, partners_by_user):
+        for user_id, partner_ids in partners_by_user.items():
+            self._forget(user_id)
+            partners = dict.fromkeys(reversed(partner_ids[:self._partners_per_user]))
+            self._partners[user_id] = partners
+            self._entries_count += 1 + len(partners)
+
+        self._evict()
+
+    def have_met(self, user_id1, user_id2):
+        partners = self._partners.get(user_id1)
+        if partners is None:
+            return False
+
+        self._partners.move_to_end(user_id1)
+        return user_id2 in partners
+
+    def add_match(self, user_id1, user_id2):
+        self._add_partner(user_id1, user_id2)
+        self._add_partner(user_id2, user_id1)
+        self._evict()
+
+    def _add_partner(self, user_id, partner_id):
+        partners = self._partners.get(user_id)
+        if partners is None:
+            # not loaded, the partner will be loaded from the db with the rest of the history
+            return
+
+        self._partners.move_to_end(user_id)
+        if partner_id in partners:
+            del partners[partner_id]
+            self._entries_count -= 1
+
+        partners[partner_id] = None
+        self._entries_count += 1
+
+        if len(partners) > self._partners_per_user:
+            del partners[next(iter(partners))]
+            self._entries_count -= 1
+
+    def _forget(self, user_id):
+        partners = self._partners.pop(user_id, None)
+        if partners is not None:
+            self._entries_count -= 1 + len(partners)
+
+    def _evict(self):
+        while self._entries_count > self._max_entries and len(self._partners) > 0:
+            _, partners = self._partners.popitem(last=False)
+            self._entries_count -= 1 + len(partners)
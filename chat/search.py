@@ -0,0 +1,40 @@
+from django.db import connection
+from .models import Message
+
+
+def search_messages(query, author_id=None, conversation_id=None, before_id=None, limit=50):
+    '''
+    returns up to limit messages containing every word of the query, newest first,
+    paging continues by passing the id of the last returned message as before_id
+    '''
+    terms = query.split()
+    if len(terms) == 0:
+        return []
+
+    messages = Message.objects.all()
+    if author_id is not None:
+        messages = messages.filter(author_id=author_id)
+
+    if conversation_id is not None:
+        messages = messages.filter(conversation_id=conversation_id)
+
+    if before_id is not None:
+        messages = messages.filter(id__lt=before_id)
+
+    # the text indexes are created by the 0010_message_text_search migration
+    if connection.vendor == 'sqlite':
+        fts_query = ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        messages = messages.extra(
+            where=['chat_message.id IN (SELECT rowid FROM chat_message_fts WHERE chat_message_fts MATCH %s)'],
+            params=[fts_query]
+        )
+    elif connection.vendor == 'postgresql':
+        messages = messages.extra(
+            where=["to_tsvector('simple', chat_message.text) @@ plainto_tsquery('simple', %s)"],
+            params=[query]
+        )
+    else:
+        for term in terms:
+            messages = messages.filter(text__icontains=term)
+
+    return list(messages.order_by('-id')[:limit])
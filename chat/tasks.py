@@ -1,30 +1,58 @@
 from asgiref.sync import async_to_sync
 from channels.generic.websocket import SyncConsumer
 from chat.match_maker import MatchMaker
-from chat.models import Message, Conversation, ChatUser
-from django.contrib.auth.models import User
+from chat.matchmaking_pool import create_matchmaking_pool
+from chat.models import Message, Conversation, ChatUser, ConversationReadState, Announcement
 from rest_framework.authtoken.models import Token
 from channels.layers import get_channel_layer
+from django.conf import settings
+import asyncio
+import collections
 import json
-import time
-import firebase_admin
-from firebase_admin import messaging
-from .enums import ErrorEnum
+import logging
+from django.db import IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from .enums import ErrorEnum, AuthorizationEnum
 from .conversation_user_dictionary import ConversationUserDictionary
+from .query_budget import QueryBudgetMixin
+from . import metrics
+from .announcements import get_broadcast_group_name
 
+logger = logging.getLogger(__name__)
+
+
+class ConversationManagerTask(QueryBudgetMixin, SyncConsumer):
+    query_budgets = {
+        'request_lobby_attendees_list': 1,
+        'user_disconnect': 1,
+        'leave_conversation': 1,
+        'join_conversation': 1,
+        'authorize_message': 0,
+        'broadcast_message_to_conversation': 0,
+    }
 
-class ConversationManagerTask(SyncConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._conversation_user_dictionary = ConversationUserDictionary()
+        self._conversation_user_dictionary = ConversationUserDictionary(settings.LOBBY_ROOM_MAX_SIZE)
         self.channel_layer = get_channel_layer()
 
     @classmethod
     def get_conversation_channel(cls, conversation_id):
         return f'conversation_{conversation_id}'
 
-    def _create_lobby_attendees_dict(self):
-        lobby_attendees_ids = self._conversation_user_dictionary.get_conversation_attendees(ConversationUserDictionary.LOBBY_CONVERSATION_ID)
+    @classmethod
+    def get_lobby_room_channel(cls, lobby_room_id):
+        return f'lobby_{lobby_room_id}'
+
+    def _get_user_channel(self, user_id, conversation_id):
+        if conversation_id == ConversationUserDictionary.LOBBY_CONVERSATION_ID:
+            return self.get_lobby_room_channel(self._conversation_user_dictionary.get_user_lobby_room(user_id))
+
+        return self.get_conversation_channel(conversation_id)
+
+    def _create_lobby_attendees_dict(self, lobby_room_id, user_id):
+        lobby_attendees_ids = self._conversation_user_dictionary.get_lobby_room_attendees(lobby_room_id) - {user_id}
         if len(lobby_attendees_ids) > 0:
             return {
                 attendee.id: attendee.name
@@ -35,13 +63,18 @@ class ConversationManagerTask(SyncConsumer):
 
     def request_lobby_attendees_list(self, content):
         channel_name = content['channel_name']
-        attendees_dict = self._create_lobby_attendees_dict()
+        user_id = content['user_id']
+
+        # reserving the room now so the attendees list matches the room the user is about to join
+        lobby_room_id = self._conversation_user_dictionary.assign_lobby_room(user_id)
+        attendees_dict = self._create_lobby_attendees_dict(lobby_room_id, user_id)
 
         async_to_sync(self.channel_layer.send)(
             channel_name,
             {
                 'type': 'response_lobby_attendees_list',
-                'attendees': json.dumps(attendees_dict)
+                'attendees': json.dumps(attendees_dict),
+                'lobby_room_id': lobby_room_id
             }
         )
 
@@ -63,9 +96,7 @@ class ConversationManagerTask(SyncConsumer):
             self._close_conversation(closed_conversation_id, user_id)
 
     def _close_conversation(self, conversation_id, user_id):
-        conversation = Conversation.objects.get(id=conversation_id)
-        conversation.is_open = False
-        conversation.save()
+        Conversation.close(conversation_id)
 
         async_to_sync(self.channel_layer.group_send)(
             self.get_conversation_channel(conversation_id),
@@ -78,18 +109,48 @@ class ConversationManagerTask(SyncConsumer):
     def join_conversation(self, content):
         user_id = content['user_id']
         conversation_id = content['conversation_id']
-        closed_conversation_id = self._conversation_user_dictionary.leave_any_previous_conversations_and_join(user_id, conversation_id)
+        closed_conversation_id = self._conversation_user_dictionary.leave_any_previous_conversations_and_join(
+            user_id,
+            conversation_id,
+            content.get('lobby_room_id')
+        )
 
         if closed_conversation_id is not None:
             return self._close_conversation(closed_conversation_id, user_id)
 
+    def authorize_message(self, content):
+        user_conversation_id = self._conversation_user_dictionary.get_user_conversation(content['author_id'])
+
+        if user_conversation_id is None:
+            authorization = AuthorizationEnum.UNKNOWN
+        elif user_conversation_id == content['conversation_id']:
+            authorization = AuthorizationEnum.GRANTED
+        else:
+            authorization = AuthorizationEnum.DENIED
+
+        async_to_sync(self.channel_layer.send)(
+            'db-operations-task',
+            {
+                'type': 'create_message',
+                'channel_name': content['channel_name'],
+                'text': content['text'],
+                'conversation_id': content['conversation_id'],
+                'author_id': content['author_id'],
+                'seq': content['seq'],
+                'lobby_room_id': content.get('lobby_room_id'),
+                'client_message_id': content.get('client_message_id'),
+                'authorization': authorization.value,
+            }
+        )
+
     def broadcast_message_to_conversation(self, content):
-        conversation_id = self._conversation_user_dictionary.get_user_conversation(content['user_id'])
+        user_id = content['user_id']
+        conversation_id = self._conversation_user_dictionary.get_user_conversation(user_id)
 
         if conversation_id is not None:
             message = content['message']
             async_to_sync(self.channel_layer.group_send)(
-                self.get_conversation_channel(conversation_id),
+                self._get_user_channel(user_id, conversation_id),
                 {
                     'type': 'chat.message',
                     'content': message
@@ -97,11 +158,32 @@ class ConversationManagerTask(SyncConsumer):
             )
 
 
-class PushNotificationsTask(SyncConsumer):
+class PushNotificationsTask(QueryBudgetMixin, SyncConsumer):
+    query_budgets = {
+        'add_pn_listener': 0,
+        'remove_pn_listener': 0,
+        'send_pn_message': 0,
+    }
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._channel_name_to_token_dict = {}
-        firebase_admin.initialize_app()
+        self._messaging = None
+
+    def _get_messaging(self):
+        # firebase and its google client stack are only loaded by the worker, on the first notification
+        if self._messaging is None:
+            import firebase_admin
+            from firebase_admin import messaging
+
+            try:
+                firebase_admin.get_app()
+            except ValueError:
+                firebase_admin.initialize_app()
+
+            self._messaging = messaging
+
+        return self._messaging
 
     def add_pn_listener(self, content):
         channel_name = content['channel_name']
@@ -119,7 +201,9 @@ class PushNotificationsTask(SyncConsumer):
         title = content['title']
         body = content['body']
         has_error_occurred = True
+        messaging = None
         try:
+            messaging = self._get_messaging()
             message = messaging.Message(
                 data={
                     'title': title,
@@ -132,20 +216,40 @@ class PushNotificationsTask(SyncConsumer):
 
             # everything succeeded, changing error to false
             has_error_occurred = False
-        except messaging.UnregisteredError:
-            if channel_name in self._channel_name_to_token_dict:
-                del self._channel_name_to_token_dict[channel_name]
+        except Exception as error:
+            if messaging is None:
+                # firebase could not be initialized, the notification is lost like any other failed send
+                logger.exception('push notifications are unavailable', extra={'event': 'pn.unavailable'})
+            elif isinstance(error, messaging.UnregisteredError):
+                if channel_name in self._channel_name_to_token_dict:
+                    del self._channel_name_to_token_dict[channel_name]
+            else:
+                raise
         finally:
             if has_error_occurred:
+                metrics.increment('pn.failed')
                 async_to_sync(self.channel_layer.send)(channel_name, {'type': 'pn_channel_removed'})
-                print('removing the pn channel')
+                logger.warning(
+                    'push notification failed, removing the pn channel',
+                    extra={'event': 'pn.channel_removed', 'channel_name': channel_name}
+                )
+
 
+class DBOperationsTask(QueryBudgetMixin, SyncConsumer):
+    query_budgets = {
+        'authenticate': 1,
+        'create_message': 5,
+        'update_receipts': 4,
+    }
+    SENT_MESSAGES_CACHE_SIZE = 10000
 
-class DBOperationsTask(SyncConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._seq = 0
 
+        # (author id, conversation id, client message id) -> message payload, of the most recently created messages
+        self._sent_messages_cache = collections.OrderedDict()
+
     def get_next_seq(self):
         self._seq += 1
         return self._seq
@@ -161,8 +265,8 @@ class DBOperationsTask(SyncConsumer):
         user = None
 
         try:
-            token = Token.objects.get(key=access_token)
-            user = User.objects.get(id=token.user_id)
+            token = Token.objects.select_related('user__chat_user').get(key=access_token)
+            user = token.user
 
             if not user.is_active:
                 error_code = ErrorEnum.AUTH_FAIL_USER_INACTIVE
@@ -189,19 +293,28 @@ class DBOperationsTask(SyncConsumer):
         author_id = content['author_id']
         conversation_id = content['conversation_id']
         response_to = content['seq']
+        authorization = AuthorizationEnum(content.get('authorization', AuthorizationEnum.UNKNOWN.value))
+        client_message_id = content.get('client_message_id')
+        sent_message_key = (author_id, conversation_id, client_message_id) if client_message_id is not None else None
 
         # initialized to success values, any exception caught should change that
         error_code = ErrorEnum.OK
         error_message = ''
-        message = None
+        message_payload = None
+        is_duplicate = False
 
         try:
-            # validate if the user is allowed to do this operation
-            message = Message.create_message(
-                author_id=author_id,
-                conversation_id=conversation_id,
-                text=text
-            )
+            if sent_message_key in self._sent_messages_cache:
+                # a client retry, answering with the original message
+                self._sent_messages_cache.move_to_end(sent_message_key)
+                message_payload = self._sent_messages_cache[sent_message_key]
+                is_duplicate = True
+            else:
+                self._authorize_message(content, authorization)
+                message_payload, is_duplicate = self._store_message(author_id, conversation_id, text, client_message_id)
+
+                if sent_message_key is not None:
+                    self._remember_sent_message(sent_message_key, message_payload)
 
         except Conversation.DoesNotExist:
             # failed
@@ -211,19 +324,74 @@ class DBOperationsTask(SyncConsumer):
         finally:
             return_content = self._create_base_return_content('create_message_response', error_code, error_message, response_to)
 
-            if message is not None:
-                return_content['message'] = {
-                    'text': message.text,
-                    'conversation_id': message.conversation_id,
-                    'author_id': author_id,
-                    'time': time.mktime(message.time.timetuple())
-                }
+            if message_payload is not None:
+                return_content['message'] = message_payload
+                return_content['is_duplicate'] = is_duplicate
 
             async_to_sync(self.channel_layer.send)(
                 channel_name,
                 return_content
             )
 
+    def _authorize_message(self, content, authorization):
+        # validate if the user is allowed to do this operation
+        if authorization == AuthorizationEnum.DENIED:
+            raise Conversation.DoesNotExist()
+
+        if authorization == AuthorizationEnum.UNKNOWN:
+            # the conversation manager lost its roster, falling back to the db and restoring the roster.
+            # the lobby has no attendees in the db, any authenticated user (the only kind a consumer forwards) may write
+            if content['conversation_id'] != ConversationUserDictionary.LOBBY_CONVERSATION_ID:
+                Message.validate_message_creation(content['author_id'], content['conversation_id'])
+
+            async_to_sync(self.channel_layer.send)(
+                'conversation-manager-task',
+                {
+                    'type': 'join_conversation',
+                    'user_id': content['author_id'],
+                    'conversation_id': content['conversation_id'],
+                    'lobby_room_id': content.get('lobby_room_id')
+                }
+            )
+
+    '''
+    returns the message payload and whether the message was already stored before
+    '''
+    @staticmethod
+    def _store_message(author_id, conversation_id, text, client_message_id):
+        try:
+            message = Message.create_message(
+                author_id=author_id,
+                conversation_id=conversation_id,
+                text=text,
+                client_message_id=client_message_id
+            )
+            return message.get_payload(), False
+        except IntegrityError:
+            if client_message_id is None:
+                raise
+
+            # the cache has missed the retry (e.g. after a restart), the unique constraint caught it
+            message = Message.objects.get(
+                author_id=author_id,
+                conversation_id=conversation_id,
+                client_message_id=client_message_id
+            )
+            return message.get_payload(), True
+
+    def update_receipts(self, content):
+        ConversationReadState.update_marks(
+            content['conversation_id'],
+            content['user_id'],
+            content['delivered_up_to'],
+            content['seen_up_to']
+        )
+
+    def _remember_sent_message(self, sent_message_key, message_payload):
+        self._sent_messages_cache[sent_message_key] = message_payload
+        if len(self._sent_messages_cache) > DBOperationsTask.SENT_MESSAGES_CACHE_SIZE:
+            self._sent_messages_cache.popitem(last=False)
+
     def _create_base_return_content(self, message_type, error_code, error_message, response_to=None):
         error_message = {
             'type': message_type,
@@ -243,10 +411,17 @@ class DBOperationsTask(SyncConsumer):
         return error_message
 
 
-class MatchmakingTask(SyncConsumer):
+class MatchmakingTask(QueryBudgetMixin, SyncConsumer):
+    query_budgets = {
+        'request_match': 0,
+        'unrequest_match': 0,
+    }
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.matcher = MatchMaker(self.match_request_found)
+        # matches are found on the matchmaker thread, their sends are scheduled back on the worker event loop
+        self._loop = asyncio.get_event_loop()
+        self.matcher = MatchMaker(self.match_request_found, create_matchmaking_pool())
 
     def request_match(self, message):
         # removing old user channel if there is
@@ -262,17 +437,49 @@ class MatchmakingTask(SyncConsumer):
         self.matcher.add_to_pool(message['user_id'], message['channel_name'])
 
     def unrequest_match(self, message):
-        print('unrequesting match')
+        logger.info('unrequesting match', extra={'event': 'matchmaking.unrequested', 'user_id': message['user_id']})
         self.matcher.remove_from_pool_if_exist(message['user_id'])
 
     def match_request_found(self, channel_name1, channel_name2, conversation_id, attendees):
         payload = {'type': 'receive_match', 'conversation_id': conversation_id, 'attendees': json.dumps(attendees)}
-        async_to_sync(self.channel_layer.send)(
-            channel_name1,
-            payload
-        )
-        async_to_sync(self.channel_layer.send)(
-            channel_name2,
-            payload
-        )
-        print(f'We found a match! {channel_name1} with {channel_name2} conversation id: {conversation_id}')
+        for channel_name in (channel_name1, channel_name2):
+            asyncio.run_coroutine_threadsafe(self.channel_layer.send(channel_name, payload), self._loop).result()
+        logger.info('match sent', extra={'event': 'matchmaking.match_sent', 'conversation_id': conversation_id})
+
+
+class AnnouncementsTask(QueryBudgetMixin, SyncConsumer):
+    query_budgets = {
+        'send_announcement': 2,
+        'record_deliveries': 3,
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the shard sends are scheduled on the worker event loop, the handler thread does not wait for them
+        self._loop = asyncio.get_event_loop()
+
+    def send_announcement(self, message):
+        try:
+            announcement = Announcement.objects.get(id=message['announcement_id'])
+        except Announcement.DoesNotExist:
+            logger.warning('announcement not found', extra={'event': 'announcements.not_found'})
+            return None
+
+        Announcement.objects.filter(id=announcement.id).update(sent_at=timezone.now())
+        content = {'type': 'chat.announcement', 'announcement_id': announcement.id, 'text': announcement.text}
+
+        return asyncio.run_coroutine_threadsafe(self._send_to_shards(content), self._loop)
+
+    async def _send_to_shards(self, content):
+        # a shard at a time, so the web processes get the fan-out in small bursts between their chat traffic
+        for shard in range(settings.BROADCAST_SHARDS):
+            if shard > 0:
+                await asyncio.sleep(settings.ANNOUNCEMENT_SHARD_INTERVAL_SECONDS)
+
+            await self.channel_layer.group_send(get_broadcast_group_name(shard), content)
+
+        logger.info('announcement sent', extra={'event': 'announcements.sent'})
+
+    def record_deliveries(self, message):
+        for announcement_id, count in message['deliveries']:
+            Announcement.objects.filter(id=announcement_id).update(delivered_count=F('delivered_count') + count)
@@ -1,3 +1,1572 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import datetime
+import gc
+import importlib
+import io
+import json
+import logging
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+import uuid
+from unittest import mock
+import jsonschema
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.db import DatabaseError
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from .announcements import DeliveryCounter, get_broadcast_group_name
+from .management.commands.bench_idle_connections import measure_idle_connections, open_idle_connection
+from .conversation_user_dictionary import ConversationUserDictionary
+from .drain import DrainController, get_drain_schedule
+from .enums import AuthorizationEnum, ErrorEnum
+from .match_maker import MatchMaker
+from .matchmaking_pool import InMemoryMatchmakingPool, RedisMatchmakingPool
+from .consumers import ChatConsumer, receipt_schema
+from .phrase_filter import AhoCorasickAutomaton, BannedPhraseFilter
+from .profiler import SamplingProfiler
+from .receipts import ReceiptBatcher
+from .recent_partners import RecentPartners
+from .models import Announcement, ChatUser, Conversation, ConversationArchive, ConversationReadState, Message
+from .query_budget import QueryBudgetExceeded, QueryRecorder, query_budget
+from .throttling import ChannelBacklogMonitor, TokenBucket
+from .typing import TypingDebouncer
+from .tasks import (
+    AnnouncementsTask,
+    ConversationManagerTask,
+    DBOperationsTask,
+    MatchmakingTask,
+    PushNotificationsTask,
+)
+from . import log, metrics, views
 
-# Create your tests here.
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def create_chat_user(username):
+    return ChatUser.objects.create(user=User.objects.create_user(username), name=username)
+
+
+def create_task(task_class):
+    task = task_class({'type': 'channel'})
+    task.channel_layer = get_channel_layer()
+    return task
+
+
+def receive(channel_name):
+    return async_to_sync(get_channel_layer().receive)(channel_name)
+
+
+@contextlib.contextmanager
+def run_worker_loop():
+    '''
+    an event loop on its own thread, standing in for the loop of the worker a task schedules its sends on.
+    the scheduled sends are finished before the loop stops
+    '''
+    async def wait_for_pending_tasks():
+        await asyncio.gather(*(asyncio.all_tasks() - {asyncio.current_task()}))
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        yield loop
+    finally:
+        asyncio.run_coroutine_threadsafe(wait_for_pending_tasks(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def get_reachable_redis_url():
+    import redis
+    redis_url = getattr(settings, 'REDIS_URL', None) or 'redis://localhost:6379'
+    try:
+        redis.StrictRedis.from_url(redis_url).ping()
+    except (redis.exceptions.ConnectionError, ValueError):
+        raise unittest.SkipTest(f'redis is not reachable at {redis_url}')
+
+    return redis_url
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class MessageAuthorizationFallbackTests(TestCase):
+    '''
+    the conversation manager has lost its roster (e.g. restarted), so db-operations-task falls back to the db
+    '''
+    def setUp(self):
+        self.lobby = Conversation.objects.create(id=ConversationUserDictionary.LOBBY_CONVERSATION_ID)
+        self.author = create_chat_user('author')
+        self.partner = create_chat_user('partner')
+        self.conversation = Conversation.create_conversation([self.author.id, self.partner.id])
+        self.task = create_task(DBOperationsTask)
+
+    def _create_message(self, conversation_id, author_id):
+        self.task.create_message({
+            'channel_name': 'author-channel',
+            'text': 'hello',
+            'conversation_id': conversation_id,
+            'author_id': author_id,
+            'seq': 1,
+            'authorization': AuthorizationEnum.UNKNOWN.value,
+        })
+        return receive('author-channel')
+
+    def test_lobby_message_is_allowed_and_roster_restored(self):
+        response = self._create_message(self.lobby.id, self.author.id)
+
+        self.assertEqual(response['error']['payload']['error_code'], ErrorEnum.OK.value)
+        self.assertTrue(Message.objects.filter(conversation=self.lobby, author=self.author).exists())
+        join_message = receive('conversation-manager-task')
+        self.assertEqual(join_message['type'], 'join_conversation')
+        self.assertEqual(join_message['conversation_id'], self.lobby.id)
+
+    def test_conversation_message_of_attendee_is_allowed_and_roster_restored(self):
+        response = self._create_message(self.conversation.id, self.author.id)
+
+        self.assertEqual(response['error']['payload']['error_code'], ErrorEnum.OK.value)
+        self.assertEqual(receive('conversation-manager-task')['conversation_id'], self.conversation.id)
+
+    def test_conversation_message_of_stranger_is_rejected(self):
+        stranger = create_chat_user('stranger')
+        response = self._create_message(self.conversation.id, stranger.id)
+
+        self.assertEqual(response['error']['payload']['error_code'], ErrorEnum.CONVERSATION_CLOSED.value)
+        self.assertFalse(Message.objects.filter(author=stranger).exists())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class MessageRoutingTests(TestCase):
+    def setUp(self):
+        self.author = create_chat_user('author')
+        self.conversation = Conversation.create_conversation([self.author.id, create_chat_user('partner').id])
+        self.task = create_task(DBOperationsTask)
+
+    def test_message_passes_through_the_conversation_manager_once(self):
+        channel_layer = get_channel_layer()
+        manager = create_task(ConversationManagerTask)
+        manager.join_conversation({'user_id': self.author.id, 'conversation_id': self.conversation.id})
+
+        async def send_message():
+            consumer = ChatConsumer({'type': 'websocket'})
+            consumer._cancel_timeouts()
+            consumer.channel_layer = channel_layer
+            consumer.channel_name = 'author-channel'
+            consumer._chat_user_id = self.author.id
+            consumer._conversation_id = self.conversation.id
+            await channel_layer.group_add(consumer.get_group_name(), 'partner-channel')
+            await consumer.process__send_message({'request_type': 'send_message', 'payload': {'text': 'hello'}, 'seq': 1})
+            return consumer
+
+        consumer = async_to_sync(send_message)()
+        manager.authorize_message(receive('conversation-manager-task'))
+        self.task.create_message(receive('db-operations-task'))
+        async_to_sync(consumer.create_message_response)(receive('author-channel'))
+
+        self.assertNotIn('conversation-manager-task', channel_layer.channels)
+        self.assertEqual(receive('partner-channel')['content']['payload']['text'], 'hello')
+
+
+@override_settings(REPEAT_MATCH_WAIT_SECONDS=120)
+class MatchMakerTests(TestCase):
+    def setUp(self):
+        self.users = [create_chat_user(username) for username in ('a', 'b', 'c', 'd')]
+        self.matches = []
+        self.pool = InMemoryMatchmakingPool()
+        # the matching rounds are run by the tests instead of the matchmaker thread
+        with mock.patch.object(MatchMaker, 'start_matchmaking'):
+            self.match_maker = MatchMaker(
+                lambda channel_name1, channel_name2, conversation_id, attendees: self.matches.append(set(attendees)),
+                self.pool
+            )
+
+    def _add_to_pool(self, chat_users, enqueue_time=None):
+        for chat_user in chat_users:
+            self.pool.add(chat_user.id, f'channel-{chat_user.id}', enqueue_time)
+
+    def test_recent_partners_are_not_matched_again(self):
+        a, b, c, d = self.users
+        Conversation.create_conversation([a.id, b.id])
+        self._add_to_pool(self.users)
+
+        self.match_maker.match_waiting_users()
+
+        self.assertNotIn({a.id, b.id}, self.matches)
+        self.assertEqual(len(self.pool.claim(MatchMaker.CLAIM_LIMIT)), 4 - 2 * len(self.matches))
+
+    def test_recent_partners_are_matched_after_waiting(self):
+        a, b, _, _ = self.users
+        Conversation.create_conversation([a.id, b.id])
+        self._add_to_pool([a, b], time.time() - 121)
+
+        self.match_maker.match_waiting_users()
+
+        self.assertEqual(self.matches, [{a.id, b.id}])
+
+    def test_matches_made_by_other_matchmakers_are_seen(self):
+        a, b, _, _ = self.users
+        self.match_maker.match_waiting_users()
+        self._add_to_pool([a])
+        self.match_maker.match_waiting_users()
+
+        # another matchmaker has paired them meanwhile
+        Conversation.create_conversation([a.id, b.id])
+        self._add_to_pool([b])
+        self.match_maker.match_waiting_users()
+
+        self.assertEqual(self.matches, [])
+        self.assertEqual({user_id for user_id, _, _ in self.pool.claim(MatchMaker.CLAIM_LIMIT)}, {a.id, b.id})
+
+    def test_claimed_users_are_released_when_loading_recent_partners_fails(self):
+        self._add_to_pool(self.users)
+
+        with mock.patch.object(Conversation, 'get_recent_partners', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.match_maker.match_waiting_users()
+
+        self.assertEqual(len(self.pool.claim(MatchMaker.CLAIM_LIMIT)), 4)
+
+
+class RecentPartnersTests(SimpleTestCase):
+    def test_only_the_latest_partners_are_kept(self):
+        recent_partners = RecentPartners(partners_per_user=2, max_entries=100)
+        recent_partners.load({1: [2, 3, 4]})
+
+        self.assertFalse(recent_partners.have_met(1, 4))
+        recent_partners.add_match(1, 5)
+        self.assertEqual([recent_partners.have_met(1, partner_id) for partner_id in (2, 3, 5)], [True, False, True])
+
+    def test_partners_of_users_that_were_not_loaded_are_not_kept(self):
+        recent_partners = RecentPartners(partners_per_user=2, max_entries=100)
+        recent_partners.load({1: []})
+        recent_partners.add_match(1, 2)
+
+        self.assertTrue(recent_partners.have_met(1, 2))
+        self.assertFalse(recent_partners.have_met(2, 1))
+
+    def test_least_recently_used_users_are_evicted(self):
+        # every user takes one entry and one more per partner
+        recent_partners = RecentPartners(partners_per_user=2, max_entries=4)
+        recent_partners.load({1: [10], 2: [20]})
+        recent_partners.have_met(1, 10)
+        recent_partners.load({3: [30]})
+
+        self.assertTrue(recent_partners.have_met(1, 10))
+        self.assertFalse(recent_partners.have_met(2, 20))
+        self.assertTrue(recent_partners.have_met(3, 30))
+
+
+class ActivityCountersTests(TestCase):
+    def setUp(self):
+        self.lobby = Conversation.objects.create(id=ConversationUserDictionary.LOBBY_CONVERSATION_ID)
+        self.author = create_chat_user('author')
+        self.conversation = Conversation.create_conversation([self.author.id])
+
+    def test_conversation_counters_are_updated(self):
+        message = Message.create_message(self.author.id, self.conversation.id, 'hello')
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 1)
+        self.assertEqual(self.conversation.last_message_time, message.time)
+
+    def test_lobby_counters_are_not_updated(self):
+        message = Message.create_message(self.author.id, self.lobby.id, 'hello')
+
+        self.lobby.refresh_from_db()
+        self.author.refresh_from_db()
+        self.assertEqual(self.lobby.message_count, 0)
+        self.assertEqual(self.author.message_count, 1)
+        self.assertEqual(self.author.last_message_time, message.time)
+
+    def test_created_at_backfill(self):
+        backfill_created_at = importlib.import_module(
+            'chat.migrations.0013_backfill_conversation_created_at'
+        ).backfill_created_at
+        migrated_at = timezone.now()
+        first_message_time = migrated_at - datetime.timedelta(days=3)
+        closed_at = migrated_at - datetime.timedelta(days=2)
+
+        Message.create_message(self.author.id, self.conversation.id, 'hello')
+        Message.objects.update(time=first_message_time)
+        archived_conversation = Conversation.create_conversation([self.author.id])
+        Conversation.objects.filter(id=archived_conversation.id).update(is_open=False, closed_at=closed_at)
+        new_conversation = Conversation.create_conversation([self.author.id])
+        Conversation.objects.exclude(id=new_conversation.id).update(created_at=migrated_at)
+
+        backfill_created_at(apps, None)
+
+        self.conversation.refresh_from_db()
+        archived_conversation.refresh_from_db()
+        self.assertEqual(self.conversation.created_at, first_message_time)
+        self.assertEqual(archived_conversation.created_at, closed_at)
+        self.assertEqual(archived_conversation.duration, datetime.timedelta(0))
+        self.assertEqual(Conversation.objects.get(id=new_conversation.id).created_at, new_conversation.created_at)
+
+
+class ReceiptsTests(TestCase):
+    def setUp(self):
+        self.reader = create_chat_user('reader')
+        self.author = create_chat_user('author')
+        self.conversation = Conversation.create_conversation([self.reader.id, self.author.id])
+        self.messages = [Message.create_message(self.author.id, self.conversation.id, 'hello') for _ in range(3)]
+
+    def _get_marks(self):
+        read_state = ConversationReadState.objects.get(conversation=self.conversation, chat_user=self.reader)
+        return read_state.delivered_up_to, read_state.seen_up_to
+
+    def test_schema_rejects_marks_beyond_message_ids(self):
+        jsonschema.validate({'seen_up_to': 2 ** 31 - 1}, receipt_schema)
+        with self.assertRaises(jsonschema.exceptions.ValidationError):
+            jsonschema.validate({'seen_up_to': 2 ** 31}, receipt_schema)
+
+    def test_marks_move_forward_only(self):
+        ConversationReadState.update_marks(self.conversation.id, self.reader.id, self.messages[2].id, self.messages[1].id)
+        ConversationReadState.update_marks(self.conversation.id, self.reader.id, self.messages[0].id, 0)
+
+        self.assertEqual(self._get_marks(), (self.messages[2].id, self.messages[1].id))
+
+    def test_marks_are_clamped_to_latest_message(self):
+        ConversationReadState.update_marks(self.conversation.id, self.reader.id, 2 ** 31 - 1, 2 ** 31 - 1)
+        self.assertEqual(self._get_marks(), (self.messages[2].id, self.messages[2].id))
+
+        new_message = Message.create_message(self.author.id, self.conversation.id, 'hello again')
+        ConversationReadState.update_marks(self.conversation.id, self.reader.id, new_message.id, 0)
+        self.assertEqual(self._get_marks(), (new_message.id, self.messages[2].id))
+
+    def test_update_receipts_query_budget(self):
+        task = create_task(DBOperationsTask)
+        content = {
+            'conversation_id': self.conversation.id,
+            'user_id': self.reader.id,
+            'delivered_up_to': self.messages[2].id,
+            'seen_up_to': self.messages[2].id
+        }
+        # the first receipt creates the row, the next ones are the latest message id and a single update
+        task.update_receipts(content)
+        with self.assertNumQueries(2):
+            task.update_receipts(content)
+
+    def test_batcher_coalesces_receipts_within_the_interval(self):
+        batcher = ReceiptBatcher(interval_seconds=1)
+
+        self.assertEqual(batcher.on_receipt(3, 0, now=0), (3, 0))
+        self.assertIsNone(batcher.on_receipt(5, 0, now=0.2))
+        # a seen message was delivered too, and marks never move back
+        self.assertIsNone(batcher.on_receipt(2, 7, now=0.5))
+        self.assertEqual(batcher.get_next_deadline(), 1)
+        self.assertEqual(batcher.poll(now=1), (7, 7))
+        self.assertIsNone(batcher.get_next_deadline())
+        self.assertIsNone(batcher.on_receipt(4, 4, now=3))
+
+    def test_batcher_flush_ignores_the_interval(self):
+        batcher = ReceiptBatcher(interval_seconds=1)
+        batcher.on_receipt(1, 1, now=0)
+        batcher.on_receipt(2, 0, now=0.1)
+
+        self.assertEqual(batcher.flush(), (2, 1))
+        self.assertIsNone(batcher.flush())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class MessageDeduplicationTests(TestCase):
+    def setUp(self):
+        self.author = create_chat_user('author')
+        self.partner = create_chat_user('partner')
+        self.conversations = [Conversation.create_conversation([self.author.id, self.partner.id]) for _ in range(2)]
+        self.task = create_task(DBOperationsTask)
+
+    def _create_message(self, task, conversation, client_message_id='client-1'):
+        task.create_message({
+            'channel_name': 'author-channel',
+            'text': 'hello',
+            'conversation_id': conversation.id,
+            'author_id': self.author.id,
+            'seq': 1,
+            'authorization': AuthorizationEnum.GRANTED.value,
+            'client_message_id': client_message_id,
+        })
+        return receive('author-channel')
+
+    def test_retry_is_answered_with_the_original_message(self):
+        original = self._create_message(self.task, self.conversations[0])
+        retry = self._create_message(self.task, self.conversations[0])
+
+        self.assertFalse(original['is_duplicate'])
+        self.assertTrue(retry['is_duplicate'])
+        self.assertEqual(retry['message'], original['message'])
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_retry_missed_by_the_cache_is_caught_by_the_constraint(self):
+        original = self._create_message(self.task, self.conversations[0])
+        # a restarted worker
+        retry = self._create_message(create_task(DBOperationsTask), self.conversations[0])
+
+        self.assertTrue(retry['is_duplicate'])
+        self.assertEqual(retry['message']['message_id'], original['message']['message_id'])
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_same_client_message_id_in_another_conversation_is_stored(self):
+        first = self._create_message(self.task, self.conversations[0])
+        second = self._create_message(self.task, self.conversations[1])
+        # the cache has forgotten both
+        third = self._create_message(create_task(DBOperationsTask), self.conversations[1])
+
+        self.assertFalse(second['is_duplicate'])
+        self.assertEqual(second['message']['conversation_id'], self.conversations[1].id)
+        self.assertNotEqual(second['message']['message_id'], first['message']['message_id'])
+        self.assertEqual(third['message']['message_id'], second['message']['message_id'])
+        self.assertEqual(Message.objects.count(), 2)
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.author = create_chat_user('author')
+        self.conversation = Conversation.create_conversation([self.author.id])
+        self.messages = [
+            Message.create_message(self.author.id, self.conversation.id, text)
+            for text in ('good morning', 'good night', 'see you')
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('moderator', is_staff=True))
+
+    def _search(self, **params):
+        response = self.client.get('/moderation/messages/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_search_returns_matching_messages_newest_first(self):
+        response = self._search(q='GOOD')
+
+        self.assertEqual([result['message_id'] for result in response['results']], [self.messages[1].id, self.messages[0].id])
+        self.assertIsNone(response['next_before'])
+
+    def test_search_pages_with_next_before(self):
+        first_page = self._search(q='good', limit=1)
+        second_page = self._search(q='good', limit=1, before=first_page['next_before'])
+
+        self.assertEqual([result['message_id'] for result in first_page['results']], [self.messages[1].id])
+        self.assertEqual([result['message_id'] for result in second_page['results']], [self.messages[0].id])
+
+    def test_negative_limit_is_clamped(self):
+        self.assertEqual(len(self._search(q='good', limit=-5)['results']), 1)
+
+    def test_search_requires_staff(self):
+        self.client.force_authenticate(self.author.user)
+        self.assertEqual(self.client.get('/moderation/messages/search/', {'q': 'good'}).status_code, 403)
+
+
+class UnregisteredError(Exception):
+    pass
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class PushNotificationsTests(TestCase):
+    def setUp(self):
+        self.task = create_task(PushNotificationsTask)
+        self.task.add_pn_listener({'channel_name': 'user-channel', 'token': 'token'})
+        self.messaging = mock.Mock(UnregisteredError=UnregisteredError)
+
+    def _send_pn_message(self):
+        self.task.send_pn_message({'channel_name': 'user-channel', 'title': 'title', 'body': 'body'})
+
+    def test_sent_notification_keeps_the_pn_channel(self):
+        with mock.patch.object(self.task, '_get_messaging', return_value=self.messaging):
+            self._send_pn_message()
+
+        self.messaging.send.assert_called_once()
+        self.assertEqual(self.messaging.Message.call_args[1]['token'], 'token')
+        self.assertNotIn('user-channel', self.task.channel_layer.channels)
+
+    def test_unregistered_token_removes_the_pn_channel(self):
+        self.messaging.send.side_effect = UnregisteredError
+        with mock.patch.object(self.task, '_get_messaging', return_value=self.messaging):
+            self._send_pn_message()
+
+        self.assertEqual(receive('user-channel'), {'type': 'pn_channel_removed'})
+        self.assertNotIn('user-channel', self.task._channel_name_to_token_dict)
+
+    def test_firebase_initialization_failure_is_a_failed_send(self):
+        failed_count = metrics.get_snapshot()['counters'].get('pn.failed', 0)
+        with mock.patch.object(self.task, '_get_messaging', side_effect=ValueError('no credentials')):
+            with self.assertLogs('chat.tasks', 'ERROR'):
+                self._send_pn_message()
+
+        self.assertEqual(receive('user-channel'), {'type': 'pn_channel_removed'})
+        self.assertEqual(metrics.get_snapshot()['counters']['pn.failed'], failed_count + 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, LAGGING_INBOX_MAX_MESSAGES=2)
+class LaggingInboxTests(SimpleTestCase):
+    '''
+    a consumer of user 1 whose channel already holds unhandled messages, writing through a fake asgi send
+    '''
+    def send_frames(self, unhandled_messages_count, conversation_id=10):
+        sent_messages = []
+
+        async def base_send(message):
+            sent_messages.append(json.loads(message['text'])['request_type'])
+
+        async def run():
+            consumer = ChatConsumer({'type': 'websocket'})
+            consumer.channel_layer = get_channel_layer()
+            consumer.channel_name = f'consumer-channel-{uuid.uuid4().hex}'
+            consumer.base_send = base_send
+            consumer._chat_user_id = 1
+            consumer._conversation_id = conversation_id
+            for _ in range(unhandled_messages_count):
+                await consumer.channel_layer.send(consumer.channel_name, {'type': 'chat.message'})
+
+            await consumer.chat_typing({'user_id': 2, 'is_typing': True})
+            await consumer.send_json({'request_type': 'leave', 'seq': 1, 'payload': {'user_id': 2}})
+            await consumer.send_error_message(ErrorEnum.OK)
+            consumer._authenticate_timeout_handle.cancel()
+            consumer._inactiveness_timeout_handle.cancel()
+
+        async_to_sync(run)()
+        return sent_messages
+
+    def test_every_frame_is_sent_while_the_consumer_keeps_up(self):
+        self.assertEqual(self.send_frames(2), ['typing', 'leave', 'error'])
+
+    def test_superseded_frames_are_skipped_while_the_consumer_lags(self):
+        dropped_count = metrics.get_snapshot()['counters'].get('lagging_inbox.frames_dropped', 0)
+
+        self.assertEqual(self.send_frames(3), ['leave', 'error'])
+        self.assertEqual(metrics.get_snapshot()['counters']['lagging_inbox.frames_dropped'], dropped_count + 1)
+
+    def test_lobby_join_and_leave_are_skipped_while_the_consumer_lags(self):
+        self.assertEqual(self.send_frames(3, ConversationUserDictionary.LOBBY_CONVERSATION_ID), ['error'])
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        metrics.increment('tests.counter')
+        metrics.observe('tests.observation', 3)
+
+    def test_staff_reads_the_process_metrics(self):
+        self.client.force_authenticate(User.objects.create_user('operator', is_staff=True))
+        response = self.client.get('/stats/metrics/').json()
+
+        self.assertGreaterEqual(response['counters']['tests.counter'], 1)
+        self.assertEqual(response['observations']['tests.observation']['max'], 3)
+
+    def test_metrics_require_staff(self):
+        self.client.force_authenticate(User.objects.create_user('user'))
+        self.assertEqual(self.client.get('/stats/metrics/').status_code, 403)
+
+    def test_snapshot_is_logged_as_json(self):
+        with self.assertLogs('chat.log', 'INFO') as logs:
+            log.report_metrics()
+
+        entry = json.loads(log.JsonFormatter().format(logs.records[0]))
+        self.assertEqual(entry['event'], 'metrics.snapshot')
+        self.assertGreaterEqual(entry['metrics']['counters']['tests.counter'], 1)
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    MATCHMAKING_POOL_BACKEND='memory',
+    ANNOUNCEMENT_SHARD_INTERVAL_SECONDS=0
+)
+class QueryBudgetTests(TestCase):
+    '''
+    every worker task handler runs its busiest path within the budget it declares
+    '''
+    def setUp(self):
+        self.lobby = Conversation.objects.create(id=ConversationUserDictionary.LOBBY_CONVERSATION_ID)
+        self.users = [create_chat_user(username) for username in ('a', 'b', 'c')]
+        self.conversation = Conversation.create_conversation([self.users[0].id, self.users[1].id])
+
+    def _run_within_budget(self, task, handler_name, content):
+        with query_budget(type(task).query_budgets[handler_name]) as recorder:
+            getattr(task, handler_name)(dict(content, type=handler_name))
+
+        return recorder.queries_count
+
+    def test_conversation_manager_task(self):
+        task = create_task(ConversationManagerTask)
+        for chat_user in self.users:
+            self._run_within_budget(task, 'request_lobby_attendees_list', {'channel_name': 'user-channel', 'user_id': chat_user.id})
+            self._run_within_budget(task, 'join_conversation', {'user_id': chat_user.id, 'conversation_id': self.lobby.id, 'lobby_room_id': 1})
+
+        for chat_user in self.users[:2]:
+            self._run_within_budget(task, 'join_conversation', {'user_id': chat_user.id, 'conversation_id': self.conversation.id})
+
+        message = {'channel_name': 'user-channel', 'text': 'hello', 'author_id': self.users[0].id, 'conversation_id': self.conversation.id, 'seq': 1}
+        self.assertEqual(self._run_within_budget(task, 'authorize_message', message), 0)
+        self.assertEqual(self._run_within_budget(task, 'broadcast_message_to_conversation', {'user_id': self.users[0].id, 'message': {}}), 0)
+
+        self._run_within_budget(task, 'leave_conversation', {'user_id': self.users[0].id, 'conversation_id': self.conversation.id})
+        self._run_within_budget(task, 'user_disconnect', {'user_id': self.users[2].id})
+        self.conversation.refresh_from_db()
+        self.assertFalse(self.conversation.is_open)
+
+    def test_db_operations_task(self):
+        task = create_task(DBOperationsTask)
+        token = Token.objects.create(user=self.users[0].user)
+        self._run_within_budget(task, 'authenticate', {'channel_name': 'user-channel', 'access_token': token.key, 'seq': 1})
+
+        message = {
+            'channel_name': 'user-channel',
+            'text': 'hello',
+            'conversation_id': self.conversation.id,
+            'author_id': self.users[0].id,
+            'seq': 2,
+            'client_message_id': 'client-1',
+        }
+        for authorization in (AuthorizationEnum.UNKNOWN, AuthorizationEnum.GRANTED):
+            self._run_within_budget(task, 'create_message', dict(message, authorization=authorization.value))
+        # a retry the cache has missed
+        self._run_within_budget(create_task(DBOperationsTask), 'create_message', dict(message, authorization=AuthorizationEnum.GRANTED.value))
+
+        receipt = {'conversation_id': self.conversation.id, 'user_id': self.users[1].id, 'delivered_up_to': 1, 'seen_up_to': 1}
+        for _ in range(2):
+            self._run_within_budget(task, 'update_receipts', receipt)
+
+    def test_push_notifications_task(self):
+        task = create_task(PushNotificationsTask)
+        self._run_within_budget(task, 'add_pn_listener', {'channel_name': 'user-channel', 'token': 'token'})
+        with mock.patch.object(task, '_get_messaging', return_value=mock.Mock()):
+            self._run_within_budget(task, 'send_pn_message', {'channel_name': 'user-channel', 'title': 'title', 'body': 'body'})
+        self._run_within_budget(task, 'remove_pn_listener', {'channel_name': 'user-channel'})
+
+    def test_matchmaking_task(self):
+        with mock.patch.object(MatchMaker, 'start_matchmaking'):
+            task = create_task(MatchmakingTask)
+
+        for channel_name in ('user-channel', 'new-user-channel'):
+            self._run_within_budget(task, 'request_match', {'user_id': self.users[0].id, 'channel_name': channel_name})
+        self._run_within_budget(task, 'unrequest_match', {'user_id': self.users[0].id})
+
+    def test_announcements_task(self):
+        task = create_task(AnnouncementsTask)
+        announcements = [Announcement.objects.create(text=text) for text in ('first', 'second')]
+
+        with run_worker_loop() as loop, mock.patch.object(task.channel_layer, 'group_send'):
+            task._loop = loop
+            self._run_within_budget(task, 'send_announcement', {'announcement_id': announcements[0].id})
+        self._run_within_budget(task, 'record_deliveries', {'deliveries': [[announcements[0].id, 3]]})
+        self.assertEqual(Announcement.objects.get(id=announcements[0].id).delivered_count, 3)
+
+    def test_transaction_statements_are_not_counted(self):
+        # the insert and the two counter updates, atomic() is a savepoint inside the test case
+        with self.assertNumQueries(5):
+            with query_budget(3) as recorder:
+                Message.create_message(self.users[0].id, self.conversation.id, 'hello')
+
+        self.assertEqual(recorder.queries_count, 3)
+
+    @override_settings(QUERY_BUDGET_STRICT=True)
+    def test_over_budget_handler_is_reported(self):
+        task = create_task(DBOperationsTask)
+        recorder = QueryRecorder()
+        recorder.queries_count = DBOperationsTask.query_budgets['authenticate'] + 1
+        over_budget_count = metrics.get_snapshot()['counters'].get('db.DBOperationsTask.authenticate.over_budget', 0)
+
+        with self.assertRaises(QueryBudgetExceeded):
+            task._report_queries('authenticate', recorder)
+
+        self.assertEqual(
+            metrics.get_snapshot()['counters']['db.DBOperationsTask.authenticate.over_budget'],
+            over_budget_count + 1
+        )
+
+
+@override_settings(DRAIN_ON_SIGTERM=False, SHEDDING_BACKLOG_THRESHOLD=0)
+class IdleConnectionMemoryTests(SimpleTestCase):
+    CONNECTIONS_COUNT = 100
+    # a connection opened through the websocket protocol, authenticated and in the broadcast group and a lobby room.
+    # about 18.5KB on python 3.11, most of it the asyncio queues of the consumer, its channel and the server side
+    MAX_BYTES_PER_CONNECTION = 24576
+
+    def test_idle_connection_memory(self):
+        with mock.patch.object(ChatConsumer, '_drain_controller', None):
+            bytes_per_connection = async_to_sync(measure_idle_connections)(IdleConnectionMemoryTests.CONNECTIONS_COUNT)
+            self.assertEqual(len(ChatConsumer.get_drain_controller()._consumers), 0)
+
+        self.assertLess(bytes_per_connection, IdleConnectionMemoryTests.MAX_BYTES_PER_CONNECTION)
+
+    def _open_connection(self, index):
+        consumer = ChatConsumer({'type': 'websocket', 'path': '/chat', 'headers': [], 'subprotocols': []})
+        consumer.channel_name = f'specific.0123456789abcdef!{index:012d}'
+        consumer.set_authenticated(index + 1, f'user {index}')
+        return consumer
+
+    def test_features_are_created_on_first_use(self):
+        async def use_rate_limits():
+            consumer = self._open_connection(0)
+            consumer._cancel_timeouts()
+            self.assertIsNone(consumer._typing_debouncer)
+
+            consumer._typing_poll_handle = None
+            self.assertIsNone(consumer._features)
+
+            consumer._rate_limit_buckets = {}
+            return consumer
+
+        consumer = async_to_sync(use_rate_limits)()
+        self.assertEqual(consumer._features.rate_limit_buckets, {})
+        self.assertIsNone(consumer._features.receipt_batcher)
+
+
+class MatchmakingPoolTestsMixin:
+    '''
+    the behaviour both pools share, the subclasses create the pool
+    '''
+    def create_pool(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.pool = self.create_pool()
+
+    def test_claim_returns_the_longest_waiting_users_once(self):
+        for user_id, enqueue_time in ((1, 30.5), (2, 10.5), (3, 20.5)):
+            self.pool.add(user_id, f'channel-{user_id}', enqueue_time)
+
+        self.assertEqual(self.pool.claim(2), [(2, 'channel-2', 10.5), (3, 'channel-3', 20.5)])
+        self.assertEqual(self.pool.claim(10), [(1, 'channel-1', 30.5)])
+        self.assertEqual(self.pool.claim(10), [])
+        self.assertIsNone(self.pool.get_channel(1))
+
+    def test_release_puts_back_claimed_users(self):
+        self.pool.add(1, 'channel-1', 10.5)
+        self.pool.add(2, 'channel-2', 20.5)
+        claimed = self.pool.claim(10)
+
+        self.pool.release(claimed)
+
+        self.assertEqual(self.pool.get_channel(1), 'channel-1')
+        self.assertEqual(self.pool.claim(10), claimed)
+
+    def test_release_keeps_a_newer_request_of_the_user(self):
+        self.pool.add(1, 'old-channel', 10.5)
+        claimed = self.pool.claim(10)
+        self.pool.add(1, 'new-channel', 40.5)
+
+        self.pool.release(claimed)
+
+        self.assertEqual(self.pool.claim(10), [(1, 'new-channel', 40.5)])
+
+    def test_removed_user_is_not_claimed(self):
+        self.pool.add(1, 'channel-1', 10.5)
+        self.pool.add(2, 'channel-2', 20.5)
+
+        self.pool.remove(1)
+        self.pool.remove(3)
+
+        self.assertIsNone(self.pool.get_channel(1))
+        self.assertEqual(self.pool.claim(10), [(2, 'channel-2', 20.5)])
+
+    def test_concurrent_claims_never_share_a_user(self):
+        users_count = 500
+        for user_id in range(1, users_count + 1):
+            self.pool.add(user_id, f'channel-{user_id}', float(user_id))
+
+        claimed_user_ids = []
+        claimed_lock = threading.Lock()
+
+        def claim_until_empty(pool):
+            while True:
+                entries = pool.claim(7)
+                if len(entries) == 0:
+                    return
+
+                with claimed_lock:
+                    claimed_user_ids.extend(user_id for user_id, _, _ in entries)
+
+        threads = [threading.Thread(target=claim_until_empty, args=(self.create_pool(),)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(claimed_user_ids), list(range(1, users_count + 1)))
+
+
+class InMemoryMatchmakingPoolTests(MatchmakingPoolTestsMixin, SimpleTestCase):
+    def setUp(self):
+        self._pool = InMemoryMatchmakingPool()
+        super().setUp()
+
+    # every claiming thread shares the process pool
+    def create_pool(self):
+        return self._pool
+
+
+class RedisMatchmakingPoolTests(MatchmakingPoolTestsMixin, SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.redis_url = get_reachable_redis_url()
+
+    def setUp(self):
+        self.key_prefix = f'tests-matchmaking-{uuid.uuid4().hex}'
+        super().setUp()
+
+    def tearDown(self):
+        import redis
+        redis.StrictRedis.from_url(self.redis_url).delete(f'{self.key_prefix}:users', f'{self.key_prefix}:channels')
+
+    # a client per claiming thread, like separate matchmaking workers
+    def create_pool(self):
+        import redis
+        return RedisMatchmakingPool(redis.StrictRedis.from_url(self.redis_url), self.key_prefix)
+
+
+class ReconnectStormModelTests(SimpleTestCase):
+    def test_drain_schedule_spreads_the_waves_over_the_duration(self):
+        schedule = get_drain_schedule(100, 4, 20, 1, 30)
+
+        self.assertEqual(len(schedule), 100)
+        self.assertEqual(sorted({close_delay_seconds for close_delay_seconds, _ in schedule}), [0, 5, 10, 15])
+        self.assertTrue(all(1 <= backoff_seconds <= 30 for _, backoff_seconds in schedule))
+
+    def test_drain_schedule_has_no_more_waves_than_connections(self):
+        schedule = get_drain_schedule(2, 10, 20, 1, 1)
+
+        self.assertEqual([close_delay_seconds for close_delay_seconds, _ in schedule], [0, 10])
+
+    def test_draining_lowers_the_modelled_peak(self):
+        output = io.StringIO()
+        call_command('model_reconnect_storm', connections=5000, stdout=output)
+
+        without_drain, with_drain = (int(peak) for peak in re.findall(r'peak (\d+) authentications/s', output.getvalue()))
+        self.assertLess(with_drain, without_drain)
+
+
+class TypingTrafficModelTests(SimpleTestCase):
+    def test_debouncer_sends_at_most_one_change_per_interval(self):
+        debouncer = TypingDebouncer(interval_seconds=2, idle_timeout_seconds=6)
+
+        self.assertTrue(debouncer.on_typing(True, now=0))
+        self.assertIsNone(debouncer.on_typing(True, now=0.5))
+        self.assertIsNone(debouncer.on_typing(False, now=1))
+        self.assertEqual(debouncer.get_next_deadline(), 2)
+        self.assertFalse(debouncer.poll(now=2))
+        self.assertIsNone(debouncer.get_next_deadline())
+
+    def test_debouncer_stops_typing_after_the_idle_timeout(self):
+        debouncer = TypingDebouncer(interval_seconds=2, idle_timeout_seconds=6)
+        debouncer.on_typing(True, now=0)
+
+        self.assertEqual(debouncer.get_next_deadline(), 6)
+        self.assertIsNone(debouncer.poll(now=5))
+        self.assertFalse(debouncer.poll(now=6))
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+    def test_consumer_relays_debounced_typing_inside_conversations_only(self):
+        async def run(conversation_id):
+            consumer = ChatConsumer({'type': 'websocket'})
+            consumer.channel_layer = get_channel_layer()
+            consumer._chat_user_id = 1
+            consumer._conversation_id = conversation_id
+            with mock.patch.object(consumer.channel_layer, 'group_send') as group_send:
+                for is_typing in (True, True, False):
+                    await consumer.process__typing({'payload': {'is_typing': is_typing}})
+
+            consumer._reset_typing()
+            consumer._authenticate_timeout_handle.cancel()
+            consumer._inactiveness_timeout_handle.cancel()
+            return [call[0][1] for call in group_send.call_args_list]
+
+        self.assertEqual(async_to_sync(run)(ConversationUserDictionary.LOBBY_CONVERSATION_ID), [])
+        self.assertEqual(async_to_sync(run)(10), [{'type': 'chat.typing', 'user_id': 1, 'is_typing': True}])
+
+    def test_debouncing_lowers_the_modelled_traffic(self):
+        output = io.StringIO()
+        call_command('model_typing_traffic', minutes=5, stdout=output)
+
+        naive, debounced = (
+            int(messages) for messages in re.findall(r': (\d+) channel layer messages/min', output.getvalue())
+        )
+        self.assertLess(debounced, naive)
+
+
+class BannedPhraseFilterTests(SimpleTestCase):
+    def setUp(self):
+        phrases_file = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False, encoding='utf-8')
+        phrases_file.write('# comment\nass\nרע\n')
+        phrases_file.close()
+        self.path = phrases_file.name
+        self.addCleanup(os.remove, self.path)
+
+    def filter(self, phrase_filter, text):
+        return async_to_sync(phrase_filter.filter)(text)
+
+    def test_phrases_match_whole_words_only(self):
+        phrase_filter = BannedPhraseFilter(self.path, BannedPhraseFilter.POLICY_MASK, 30)
+
+        self.assertEqual(self.filter(phrase_filter, 'a class assignment'), (False, 'a class assignment'))
+        self.assertEqual(self.filter(phrase_filter, 'ASS! ass_ass'), (False, '***! ass_ass'))
+        self.assertEqual(self.filter(phrase_filter, 'רע מרע'), (False, '** מרע'))
+
+    def test_a_shorter_whole_word_phrase_matches_inside_a_longer_partial_one(self):
+        automaton = AhoCorasickAutomaton(['ab c', 'c'])
+
+        self.assertEqual(list(automaton.find_spans('xab c')), [(4, 5)])
+        self.assertEqual(list(automaton.find_spans('ab c')), [(0, 4)])
+
+    def test_reject_policy(self):
+        phrase_filter = BannedPhraseFilter(self.path, BannedPhraseFilter.POLICY_REJECT, 30)
+
+        self.assertEqual(self.filter(phrase_filter, 'you ass'), (True, 'you ass'))
+        self.assertEqual(self.filter(phrase_filter, 'glass'), (False, 'glass'))
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+    def test_consumer_rejects_a_banned_message_before_it_is_sent_on(self):
+        consumer = ChatConsumer({'type': 'websocket'})
+        consumer.channel_layer = get_channel_layer()
+        consumer._conversation_id = 1
+        phrase_filter = BannedPhraseFilter(self.path, BannedPhraseFilter.POLICY_REJECT, 30)
+
+        with mock.patch.object(ChatConsumer, '_banned_phrase_filter', phrase_filter), \
+                mock.patch.object(consumer, 'send_error_message') as send_error_message, \
+                mock.patch.object(consumer.channel_layer, 'send') as send:
+            async_to_sync(consumer.process__send_message)({'seq': 7, 'payload': {'text': 'you ass'}})
+
+        send_error_message.assert_called_once_with(ErrorEnum.MESSAGE_REJECTED, mock.ANY, 7)
+        send.assert_not_called()
+
+    def test_the_automaton_is_built_off_the_event_loop(self):
+        phrase_filter = BannedPhraseFilter(self.path, BannedPhraseFilter.POLICY_MASK, 30)
+        build_threads = []
+
+        def build(phrases):
+            build_threads.append(threading.get_ident())
+            return AhoCorasickAutomaton(phrases)
+
+        async def run():
+            with mock.patch('chat.phrase_filter.AhoCorasickAutomaton', side_effect=build):
+                result = await phrase_filter.filter('ass')
+
+            self.assertNotIn(threading.get_ident(), build_threads)
+            return result
+
+        self.assertEqual(async_to_sync(run)(), (False, '***'))
+        self.assertEqual(len(build_threads), 1)
+
+    def test_a_reload_keeps_the_previous_phrases_until_it_is_done(self):
+        phrase_filter = BannedPhraseFilter(self.path, BannedPhraseFilter.POLICY_MASK, 0)
+        is_build_allowed = threading.Event()
+
+        def build(phrases):
+            is_build_allowed.wait(5)
+            return AhoCorasickAutomaton(phrases)
+
+        async def run():
+            self.assertEqual(await phrase_filter.filter('ass and bad'), (False, '*** and bad'))
+
+            with open(self.path, 'w', encoding='utf-8') as phrases_file:
+                phrases_file.write('bad\n')
+            os.utime(self.path, (time.time() + 10, time.time() + 10))
+
+            with mock.patch('chat.phrase_filter.AhoCorasickAutomaton', side_effect=build):
+                self.assertEqual(await phrase_filter.filter('ass and bad'), (False, '*** and bad'))
+                is_build_allowed.set()
+                await asyncio.shield(phrase_filter._reload_future)
+
+            return await phrase_filter.filter('ass and bad')
+
+        self.assertEqual(async_to_sync(run)(), (False, 'ass and ***'))
+
+
+class LobbyRoomsTests(SimpleTestCase):
+    LOBBY_CONVERSATION_ID = ConversationUserDictionary.LOBBY_CONVERSATION_ID
+
+    def setUp(self):
+        self.dictionary = ConversationUserDictionary(lobby_room_max_size=2)
+
+    def join_lobby(self, *user_ids):
+        for user_id in user_ids:
+            self.dictionary.leave_any_previous_conversations_and_join(user_id, self.LOBBY_CONVERSATION_ID)
+
+    def test_rooms_are_bounded_and_filled_least_full_first(self):
+        self.join_lobby(1, 2, 3)
+
+        self.assertEqual(self.dictionary.get_lobby_room_attendees(1), {1, 2})
+        self.assertEqual(self.dictionary.get_lobby_room_attendees(2), {3})
+
+        self.dictionary.user_disconnect(1)
+        self.join_lobby(4, 5)
+
+        self.assertEqual(self.dictionary.get_lobby_room_attendees(1), {2, 4})
+        self.assertEqual(self.dictionary.get_lobby_room_attendees(2), {3, 5})
+        self.assertIsNone(self.dictionary.get_user_lobby_room(1))
+
+    def test_joining_a_conversation_leaves_the_lobby_room(self):
+        self.join_lobby(1, 2)
+        self.dictionary.leave_any_previous_conversations_and_join(1, 10)
+        self.dictionary.leave_any_previous_conversations_and_join(2, 10)
+
+        self.assertIsNone(self.dictionary.get_user_lobby_room(1))
+        self.assertEqual(self.dictionary.get_lobby_room_attendees(1), set())
+        self.assertEqual(self.dictionary.get_conversation_attendees(self.LOBBY_CONVERSATION_ID), set())
+        self.assertEqual(self.dictionary.get_conversation_attendees(10), {1, 2})
+
+    def test_a_reserved_room_is_kept_when_joining_the_lobby(self):
+        lobby_room_id = self.dictionary.assign_lobby_room(1)
+        self.join_lobby(2, 3)
+        self.dictionary.leave_any_previous_conversations_and_join(1, self.LOBBY_CONVERSATION_ID, lobby_room_id)
+
+        self.assertEqual(self.dictionary.get_user_lobby_room(1), lobby_room_id)
+        self.assertEqual(self.dictionary.get_lobby_room_attendees(lobby_room_id), {1, 2})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ThrottlingTests(SimpleTestCase):
+    def test_token_bucket_allows_a_burst_and_refills_at_its_rate(self):
+        with mock.patch('chat.throttling.time.monotonic', return_value=100):
+            bucket = TokenBucket(rate=2, capacity=3)
+            self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+        with mock.patch('chat.throttling.time.monotonic', return_value=101):
+            self.assertEqual([bucket.consume() for _ in range(3)], [True, True, False])
+
+        with mock.patch('chat.throttling.time.monotonic', return_value=1000):
+            self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+    def assert_backlog_monitor_reports_the_longest_worker_channel(self, channel_layer):
+        monitor = ChannelBacklogMonitor(channel_layer, ['first-task', 'second-task'], threshold=2, interval_seconds=60)
+
+        async def run():
+            for _ in range(3):
+                await channel_layer.send('second-task', {'type': 'work'})
+            await channel_layer.send('first-task', {'type': 'work'})
+
+            backlog = await monitor.get_backlog()
+            self.assertFalse(monitor.is_overloaded())
+            # the sampler makes its own round trips to redis
+            for _ in range(50):
+                await asyncio.sleep(0.01)
+                if monitor.is_overloaded():
+                    break
+
+            is_overloaded = monitor.is_overloaded()
+            monitor._sampling_task.cancel()
+            return backlog, is_overloaded
+
+        with mock.patch('chat.throttling.logger') as throttling_logger:
+            self.assertEqual(async_to_sync(run)(), (3, True))
+
+        # a failing sample is only logged, and would keep the monitor from ever shedding
+        throttling_logger.exception.assert_not_called()
+
+    def test_backlog_monitor_reports_the_longest_worker_channel(self):
+        self.assert_backlog_monitor_reports_the_longest_worker_channel(get_channel_layer())
+
+    def test_backlog_monitor_reports_the_longest_redis_channel(self):
+        from channels_redis.core import RedisChannelLayer
+        channel_layer = RedisChannelLayer(hosts=[get_reachable_redis_url()], prefix=f'tests-backlog-{uuid.uuid4().hex}')
+
+        async def flush():
+            await channel_layer.flush()
+            await channel_layer.close_pools()
+
+        self.addCleanup(async_to_sync(flush))
+        self.assert_backlog_monitor_reports_the_longest_worker_channel(channel_layer)
+
+    def test_consumer_rate_limits_each_request_type(self):
+        consumer = ChatConsumer({'type': 'websocket'})
+
+        async def run():
+            allowed = [await consumer.is_request_allowed({'request_type': 'authenticate', 'seq': seq}) for seq in range(4)]
+            allowed.append(await consumer.is_request_allowed({'request_type': 'send_message', 'seq': 4}))
+            return allowed
+
+        with mock.patch.object(consumer, 'send_error_message') as send_error_message:
+            self.assertEqual(async_to_sync(run)(), [True, True, True, False, True])
+
+        send_error_message.assert_called_once_with(ErrorEnum.RATE_LIMITED, mock.ANY, 3)
+
+    def test_consumer_sheds_non_critical_requests_while_overloaded(self):
+        consumer = ChatConsumer({'type': 'websocket'})
+        consumer.channel_layer = get_channel_layer()
+        monitor = mock.Mock(**{'is_overloaded.return_value': True})
+
+        async def run():
+            return (
+                await consumer.is_request_allowed({'request_type': 'request_match', 'seq': 1}),
+                await consumer.is_request_allowed({'request_type': 'send_message', 'seq': 2}),
+            )
+
+        with mock.patch.object(ChatConsumer, '_backlog_monitor', monitor), \
+                mock.patch.object(consumer, 'send_error_message') as send_error_message:
+            self.assertEqual(async_to_sync(run)(), (False, True))
+
+        send_error_message.assert_called_once_with(ErrorEnum.SERVER_BUSY, mock.ANY, 1)
+
+
+class DrainedConsumer:
+    def __init__(self, closes):
+        self._closes = closes
+
+    async def send_reconnect_and_close(self, backoff_seconds):
+        self._closes.append((self, time.monotonic(), backoff_seconds))
+
+
+class DrainControllerTests(SimpleTestCase):
+    def test_connections_are_closed_in_waves_with_a_backoff(self):
+        controller = DrainController(waves=2, duration_seconds=0.2, min_backoff_seconds=1, max_backoff_seconds=3)
+        closes = []
+        consumers = [DrainedConsumer(closes) for _ in range(4)]
+        for consumer in consumers:
+            controller.register(consumer)
+
+        async def run():
+            start = time.monotonic()
+            await controller.drain()
+            return start
+
+        start = async_to_sync(run)()
+
+        self.assertTrue(controller.is_draining)
+        self.assertCountEqual([consumer for consumer, _, _ in closes], consumers)
+        close_delays = sorted(close_time - start for _, close_time, _ in closes)
+        self.assertLess(close_delays[1], 0.1)
+        self.assertGreaterEqual(close_delays[2], 0.1)
+        self.assertTrue(all(1 <= backoff_seconds <= 3 for _, _, backoff_seconds in closes))
+
+    def test_a_connection_closed_before_its_wave_is_skipped(self):
+        controller = DrainController(waves=2, duration_seconds=0.1, min_backoff_seconds=1, max_backoff_seconds=1)
+        closes = []
+        consumers = [DrainedConsumer(closes) for _ in range(2)]
+        for consumer in consumers:
+            controller.register(consumer)
+
+        async def run():
+            drain_task = asyncio.ensure_future(controller.drain())
+            await asyncio.sleep(0.01)
+            for consumer in consumers:
+                controller.unregister(consumer)
+
+            await drain_task
+            # draining again does nothing
+            await controller.drain()
+
+        async_to_sync(run)()
+        self.assertEqual(len(closes), 1)
+
+    @override_settings(
+        CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+        DRAIN_ON_SIGTERM=False,
+        DRAIN_WAVES=4,
+        DRAIN_DURATION_SECONDS=0.4,
+        RECONNECT_MIN_BACKOFF_SECONDS=0.05,
+        RECONNECT_MAX_BACKOFF_SECONDS=0.2,
+        SHEDDING_BACKLOG_THRESHOLD=0
+    )
+    def test_drained_clients_reconnect_in_waves(self):
+        '''
+        authenticated connections are drained, each client reconnects to a new process after the backoff it was sent
+        '''
+        connections_count = 20
+
+        class NewProcessConsumer(ChatConsumer):
+            _drain_controller = None
+
+        async def reconnect(communicator):
+            reconnect_message = await communicator.receive_json_from(timeout=2)
+            self.assertEqual((await communicator.receive_output(timeout=2))['type'], 'websocket.close')
+            await communicator.disconnect()
+            await asyncio.sleep(reconnect_message['payload']['backoff_ms'] / 1000)
+
+            new_communicator = WebsocketCommunicator(NewProcessConsumer, '/chat')
+            await new_communicator.connect()
+            await new_communicator.send_json_to({'request_type': 'authenticate', 'seq': 1, 'payload': {'access_token': 'token'}})
+            return new_communicator
+
+        async def receive_authentications(channel_layer, drain_start):
+            authentication_times = []
+            for _ in range(connections_count):
+                await channel_layer.receive('db-operations-task')
+                authentication_times.append(asyncio.get_event_loop().time() - drain_start)
+
+            return authentication_times
+
+        async def run():
+            channel_layer = get_channel_layer()
+            communicators = [WebsocketCommunicator(ChatConsumer, '/chat') for _ in range(connections_count)]
+            for index, communicator in enumerate(communicators):
+                await open_idle_connection(communicator, channel_layer, index)
+
+            drain_start = asyncio.get_event_loop().time()
+            drain_task = asyncio.ensure_future(ChatConsumer.get_drain_controller().drain())
+            authentications_task = asyncio.ensure_future(receive_authentications(channel_layer, drain_start))
+            new_communicators = await asyncio.gather(*(reconnect(communicator) for communicator in communicators))
+            await drain_task
+
+            authentication_times = await asyncio.wait_for(authentications_task, timeout=2)
+            for new_communicator in new_communicators:
+                await new_communicator.disconnect()
+
+            return authentication_times
+
+        with mock.patch.object(ChatConsumer, '_drain_controller', None):
+            authentication_times = async_to_sync(run)()
+
+        self.assertEqual(len(authentication_times), connections_count)
+        # nobody reconnects before the minimal backoff, the last wave is closed 0.3 seconds into the drain
+        self.assertGreaterEqual(min(authentication_times), 0.05)
+        self.assertGreaterEqual(max(authentication_times), 0.35)
+
+
+class ConversationArchiveTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.author = create_chat_user('author')
+        self.partner = create_chat_user('partner')
+        self.old_conversation = Conversation.create_conversation([self.author.id, self.partner.id])
+        self.recent_conversation = Conversation.create_conversation([self.author.id, self.partner.id])
+        for conversation in (self.old_conversation, self.recent_conversation):
+            Message.create_message(self.author.id, conversation.id, 'hello')
+            Message.create_message(self.partner.id, conversation.id, 'שלום')
+            Conversation.close(conversation.id)
+
+        Conversation.objects.filter(id=self.old_conversation.id).update(
+            closed_at=timezone.now() - datetime.timedelta(days=40)
+        )
+
+    def get_history(self, user, conversation_id):
+        self.client.force_authenticate(user)
+        return self.client.get(f'/conversations/{conversation_id}/history/')
+
+    @staticmethod
+    def get_texts(response):
+        return [(message['message_id'], message['author_id'], message['text']) for message in response.json()['messages']]
+
+    def test_only_long_closed_conversations_are_archived(self):
+        history_before = self.get_texts(self.get_history(self.author.user, self.old_conversation.id))
+
+        call_command('archive_messages', days=30, sleep_seconds=0, stdout=io.StringIO())
+
+        self.assertEqual(ConversationArchive.objects.get().conversation_id, self.old_conversation.id)
+        self.assertFalse(Message.objects.filter(conversation=self.old_conversation).exists())
+        self.assertEqual(Message.objects.filter(conversation=self.recent_conversation).count(), 2)
+        self.assertEqual(self.get_texts(self.get_history(self.partner.user, self.old_conversation.id)), history_before)
+
+    def test_a_large_conversation_is_split_across_batches(self):
+        for text in ('how are you', 'fine', 'bye'):
+            Message.create_message(self.author.id, self.old_conversation.id, text)
+        history_before = self.get_texts(self.get_history(self.author.user, self.old_conversation.id))
+        closed_before = timezone.now() - datetime.timedelta(days=30)
+
+        batch_counts = [ConversationArchive.archive_closed_conversations(closed_before, 2) for _ in range(4)]
+
+        self.assertEqual(batch_counts, [2, 2, 1, 0])
+        archive = ConversationArchive.objects.get()
+        self.assertEqual(archive.messages_count, 5)
+        self.assertEqual(archive.chunks.count(), 3)
+        self.assertEqual(self.get_texts(self.get_history(self.author.user, self.old_conversation.id)), history_before)
+
+    def test_history_is_only_readable_by_attendees_and_staff(self):
+        stranger = create_chat_user('stranger')
+        stranger_response = self.get_history(stranger.user, self.old_conversation.id)
+        staff_response = self.get_history(
+            User.objects.create_user('operator', is_staff=True),
+            self.old_conversation.id
+        )
+
+        self.assertEqual(stranger_response.status_code, 403)
+        self.assertEqual(len(staff_response.json()['messages']), 2)
+
+
+class ProvisionUsersTests(TestCase):
+    def test_users_are_created_in_chunks_with_working_tokens(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'tokens.csv')
+            call_command(
+                'provision_users',
+                count=5,
+                chunk_size=2,
+                prefix='load',
+                password='secret',
+                output=output,
+                stdout=io.StringIO()
+            )
+            with open(output) as output_file:
+                access_tokens = [line.strip().split(',') for line in output_file]
+
+        self.assertEqual([username for username, _ in access_tokens], [f'load-{index}' for index in range(5)])
+        for username, access_token in access_tokens:
+            user = Token.objects.select_related('user').get(key=access_token).user
+            self.assertEqual(user.username, username)
+            self.assertEqual(user.chat_user.name, username)
+            self.assertTrue(user.check_password('secret'))
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class AdminChangelistQueriesTests(TestCase):
+    CHANGELISTS = ('/admin/chat/chatuser/', '/admin/chat/conversation/', '/admin/chat/message/')
+
+    def setUp(self):
+        self.client = Client()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        self.conversations_count = 0
+
+    def create_conversations(self, count):
+        for _ in range(count):
+            self.conversations_count += 1
+            author = create_chat_user(f'author-{self.conversations_count}')
+            partner = create_chat_user(f'partner-{self.conversations_count}')
+            conversation = Conversation.create_conversation([author.id, partner.id])
+            Message.create_message(author.id, conversation.id, 'hello')
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+        return len(queries)
+
+    def test_changelist_queries_do_not_grow_with_the_rows(self):
+        self.create_conversations(2)
+        queries_counts = {url: self.count_queries(url) for url in AdminChangelistQueriesTests.CHANGELISTS}
+
+        self.create_conversations(10)
+        for url, queries_count in queries_counts.items():
+            with self.subTest(url=url):
+                self.assertEqual(self.count_queries(url), queries_count)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, PN_IDLE_SECONDS=60)
+class PushNotificationRoutingTests(SimpleTestCase):
+    def deliver(self, author_id, is_visible=True):
+        '''
+        delivers a received message to the connection of user 1 and returns the notifications it sent to pn-task
+        '''
+        async def run():
+            consumer = ChatConsumer({'type': 'websocket'})
+            consumer.channel_layer = get_channel_layer()
+            consumer.channel_name = 'recipient-channel'
+            consumer._chat_user_id = 1
+            consumer._has_push_notifications = True
+            await consumer.process__set_visibility({'payload': {'is_visible': is_visible}})
+
+            with mock.patch.object(consumer, 'send_json') as send_json, \
+                    mock.patch.object(consumer.channel_layer, 'send') as send:
+                await consumer.chat_message({
+                    'content': {'request_type': 'receive_message', 'payload': {'author_id': author_id, 'text': 'hi'}}
+                })
+
+            consumer._authenticate_timeout_handle.cancel()
+            consumer._inactiveness_timeout_handle.cancel()
+            send_json.assert_called_once()
+            return [call[0][1] for call in send.call_args_list if call[0][0] == 'pn-task']
+
+        return async_to_sync(run)()
+
+    def test_the_author_is_not_notified_of_own_message(self):
+        self.assertEqual(self.deliver(author_id=1, is_visible=False), [])
+
+    def test_an_active_recipient_looking_at_the_chat_is_not_notified(self):
+        suppressed_count = metrics.get_snapshot()['counters'].get('pn.suppressed', 0)
+
+        self.assertEqual(self.deliver(author_id=2), [])
+        self.assertEqual(metrics.get_snapshot()['counters']['pn.suppressed'], suppressed_count + 1)
+
+    def test_a_recipient_not_looking_at_the_chat_is_notified(self):
+        notifications = self.deliver(author_id=2, is_visible=False)
+
+        self.assertEqual([notification['body'] for notification in notifications], ['hi'])
+
+    @override_settings(PN_IDLE_SECONDS=0)
+    def test_an_idle_recipient_is_notified(self):
+        self.assertEqual(len(self.deliver(author_id=2)), 1)
+
+
+def sleep_in_profiled_thread(is_done):
+    is_done.wait(5)
+
+
+class SamplingProfilerTests(TestCase):
+    def test_session_writes_the_folded_stacks_of_every_thread(self):
+        is_done = threading.Event()
+        thread = threading.Thread(target=sleep_in_profiled_thread, args=(is_done,), name='profiled thread')
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(is_done.set)
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            profiler = SamplingProfiler(interval_seconds=0.005, output_dir=output_dir)
+            self.assertTrue(profiler.start(0.05))
+            self.assertFalse(profiler.start(0.05))
+            while profiler.is_running:
+                time.sleep(0.01)
+
+            output_name, = os.listdir(output_dir)
+            with open(os.path.join(output_dir, output_name)) as output_file:
+                stacks = [line.rsplit(' ', 1) for line in output_file]
+
+        profiled_stacks = [stack for stack, _ in stacks if stack.startswith('profiled_thread;')]
+        self.assertTrue(any('chat.tests:sleep_in_profiled_thread' in stack for stack in profiled_stacks))
+        self.assertTrue(all(int(count) > 0 for _, count in stacks))
+
+    def test_only_staff_starts_a_session_with_a_bounded_duration(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('user'))
+        self.assertEqual(client.post('/profiler/', {'seconds': 1}).status_code, 403)
+
+        client.force_authenticate(User.objects.create_user('operator', is_staff=True))
+        self.assertEqual(client.post('/profiler/', {'seconds': 301}).status_code, 400)
+        with mock.patch('chat.views.get_profiler') as get_profiler:
+            get_profiler.return_value.start.return_value = True
+            response = client.post('/profiler/', {'seconds': 1})
+
+        self.assertTrue(response.json()['started'])
+        get_profiler.return_value.start.assert_called_once_with(1.0)
+
+
+class StructuredLoggingTests(SimpleTestCase):
+    @staticmethod
+    def make_record(message, *args, level=logging.INFO, **extra):
+        record = logging.getLogger('chat.tests').makeRecord('chat.tests', level, __file__, 0, message, args, None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_records_are_formatted_as_json_with_their_context(self):
+        entry = json.loads(log.JsonFormatter().format(
+            self.make_record('match %s', 'created', event='matchmaking.match_created', user_id=1, text='ignored')
+        ))
+
+        self.assertEqual(entry['message'], 'match created')
+        self.assertEqual(entry['event'], 'matchmaking.match_created')
+        self.assertEqual(entry['user_id'], 1)
+        self.assertNotIn('text', entry)
+        self.assertTrue(entry['time'].endswith('Z'))
+
+    def test_sampled_events_keep_their_share_and_errors_always_pass(self):
+        sampling_filter = log.SamplingFilter({'dropped.event': 0, 'kept.event': 1})
+
+        self.assertFalse(sampling_filter.filter(self.make_record('m', event='dropped.event')))
+        self.assertTrue(sampling_filter.filter(self.make_record('m', event='dropped.event', level=logging.ERROR)))
+        self.assertTrue(sampling_filter.filter(self.make_record('m', event='kept.event')))
+        self.assertTrue(sampling_filter.filter(self.make_record('m')))
+
+    def test_a_full_queue_drops_records_instead_of_blocking(self):
+        log_queue = queue.Queue(1)
+        handler = log.NonBlockingQueueHandler(log_queue)
+        dropped_count = metrics.get_snapshot()['counters'].get('log.dropped', 0)
+        arguments = ['first']
+
+        handler.handle(self.make_record('%s', arguments))
+        arguments.append('second')
+        handler.handle(self.make_record('%s', arguments))
+
+        self.assertEqual(log_queue.get_nowait().msg, "['first']")
+        self.assertEqual(metrics.get_snapshot()['counters']['log.dropped'], dropped_count + 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, BROADCAST_SHARDS=3, ANNOUNCEMENT_SHARD_INTERVAL_SECONDS=0)
+class AnnouncementsTests(TestCase):
+    def send_announcement(self, announcement):
+        '''
+        returns the time the handler took and the (group, content) of every group_send, in order
+        '''
+        task = create_task(AnnouncementsTask)
+        with run_worker_loop() as loop, mock.patch.object(task.channel_layer, 'group_send') as group_send:
+            task._loop = loop
+            start = time.monotonic()
+            shards_future = task.send_announcement({'announcement_id': announcement.id})
+            handler_seconds = time.monotonic() - start
+            shards_future.result(timeout=2)
+
+        return handler_seconds, [call[0] for call in group_send.call_args_list]
+
+    def test_announcement_is_sent_to_every_shard(self):
+        announcement = Announcement.objects.create(text='hello everyone')
+
+        _, group_sends = self.send_announcement(announcement)
+
+        content = {'type': 'chat.announcement', 'announcement_id': announcement.id, 'text': 'hello everyone'}
+        self.assertEqual(
+            group_sends,
+            [(get_broadcast_group_name(shard), content) for shard in range(settings.BROADCAST_SHARDS)]
+        )
+        self.assertIsNotNone(Announcement.objects.get(id=announcement.id).sent_at)
+
+    @override_settings(ANNOUNCEMENT_SHARD_INTERVAL_SECONDS=0.1)
+    def test_the_handler_does_not_wait_for_the_shard_intervals(self):
+        handler_seconds, group_sends = self.send_announcement(Announcement.objects.create(text='hello everyone'))
+
+        self.assertLess(handler_seconds, 0.1)
+        self.assertEqual(len(group_sends), settings.BROADCAST_SHARDS)
+
+    def test_deliveries_are_reported_once_per_flush_interval(self):
+        channel_layer = get_channel_layer()
+        delivery_counter = DeliveryCounter(channel_layer, flush_interval_seconds=0.01)
+
+        async def run():
+            for announcement_id in (1, 1, 2):
+                delivery_counter.increment(announcement_id)
+
+            report = await channel_layer.receive('announcements-task')
+            delivery_counter.increment(1)
+            return report, await channel_layer.receive('announcements-task')
+
+        first_report, second_report = async_to_sync(run)()
+        self.assertEqual(first_report, {'type': 'record_deliveries', 'deliveries': [[1, 2], [2, 1]]})
+        self.assertEqual(second_report['deliveries'], [[1, 1]])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage', DEBUG=False)
+class IndexPageTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('chat.views._index_page', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = Client()
+
+    def test_unchanged_page_is_revalidated_with_a_304(self):
+        with mock.patch('chat.views.render_to_string', wraps=views.render_to_string) as render_to_string:
+            response = self.client.get('/')
+            revalidated_response = self.client.get('/', HTTP_IF_NONE_MATCH=response['ETag'])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertEqual(revalidated_response.status_code, 304)
+        self.assertEqual(revalidated_response.content, b'')
+        render_to_string.assert_called_once()
+
+    def test_a_stale_etag_gets_the_page(self):
+        response = self.client.get('/', HTTP_IF_NONE_MATCH='"stale"')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(len(response.content), 0)
+
+
+class SingleNodeApplicationTests(SimpleTestCase):
+    def test_worker_tasks_start_with_the_first_connection_only(self):
+        from co_buddies.routing import SingleNodeApplication
+
+        application = mock.Mock()
+        single_node_application = SingleNodeApplication(application, ChatConsumer.WORKER_CHANNELS)
+
+        async def run():
+            with mock.patch('co_buddies.routing.Worker') as worker_class, \
+                    mock.patch('co_buddies.routing.asyncio.ensure_future') as ensure_future:
+                for _ in range(2):
+                    single_node_application({'type': 'websocket'})
+
+            return worker_class, ensure_future
+
+        worker_class, ensure_future = async_to_sync(run)()
+        worker_class.assert_called_once()
+        self.assertEqual(worker_class.call_args[1]['channels'], ChatConsumer.WORKER_CHANNELS)
+        self.assertEqual(ensure_future.call_count, 2)
+        self.assertEqual(application.call_count, 2)
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    __slots__ = ('_rate', '_capacity', '_tokens', '_last_refill_time')
+
+    def __init__(self, rate, capacity):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._last_refill_time = time.monotonic()
+
+    def consume(self, tokens=1):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last_refill_time) * self._rate)
+        self._last_refill_time = now
+
+        if self._tokens < tokens:
+            return False
+
+        self._tokens -= tokens
+        return True
+
+
+def get_inbox_depth(channel_layer, channel_name):
+    '''
+    the messages received for a consumer channel of this process that its consumer has not handled yet
+    '''
+    # InMemoryChannelLayer
+    if hasattr(channel_layer, 'channels'):
+        queue = channel_layer.channels.get(channel_name)
+    # RedisChannelLayer moves the messages of the process channels into local queues
+    else:
+        queue = getattr(channel_layer, 'receive_buffer', {}).get(channel_name)
+
+    return queue.qsize() if queue is not None else 0
+
+
+class ChannelBacklogMonitor:
+    '''
+    samples the backlog of the worker channels in the background, one instance is shared by every consumer of the process
+    '''
+    def __init__(self, channel_layer, channels, threshold, interval_seconds):
+        self._channel_layer = channel_layer
+        self._channels = channels
+        self._threshold = threshold
+        self._interval_seconds = interval_seconds
+        self._is_overloaded = False
+        self._sampling_task = None
+
+    def is_overloaded(self):
+        if self._threshold <= 0:
+            return False
+
+        if self._sampling_task is None or self._sampling_task.done():
+            self._sampling_task = asyncio.ensure_future(self._sample_forever())
+
+        return self._is_overloaded
+
+    async def _sample_forever(self):
+        while True:
+            try:
+                backlog = await self.get_backlog()
+                if (backlog > self._threshold) != self._is_overloaded:
+                    logger.warning('channel backlog is %s, load shedding %s', backlog, 'on' if not self._is_overloaded else 'off')
+
+                self._is_overloaded = backlog > self._threshold
+            except Exception:
+                logger.exception('failed sampling the channel backlog')
+
+            await asyncio.sleep(self._interval_seconds)
+
+    async def get_backlog(self):
+        backlog = 0
+        for channel in self._channels:
+            backlog = max(backlog, await self._get_channel_backlog(channel))
+
+        return backlog
+
+    async def _get_channel_backlog(self, channel):
+        channel_layer = self._channel_layer
+
+        # InMemoryChannelLayer
+        if hasattr(channel_layer, 'channels'):
+            queue = channel_layer.channels.get(channel)
+            return queue.qsize() if queue is not None else 0
+
+        # RedisChannelLayer keeps each channel in a list, the messages of a worker channel are spread over every host
+        if hasattr(channel_layer, 'connection'):
+            backlog = 0
+            for index in range(channel_layer.ring_size):
+                async with channel_layer.connection(index) as connection:
+                    backlog += await connection.llen(channel_layer.prefix + channel)
+
+            return backlog
+
+        return 0
@@ -0,0 +1,58 @@
+class TypingDebouncer:
+    '''
+    coalesces the typing events of a single user into at most one state change per interval,
+    typing stops by itself once no typing event arrived for idle_timeout_seconds
+    '''
+    __slots__ = (
+        '_interval_seconds',
+        '_idle_timeout_seconds',
+        '_requested_state',
+        '_sent_state',
+        '_last_typing_time',
+        '_last_sent_time',
+    )
+
+    def __init__(self, interval_seconds, idle_timeout_seconds):
+        self._interval_seconds = interval_seconds
+        self._idle_timeout_seconds = idle_timeout_seconds
+        self._requested_state = False
+        self._sent_state = False
+        self._last_typing_time = None
+        self._last_sent_time = None
+
+    def on_typing(self, is_typing, now):
+        self._requested_state = is_typing
+        if is_typing:
+            self._last_typing_time = now
+
+        return self.poll(now)
+
+    '''
+    returns the state that should be sent now, None if there is nothing to send yet
+    '''
+    def poll(self, now):
+        if self._requested_state and now >= self._last_typing_time + self._idle_timeout_seconds:
+            self._requested_state = False
+
+        if self._requested_state == self._sent_state:
+            return None
+
+        if self._last_sent_time is not None and now < self._last_sent_time + self._interval_seconds:
+            return None
+
+        self._sent_state = self._requested_state
+        self._last_sent_time = now
+        return self._sent_state
+
+    '''
+    returns the time poll should be called at, None if nothing is pending
+    '''
+    def get_next_deadline(self):
+        deadlines = []
+        if self._requested_state != self._sent_state:
+            deadlines.append(self._last_sent_time + self._interval_seconds)
+
+        if self._requested_state:
+            deadlines.append(self._last_typing_time + self._idle_timeout_seconds)
+
+        return min(deadlines) if len(deadlines) > 0 else None
@@ -1,5 +1,40 @@
+import hashlib
 from rest_auth.registration.views import RegisterView
 from allauth.account import app_settings as allauth_settings
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from django.conf import settings
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.template.loader import render_to_string
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from . import metrics
+from .models import ChatUser, Conversation, Message
+from .profiler import get_profiler
+from .search import search_messages
+
+
+# (content, etag) of the client index page, rendered once per process
+_index_page = None
+
+
+def _get_index_page():
+    global _index_page
+    if _index_page is None or settings.DEBUG:
+        content = render_to_string('index.html').encode()
+        _index_page = (content, hashlib.md5(content).hexdigest())
+
+    return _index_page
+
+
+# revalidated on every load, so a new client build is picked up while unchanged pages are answered with a 304
+@cache_control(no_cache=True)
+@condition(etag_func=lambda request: _get_index_page()[1])
+def index_view(request):
+    return HttpResponse(_get_index_page()[0], content_type='text/html; charset=utf-8')
 
 
 class CustomerRegisterView(RegisterView):
@@ -11,3 +46,126 @@ class CustomerRegisterView(RegisterView):
             'key': user.auth_token.key,
             'id': user.chat_user.id
         }
+
+
+class ConversationHistoryView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, conversation_id):
+        # only the attendees of the conversation and the staff may read its history
+        if (
+                not request.user.is_staff and
+                not Conversation.objects.filter(id=conversation_id, attendees__user=request.user).exists()
+        ):
+            raise PermissionDenied()
+
+        return Response({
+            'conversation_id': conversation_id,
+            'messages': Message.get_conversation_history(conversation_id)
+        })
+
+
+class ProfilerView(APIView):
+    permission_classes = [IsAdminUser]
+
+    # profiles the web process serving the request, workers are profiled with PROFILE=1 or SIGUSR2
+    def post(self, request):
+        try:
+            duration_seconds = float(request.data.get('seconds', settings.PROFILER_DURATION_SECONDS))
+        except (TypeError, ValueError):
+            raise ValidationError({'seconds': 'must be a number'})
+
+        if not 0 < duration_seconds <= 300:
+            raise ValidationError({'seconds': 'must be between 0 and 300'})
+
+        return Response({
+            'started': get_profiler().start(duration_seconds),
+            'output_dir': settings.PROFILER_OUTPUT_DIR
+        })
+
+
+class MetricsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    # the counters of the web process serving the request, the workers log theirs every METRICS_LOG_INTERVAL_SECONDS
+    def get(self, request):
+        return Response(metrics.get_snapshot())
+
+
+class ActivityStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            'active_conversations': Conversation.objects.filter(is_open=True).count()
+        })
+
+
+class ConversationStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, conversation_id):
+        conversation = get_object_or_404(
+            Conversation.objects.only('id', 'is_open', 'created_at', 'closed_at', 'message_count', 'last_message_time'),
+            id=conversation_id
+        )
+
+        return Response({
+            'conversation_id': conversation.id,
+            'is_open': conversation.is_open,
+            'message_count': conversation.message_count,
+            'last_message_time': conversation.last_message_time,
+            'created_at': conversation.created_at,
+            'closed_at': conversation.closed_at,
+            'duration_seconds': conversation.duration.total_seconds()
+        })
+
+
+class ChatUserStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, chat_user_id):
+        chat_user = get_object_or_404(ChatUser.objects.only('id', 'message_count', 'last_message_time'), id=chat_user_id)
+
+        return Response({
+            'chat_user_id': chat_user.id,
+            'message_count': chat_user.message_count,
+            'last_message_time': chat_user.last_message_time
+        })
+
+
+class MessageSearchView(APIView):
+    permission_classes = [IsAdminUser]
+    DEFAULT_LIMIT = 50
+    MAX_LIMIT = 200
+
+    def get(self, request):
+        query = request.query_params.get('q', '')
+        if len(query.strip()) == 0:
+            raise ValidationError({'q': 'a search query is required'})
+
+        limit = self._get_int_param(request, 'limit') or MessageSearchView.DEFAULT_LIMIT
+        limit = max(1, min(limit, MessageSearchView.MAX_LIMIT))
+        messages = search_messages(
+            query,
+            author_id=self._get_int_param(request, 'author'),
+            conversation_id=self._get_int_param(request, 'conversation'),
+            before_id=self._get_int_param(request, 'before'),
+            limit=limit
+        )
+
+        return Response({
+            'results': [message.get_payload() for message in messages],
+            'next_before': messages[-1].id if len(messages) == limit else None
+        })
+
+    @staticmethod
+    def _get_int_param(request, name):
+        value = request.query_params.get(name)
+        if value is None:
+            return None
+
+        try:
+            return int(value)
+        except ValueError:
+            raise ValidationError({name: 'must be an integer'})
@@ -1,11 +1,37 @@
 import asyncio
+from channels.layers import get_channel_layer
 from channels.routing import ProtocolTypeRouter, URLRouter, ChannelNameRouter
 from channels.auth import AuthMiddlewareStack
+from channels.worker import Worker
+from django.conf import settings
 from django.urls import re_path
 from channels.security.websocket import AllowedHostsOriginValidator
 
 from chat.consumers import ChatConsumer
-from chat.tasks import *
+from chat.tasks import MatchmakingTask, DBOperationsTask, PushNotificationsTask, ConversationManagerTask, AnnouncementsTask
+
+
+class SingleNodeApplication:
+    '''
+    hosts the worker tasks inside the daphne process, the worker starts on the event loop with the first connection
+    '''
+    def __init__(self, application, channels):
+        self._application = application
+        self._channels = channels
+        self._worker = None
+
+    def __call__(self, scope):
+        if self._worker is None:
+            self._worker = Worker(
+                application=self._application,
+                channels=self._channels,
+                channel_layer=get_channel_layer()
+            )
+            asyncio.ensure_future(self._worker.handle())
+            asyncio.ensure_future(self._worker.application_checker())
+
+        return self._application(scope)
+
 
 websocket_urlpatterns = [
     re_path(r'^chat$', ChatConsumer),
@@ -21,6 +47,10 @@ application = ProtocolTypeRouter({
             'matchmaking-task': MatchmakingTask,
             'db-operations-task': DBOperationsTask,
             'pn-task': PushNotificationsTask,
-            'conversation-manager-task': ConversationManagerTask
+            'conversation-manager-task': ConversationManagerTask,
+            'announcements-task': AnnouncementsTask
         })
 })
+
+if settings.SINGLE_NODE:
+    application = SingleNodeApplication(application, ChatConsumer.WORKER_CHANNELS)
@@ -15,13 +15,29 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import re_path, path, include
-from django.views.generic import TemplateView
-from chat.views import CustomerRegisterView
+from chat.views import (
+    index_view,
+    CustomerRegisterView,
+    ConversationHistoryView,
+    ActivityStatsView,
+    MetricsView,
+    ConversationStatsView,
+    ChatUserStatsView,
+    MessageSearchView,
+    ProfilerView,
+)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    re_path(r'^$', TemplateView.as_view(template_name='index.html'), name='index'),
+    re_path(r'^$', index_view, name='index'),
     # re_path(r'^rest-auth/', include('rest_auth.urls')),
     # re_path(r'^rest-auth/registration/', include('rest_auth.registration.urls')),
     re_path(r'^registration/', CustomerRegisterView.as_view()),
+    path('conversations/<int:conversation_id>/history/', ConversationHistoryView.as_view()),
+    path('stats/', ActivityStatsView.as_view()),
+    path('stats/metrics/', MetricsView.as_view()),
+    path('stats/conversations/<int:conversation_id>/', ConversationStatsView.as_view()),
+    path('stats/users/<int:chat_user_id>/', ChatUserStatsView.as_view()),
+    path('moderation/messages/search/', MessageSearchView.as_view()),
+    path('profiler/', ProfilerView.as_view()),
 ]